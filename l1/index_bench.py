@@ -0,0 +1,240 @@
+"""Повторяемое сравнение индексов lab.data.
+
+Для каждого размера выборки из lab.data создаётся копия lab.bench_<размер>, на ней по
+очереди строятся варианты индексов (без индекса, BTREE, BRIN, GIN pg_trgm, GIN pg_bigm),
+и каждая форма запроса с несколькими параметрами разной селективности выполняется
+через EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) --warmup + --runs раз. Первый прогон
+сохраняется отдельно как холодный (чтения с диска видны в shared read), по остальным
+считаются медиана и p95 времени выполнения и попадания/чтения буферов. Результаты
+пишутся в JSON.
+
+    POSTGRES_HOST=localhost python index_bench.py --sizes 10000,100000,1000000 --runs 20 \\
+        --output data/index_bench.json
+
+Кэш ОС и shared buffers между прогонами не сбрасываются; для действительно холодного
+первого прогона передайте --cold-command, например
+"sudo systemctl restart postgresql && sync && echo 3 | sudo tee /proc/sys/vm/drop_caches".
+"""
+import argparse
+import datetime
+import json
+import statistics
+import subprocess
+import sys
+import time
+from typing import Optional
+
+from loader import get_db_connection
+
+QUERIES = {
+    'rating': 'SELECT * FROM {table} WHERE rating < %s',
+    'date': 'SELECT * FROM {table} WHERE date BETWEEN %s AND %s',
+    'text': 'SELECT * FROM {table} WHERE text LIKE %s',
+}
+
+# Параметры от узких к широким
+PARAMS = {
+    'rating': [(2,), (3,), (5,)],
+    'date': [('2018-01-01', '2018-01-31'), ('2018-01-01', '2018-12-31'), ('2010-01-01', '2019-12-31')],
+    'text': [('%sushi%',), ('%terrible%',), ('%good%',)],
+}
+
+# Варианты индексов для каждой формы запроса; None - без индекса.
+# {ops} - схема, в которой установлено расширение с классом операторов.
+INDEXES = {
+    'rating': {
+        'none': None,
+        'btree': 'CREATE INDEX {name} ON {table} USING BTREE (rating)',
+    },
+    'date': {
+        'none': None,
+        'btree': 'CREATE INDEX {name} ON {table} USING BTREE (date)',
+        'brin': 'CREATE INDEX {name} ON {table} USING BRIN (date)',
+    },
+    'text': {
+        'none': None,
+        'gin_trgm': 'CREATE INDEX {name} ON {table} USING GIN (text {ops}.gin_trgm_ops)',
+        'gin_bigm': 'CREATE INDEX {name} ON {table} USING GIN (text {ops}.gin_bigm_ops)',
+    },
+}
+
+EXTENSIONS = {'gin_trgm': ('pg_trgm', 'gin_trgm_ops'), 'gin_bigm': ('pg_bigm', 'gin_bigm_ops')}
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def explain(cursor, sql: str, params: tuple) -> dict:
+    cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+    result = cursor.fetchone()[0]
+    # psycopg2 разбирает тип json сам, но на старых версиях приходит строка
+    return (json.loads(result) if isinstance(result, str) else result)[0]
+
+
+def plan_nodes(plan: dict) -> list[str]:
+    """Узлы плана сверху вниз: 'Bitmap Index Scan on idx' и т. п."""
+    node = plan['Node Type'] + (f" on {plan['Index Name']}" if 'Index Name' in plan else '')
+    return [node] + [child for sub in plan.get('Plans', []) for child in plan_nodes(sub)]
+
+
+def _sample(result: dict) -> dict:
+    plan = result['Plan']
+    return {
+        'execution_ms': result['Execution Time'],
+        'planning_ms': result['Planning Time'],
+        # Счётчики корневого узла включают все дочерние
+        'shared_hit': plan.get('Shared Hit Blocks', 0),
+        'shared_read': plan.get('Shared Read Blocks', 0),
+    }
+
+
+def profile(cursor, sql: str, params: tuple, runs: int = 20, warmup: int = 3) -> dict:
+    """Первый (холодный) прогон отдельно, по прогонам после прогрева - медиана и p95."""
+    first = explain(cursor, sql, params)
+    for _ in range(max(warmup - 1, 0)):
+        explain(cursor, sql, params)
+    samples = [_sample(explain(cursor, sql, params)) for _ in range(runs)]
+    times = [sample['execution_ms'] for sample in samples]
+    return {
+        'rows': first['Plan']['Actual Rows'],
+        'nodes': plan_nodes(first['Plan']),
+        'cold': _sample(first),
+        'warm': {
+            'median_ms': round(statistics.median(times), 3),
+            'p95_ms': round(percentile(times, 0.95), 3),
+            'min_ms': round(min(times), 3),
+            'planning_median_ms': round(statistics.median(sample['planning_ms'] for sample in samples), 3),
+            'shared_hit': statistics.median_low(sample['shared_hit'] for sample in samples),
+            'shared_read': statistics.median_low(sample['shared_read'] for sample in samples),
+        },
+    }
+
+
+def extension_schema(cursor, variant: str) -> Optional[str]:
+    """Схема класса операторов варианта; None, если расширение недоступно."""
+    if variant not in EXTENSIONS:
+        return None
+    extension, opclass = EXTENSIONS[variant]
+    try:
+        cursor.execute(f'CREATE EXTENSION IF NOT EXISTS {extension}')
+    except Exception as e:
+        print(f'{extension} недоступно: {e}'.strip(), file=sys.stderr)
+        return None
+    cursor.execute('''
+        SELECT n.nspname FROM pg_opclass o JOIN pg_namespace n ON n.oid = o.opcnamespace
+        WHERE o.opcname = %s AND o.opcmethod = (SELECT oid FROM pg_am WHERE amname = 'gin')
+    ''', (opclass,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def prepare_table(cursor, size: int) -> tuple[str, int, int]:
+    """Копия первых size строк lab.data без индексов; возвращает имя, число строк и размер в байтах."""
+    table = f'lab.bench_{size}'
+    cursor.execute(f'DROP TABLE IF EXISTS {table}')
+    # Порядок строк как в lab.data: от него зависит корреляция даты, важная для BRIN
+    cursor.execute(f'CREATE TABLE {table} AS SELECT * FROM lab.data LIMIT %s', (size,))
+    cursor.execute(f'VACUUM ANALYZE {table}')
+    cursor.execute(f'SELECT count(*), pg_total_relation_size(%s) FROM {table}', (table,))
+    rows, table_bytes = cursor.fetchone()
+    return table, rows, table_bytes
+
+
+def run_benchmark(sizes: list[int], queries: list[str], runs: int = 20, warmup: int = 3,
+                  cold_command: Optional[str] = None, keep_tables: bool = False, report=print) -> dict:
+    conn = get_db_connection()
+    # VACUUM и CREATE INDEX вне явной транзакции
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute('SHOW server_version')
+    server_version = cursor.fetchone()[0]
+    results = []
+    tables = []
+    try:
+        for size in sizes:
+            table, rows, table_bytes = prepare_table(cursor, size)
+            tables.append({'table': table, 'requested': size, 'rows': rows, 'bytes': table_bytes})
+            for query in queries:
+                sql = QUERIES[query].format(table=table)
+                for variant, template in INDEXES[query].items():
+                    index = None
+                    index_bytes = build_seconds = None
+                    if template is not None:
+                        ops = extension_schema(cursor, variant)
+                        if variant in EXTENSIONS and ops is None:
+                            results.append({'size': rows, 'query': query, 'index': variant, 'skipped': True})
+                            continue
+                        index = f'bench_{size}_{variant}'
+                        start = time.time()
+                        cursor.execute(template.format(name=index, table=table, ops=ops))
+                        build_seconds = round(time.time() - start, 3)
+                        cursor.execute(f'ANALYZE {table}')
+                        cursor.execute('SELECT pg_relation_size(%s)', (f'lab.{index}',))
+                        index_bytes = cursor.fetchone()[0]
+                    for params in PARAMS[query]:
+                        if cold_command:
+                            cursor.close()
+                            conn.close()
+                            subprocess.run(cold_command, shell=True, check=True)
+                            conn = get_db_connection()
+                            conn.autocommit = True
+                            cursor = conn.cursor()
+                        result = profile(cursor, sql, params, runs, warmup)
+                        result.update({
+                            'size': rows,
+                            'query': query,
+                            'params': list(params),
+                            'selectivity': round(result['rows'] / rows, 4) if rows else 0,
+                            'index': variant,
+                            'index_bytes': index_bytes,
+                            'build_seconds': build_seconds,
+                        })
+                        results.append(result)
+                        if report:
+                            report(f"{rows:>9} {query:<6} {variant:<8} {str(params):<28} "
+                                   f"sel {result['selectivity']:>7.2%}  median {result['warm']['median_ms']:>9.3f} ms  "
+                                   f"p95 {result['warm']['p95_ms']:>9.3f} ms  hit {result['warm']['shared_hit']:>7} "
+                                   f"read {result['cold']['shared_read']:>7} (cold)  {result['nodes'][-1]}")
+                    if index:
+                        cursor.execute(f'DROP INDEX lab.{index}')
+            if not keep_tables:
+                cursor.execute(f'DROP TABLE {table}')
+    finally:
+        cursor.close()
+        conn.close()
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'server_version': server_version,
+            'runs': runs,
+            'warmup': warmup,
+            'cold_command': cold_command,
+            'tables': tables,
+        },
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='размеры выборок через запятую')
+    parser.add_argument('--queries', default=','.join(QUERIES), help='формы запросов через запятую')
+    parser.add_argument('--runs', type=int, default=20, help='измеряемых прогонов на запрос')
+    parser.add_argument('--warmup', type=int, default=3, help='прогонов прогрева, включая холодный')
+    parser.add_argument('--cold-command', help='команда сброса кэшей перед холодным прогоном')
+    parser.add_argument('--keep-tables', action='store_true', help='не удалять lab.bench_<размер>')
+    parser.add_argument('--output', default='data/index_bench.json')
+    args = parser.parse_args()
+
+    result = run_benchmark([int(size) for size in args.sizes.split(',')], args.queries.split(','), args.runs,
+                           args.warmup, args.cold_command, args.keep_tables)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+    print(f'Результаты сохранены в {args.output}')
+
+
+if __name__ == '__main__':
+    main()
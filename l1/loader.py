@@ -0,0 +1,467 @@
+"""Потоковая загрузка отзывов Yelp (NDJSON) в PostgreSQL.
+
+Файл читается построчно, из каждого отзыва берутся review_id, text, stars и date.
+Строки копятся в буфере в памяти и порциями по --chunk-size уходят в lab.tmp через
+COPY FROM STDIN, поэтому память не зависит от размера файла. Затем lab.tmp
+переносится в lab.data без дубликатов и очищается.
+
+С --workers N файл делится на N диапазонов байт по границам строк. Каждый процесс
+со своим соединением копирует свой диапазон в отдельную UNLOGGED-таблицу, затем
+переносит её в lab.data пачками по --batch-size. Прогресс каждой порции и пачки
+фиксируется в lab.load_checkpoint в той же транзакции, поэтому повторный запуск
+после сбоя продолжает с места остановки. С --rebuild-indexes вторичные индексы
+lab.data удаляются на время загрузки и строятся заново в конце.
+
+    POSTGRES_HOST=localhost POSTGRES_PASSWORD=admin123 python loader.py data/rewiews.json
+    python loader.py data/rewiews.json --workers 8 --rebuild-indexes
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import psycopg2
+
+COLUMNS = ('origin_id', 'text', 'rating', 'date')
+CHUNK_SIZE = 50000
+BATCH_SIZE = 100000
+
+# Спецсимволы текстового формата COPY
+_COPY_ESCAPES = str.maketrans({'\x00': None, '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def get_db_connection():
+    return psycopg2.connect(
+        dbname=os.environ.get('POSTGRES_DB', 'db'),
+        user=os.environ.get('POSTGRES_USER', 'postgres'),
+        password=os.environ.get('POSTGRES_PASSWORD', 'admin123'),
+        host=os.environ.get('POSTGRES_HOST', 'localhost'),
+        port=int(os.environ.get('POSTGRES_PORT', '5432'))
+    )
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    # ru_maxrss в Linux - килобайты
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def copy_line(review: dict) -> Optional[str]:
+    """Строка COPY для отзыва или None, если не хватает полей (как dropna в pandas)."""
+    try:
+        values = (review['review_id'], review['text'], float(review['stars']), review['date'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if any(value is None for value in values):
+        return None
+    return '\t'.join(str(value).translate(_COPY_ESCAPES) for value in values) + '\n'
+
+
+def iter_chunks(path: str, chunk_size: int = CHUNK_SIZE, start: int = 0, end: Optional[int] = None,
+                with_pos: bool = False):
+    """Порции (буфер COPY, число строк, число пропущенных, смещение следующей строки)
+    из строк NDJSON-файла, начинающихся в [start, end). С with_pos первым столбцом
+    идёт смещение строки в файле."""
+    buffer, rows, skipped = io.StringIO(), 0, 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while end is None or pos < end:
+            line = f.readline()
+            if not line:
+                break
+            line_pos, pos = pos, pos + len(line)
+            if not line.strip():
+                continue
+            try:
+                row = copy_line(json.loads(line))
+            except ValueError:
+                row = None
+            if row is None:
+                skipped += 1
+                continue
+            buffer.write(f'{line_pos}\t{row}' if with_pos else row)
+            rows += 1
+            if rows == chunk_size:
+                buffer.seek(0)
+                yield buffer, rows, skipped, pos
+                buffer, rows, skipped = io.StringIO(), 0, 0
+    if rows or skipped:
+        buffer.seek(0)
+        yield buffer, rows, skipped, pos
+
+
+def create_tables(cursor):
+    cursor.execute('''
+        CREATE SCHEMA IF NOT EXISTS lab;
+        CREATE TABLE IF NOT EXISTS lab.data (
+            id VARCHAR(22) PRIMARY KEY,
+            text TEXT,
+            rating FLOAT,
+            date TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS lab.tmp (
+            id SERIAL PRIMARY KEY,
+            origin_id VARCHAR(22),
+            text TEXT,
+            rating FLOAT,
+            date TIMESTAMP
+        );
+    ''')
+
+
+def copy_chunks(cursor, path: str, table: str = 'lab.tmp', chunk_size: int = CHUNK_SIZE, report=print) -> dict:
+    """COPY файла в table порциями; возвращает статистику загрузки."""
+    start = time.time()
+    total, skipped, chunks = 0, 0, 0
+    for buffer, rows, bad, _ in iter_chunks(path, chunk_size):
+        cursor.copy_expert(f'COPY {table} ({", ".join(COLUMNS)}) FROM STDIN', buffer)
+        total += rows
+        skipped += bad
+        chunks += 1
+        elapsed = time.time() - start
+        if report:
+            report(f'{total} строк, {total / elapsed:.0f} строк/с, пиковая память {peak_rss_mb():.0f} МБ')
+    elapsed = time.time() - start
+    return {
+        'rows': total,
+        'skipped': skipped,
+        'chunks': chunks,
+        'seconds': round(elapsed, 2),
+        'rows_per_sec': round(total / elapsed) if elapsed else 0,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def merge(cursor) -> int:
+    """Перенос lab.tmp в lab.data без дубликатов; возвращает число добавленных строк."""
+    cursor.execute('''
+        INSERT INTO lab.data (id, text, rating, date)
+        SELECT origin_id, text, rating, date
+        FROM lab.tmp
+        ON CONFLICT (id) DO NOTHING
+    ''')
+    inserted = cursor.rowcount
+    cursor.execute('TRUNCATE TABLE lab.tmp')
+    return inserted
+
+
+def load(conn, path: str, chunk_size: int = CHUNK_SIZE, report=print) -> dict:
+    """Полная загрузка одной транзакцией: при ошибке lab.data не меняется."""
+    try:
+        with conn.cursor() as cursor:
+            create_tables(cursor)
+            stats = copy_chunks(cursor, path, chunk_size=chunk_size, report=report)
+            stats['inserted'] = merge(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return stats
+
+
+# Параллельная загрузка
+#
+# lab.load_checkpoint хранит по строке на диапазон файла: границы диапазона, смещение,
+# до которого строки уже скопированы в его staging-таблицу (copied_pos), число строк
+# в ней (rows) и смещение последней строки, перенесённой в lab.data (merged_pos).
+# lab.load_indexes - определения вторичных индексов, удалённых на время загрузки.
+def create_checkpoint_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lab.load_checkpoint (
+            source TEXT,
+            part INT,
+            start_pos BIGINT NOT NULL,
+            end_pos BIGINT NOT NULL,
+            copied_pos BIGINT NOT NULL,
+            rows BIGINT NOT NULL DEFAULT 0,
+            copied BOOLEAN NOT NULL DEFAULT FALSE,
+            merged_pos BIGINT NOT NULL DEFAULT -1,
+            inserted BIGINT NOT NULL DEFAULT 0,
+            merged BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (source, part)
+        );
+        CREATE TABLE IF NOT EXISTS lab.load_indexes (
+            source TEXT,
+            name TEXT,
+            definition TEXT NOT NULL,
+            PRIMARY KEY (source, name)
+        );
+    ''')
+
+
+def source_key(path: str) -> str:
+    # Тот же файл того же размера считается той же загрузкой
+    return f'{os.path.abspath(path)}:{os.path.getsize(path)}'
+
+
+def stage_table(source: str, part: int) -> str:
+    return f'lab.load_stage_{hashlib.md5(source.encode()).hexdigest()[:8]}_{part}'
+
+
+def split_file(path: str, parts: int) -> list[tuple[int, int]]:
+    """Диапазоны [start, end) примерно равного размера, начинающиеся с начала строки."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, parts):
+            f.seek(max(size * i // parts - 1, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def plan_parts(cursor, source: str, path: str, workers: int) -> list[int]:
+    """Номера диапазонов загрузки; при продолжении берётся сохранённое разбиение."""
+    cursor.execute('SELECT part FROM lab.load_checkpoint WHERE source = %s ORDER BY part', (source,))
+    parts = [row[0] for row in cursor.fetchall()]
+    if parts:
+        return parts
+    ranges = split_file(path, workers)
+    for part, (start, end) in enumerate(ranges):
+        cursor.execute('''
+            INSERT INTO lab.load_checkpoint (source, part, start_pos, end_pos, copied_pos)
+            VALUES (%s, %s, %s, %s, %s)
+        ''', (source, part, start, end, start))
+    return list(range(len(ranges)))
+
+
+def drop_secondary_indexes(cursor, source: str):
+    """Запоминает определения неуникальных индексов lab.data и удаляет их."""
+    cursor.execute('''
+        INSERT INTO lab.load_indexes (source, name, definition)
+        SELECT %s, i.relname, pg_get_indexdef(i.oid)
+        FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = 'lab.data'::regclass AND NOT x.indisunique
+        ON CONFLICT DO NOTHING
+    ''', (source,))
+    cursor.execute('SELECT name FROM lab.load_indexes WHERE source = %s ORDER BY name', (source,))
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'DROP INDEX IF EXISTS lab.{name}')
+
+
+def rebuild_index(source: str, name: str) -> float:
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            start = time.time()
+            cursor.execute('SELECT definition FROM lab.load_indexes WHERE source = %s AND name = %s',
+                           (source, name))
+            definition = cursor.fetchone()[0]
+            cursor.execute('SELECT to_regclass(%s)', (f'lab.{name}',))
+            if cursor.fetchone()[0] is None:
+                cursor.execute(definition)
+            cursor.execute('DELETE FROM lab.load_indexes WHERE source = %s AND name = %s', (source, name))
+        conn.commit()
+        return time.time() - start
+    finally:
+        conn.close()
+
+
+def _line_end(path: str, pos: int) -> int:
+    with open(path, 'rb') as f:
+        f.seek(pos)
+        f.readline()
+        return f.tell()
+
+
+def copy_part(path: str, source: str, part: int, chunk_size: int) -> int:
+    """COPY одного диапазона в его staging-таблицу; возвращает число строк в ней."""
+    conn = get_db_connection()
+    table = stage_table(source, part)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT start_pos, end_pos, copied_pos, rows, copied, merged_pos, merged
+                FROM lab.load_checkpoint WHERE source = %s AND part = %s
+            ''', (source, part))
+            start_pos, end_pos, copied_pos, rows, copied, merged_pos, merged = cursor.fetchone()
+            if merged:
+                return rows
+            cursor.execute(f'''
+                CREATE UNLOGGED TABLE IF NOT EXISTS {table} (
+                    pos BIGINT,
+                    origin_id VARCHAR(22),
+                    text TEXT,
+                    rating FLOAT,
+                    date TIMESTAMP
+                )
+            ''')
+            cursor.execute(f'SELECT count(*) FROM {table}')
+            if cursor.fetchone()[0] != rows:
+                # После аварийного рестарта PostgreSQL очищает UNLOGGED-таблицы:
+                # копируем заново всё, что ещё не перенесено в lab.data
+                cursor.execute(f'TRUNCATE {table}')
+                rows, copied = 0, False
+                copied_pos = _line_end(path, merged_pos) if merged_pos >= 0 else start_pos
+                cursor.execute('''
+                    UPDATE lab.load_checkpoint SET copied_pos = %s, rows = 0, copied = FALSE
+                    WHERE source = %s AND part = %s
+                ''', (copied_pos, source, part))
+            conn.commit()
+            if copied:
+                return rows
+            for buffer, chunk_rows, _, next_pos in iter_chunks(path, chunk_size, copied_pos, end_pos, with_pos=True):
+                cursor.copy_expert(f'COPY {table} (pos, {", ".join(COLUMNS)}) FROM STDIN', buffer)
+                rows += chunk_rows
+                cursor.execute('''
+                    UPDATE lab.load_checkpoint SET copied_pos = %s, rows = %s
+                    WHERE source = %s AND part = %s
+                ''', (next_pos, rows, source, part))
+                conn.commit()
+            # Строки шли по возрастанию pos, индекс для выборки пачек строится быстро
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {table.split(".")[1]}_pos ON {table} (pos)')
+            cursor.execute(f'ANALYZE {table}')
+            cursor.execute('''
+                UPDATE lab.load_checkpoint SET copied_pos = end_pos, copied = TRUE
+                WHERE source = %s AND part = %s
+            ''', (source, part))
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+
+def merge_part(source: str, part: int, batch_size: int) -> int:
+    """Перенос staging-таблицы диапазона в lab.data пачками; возвращает число добавленных строк."""
+    conn = get_db_connection()
+    table = stage_table(source, part)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT merged_pos, inserted, merged FROM lab.load_checkpoint
+                WHERE source = %s AND part = %s
+            ''', (source, part))
+            merged_pos, inserted, merged = cursor.fetchone()
+            while not merged:
+                # Дубликаты внутри пачки отбрасывает DISTINCT ON (остаётся строка с меньшим
+                # смещением), с уже загруженными - ON CONFLICT. Поэтому в пределах диапазона
+                # побеждает первая строка, а между диапазонами - та, что раньше попала в
+                # lab.data: при повторах id в разных частях файла выбор недетерминирован.
+                # Сортировка по id задаёт одинаковый порядок блокировок у параллельных
+                # пачек и исключает дедлоки.
+                cursor.execute(f'''
+                    WITH batch AS (
+                        SELECT pos, origin_id, text, rating, date FROM {table}
+                        WHERE pos > %(after)s
+                        ORDER BY pos
+                        LIMIT %(size)s
+                    ), inserted AS (
+                        INSERT INTO lab.data (id, text, rating, date)
+                        SELECT DISTINCT ON (origin_id) origin_id, text, rating, date
+                        FROM batch
+                        ORDER BY origin_id, pos
+                        ON CONFLICT (id) DO NOTHING
+                        RETURNING 1
+                    )
+                    SELECT (SELECT max(pos) FROM batch), (SELECT count(*) FROM inserted)
+                ''', {'after': merged_pos, 'size': batch_size})
+                last_pos, batch_inserted = cursor.fetchone()
+                if last_pos is None:
+                    merged = True
+                    cursor.execute(f'DROP TABLE IF EXISTS {table}')
+                else:
+                    merged_pos = last_pos
+                    inserted += batch_inserted
+                cursor.execute('''
+                    UPDATE lab.load_checkpoint SET merged_pos = %s, inserted = %s, merged = %s
+                    WHERE source = %s AND part = %s
+                ''', (merged_pos, inserted, merged, source, part))
+                conn.commit()
+        return inserted
+    finally:
+        conn.close()
+
+
+def parallel_load(path: str, workers: int, chunk_size: int = CHUNK_SIZE, batch_size: int = BATCH_SIZE,
+                  rebuild_indexes: bool = False, report=print) -> dict:
+    """Загрузка N процессами с продолжением после сбоя; возвращает статистику по фазам."""
+    source = source_key(path)
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            create_tables(cursor)
+            create_checkpoint_tables(cursor)
+            parts = plan_parts(cursor, source, path, workers)
+            if rebuild_indexes:
+                drop_secondary_indexes(cursor, source)
+            # Индексы, удалённые прерванным запуском, строятся и без --rebuild-indexes
+            cursor.execute('SELECT name FROM lab.load_indexes WHERE source = %s ORDER BY name', (source,))
+            indexes = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    finally:
+        conn.close()
+    if report:
+        report(f'{len(parts)} диапазонов, индексы на время загрузки удалены: {", ".join(indexes) or "нет"}')
+
+    stats = {'parts': len(parts)}
+    start = time.time()
+    with ProcessPoolExecutor(workers) as pool:
+        rows = sum(pool.map(copy_part, [path] * len(parts), [source] * len(parts), parts,
+                            [chunk_size] * len(parts)))
+        stats['copy_seconds'] = round(time.time() - start, 2)
+        if report:
+            report(f'COPY: {rows} строк за {stats["copy_seconds"]} с')
+
+        merge_start = time.time()
+        stats['inserted'] = sum(pool.map(merge_part, [source] * len(parts), parts, [batch_size] * len(parts)))
+        stats['merge_seconds'] = round(time.time() - merge_start, 2)
+        if report:
+            report(f'Перенос в lab.data: {stats["inserted"]} строк за {stats["merge_seconds"]} с')
+
+        # Индексы строятся одновременно: CREATE INDEX не блокирует другие CREATE INDEX
+        index_start = time.time()
+        list(pool.map(rebuild_index, [source] * len(indexes), indexes))
+        stats['index_seconds'] = round(time.time() - index_start, 2)
+        if report and indexes:
+            report(f'Индексы построены за {stats["index_seconds"]} с')
+
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('DELETE FROM lab.load_checkpoint WHERE source = %s', (source,))
+        conn.commit()
+    finally:
+        conn.close()
+    elapsed = time.time() - start
+    stats.update({
+        'rows': rows,
+        'seconds': round(elapsed, 2),
+        'rows_per_sec': round(rows / elapsed) if elapsed else 0,
+        'peak_rss_mb': round(max(peak_rss_mb(), peak_rss_mb(resource.RUSAGE_CHILDREN)), 1),
+    })
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='NDJSON-файл с отзывами')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='строк в одном COPY')
+    parser.add_argument('--workers', type=int, default=0, help='процессов параллельной загрузки')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='строк в одной пачке переноса')
+    parser.add_argument('--rebuild-indexes', action='store_true',
+                        help='удалить вторичные индексы lab.data на время загрузки')
+    args = parser.parse_args()
+
+    def report(message):
+        print(message, file=sys.stderr)
+
+    if args.workers:
+        stats = parallel_load(args.path, args.workers, args.chunk_size, args.batch_size, args.rebuild_indexes, report)
+    else:
+        conn = get_db_connection()
+        try:
+            stats = load(conn, args.path, args.chunk_size, report=report)
+        finally:
+            conn.close()
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""Catalog indexes for keyset pagination
+
+Revision ID: 002_catalog_indexes
+Revises: 001_initial_schema
+Create Date: 2026-10-18 10:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '002_catalog_indexes'
+down_revision = '001_initial_schema'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Сортировка и курсор (price, id) / (name, id) читаются прямо из индекса
+    op.create_index('ix_products_price_id', 'products', ['price', 'id'], schema='lab2')
+    op.create_index('ix_products_name_id', 'products', ['name', 'id'], schema='lab2')
+    # Частичный индекс для фильтра "только в наличии"
+    op.create_index(
+        'ix_products_in_stock_id', 'products', ['id'], schema='lab2',
+        postgresql_where=sa.text('stock > 0')
+    )
+
+def downgrade():
+    op.drop_index('ix_products_in_stock_id', table_name='products', schema='lab2')
+    op.drop_index('ix_products_name_id', table_name='products', schema='lab2')
+    op.drop_index('ix_products_price_id', table_name='products', schema='lab2')
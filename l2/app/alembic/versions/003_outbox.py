@@ -0,0 +1,34 @@
+"""Outbox for order notifications
+
+Revision ID: 003_outbox
+Revises: 002_catalog_indexes
+Create Date: 2026-10-18 12:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision = '003_outbox'
+down_revision = '002_catalog_indexes'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Уведомления пишутся в той же транзакции, что и заказ, и доставляются в Redis
+    # фоновым диспетчером; доставленные строки удаляются
+    op.create_table(
+        'outbox',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('payload', postgresql.JSONB(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.text('now()')),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('next_attempt_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.text('now()')),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        schema='lab2'
+    )
+
+def downgrade():
+    op.drop_table('outbox', schema='lab2')
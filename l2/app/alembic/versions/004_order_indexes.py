@@ -0,0 +1,29 @@
+"""Covering indexes for order history
+
+Revision ID: 004_order_indexes
+Revises: 003_outbox
+Create Date: 2026-10-18 14:00:00
+
+"""
+from alembic import op
+
+revision = '004_order_indexes'
+down_revision = '003_outbox'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # История заказов пользователя: WHERE user_id = ? AND id < ? ORDER BY id DESC
+    op.create_index(
+        'ix_orders_user_id_id', 'orders', ['user_id', 'id'], schema='lab2',
+        postgresql_include=['status']
+    )
+    # Позиции заказов: WHERE order_id IN (...) без обращения к таблице
+    op.create_index(
+        'ix_order_items_order_id', 'order_items', ['order_id'], schema='lab2',
+        postgresql_include=['id', 'product_id', 'quantity']
+    )
+
+def downgrade():
+    op.drop_index('ix_order_items_order_id', table_name='order_items', schema='lab2')
+    op.drop_index('ix_orders_user_id_id', table_name='orders', schema='lab2')
@@ -0,0 +1,24 @@
+"""Index for per-user ordering of outbox delivery
+
+Revision ID: 005_outbox_user_order
+Revises: 004_order_indexes
+Create Date: 2026-10-18 16:00:00
+
+"""
+from alembic import op
+
+revision = '005_outbox_user_order'
+down_revision = '004_order_indexes'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Диспетчер пропускает строку, если у пользователя есть более ранняя недоставленная:
+    # WHERE user_id = ? AND id < ? AND next_attempt_at > now()
+    op.create_index(
+        'ix_outbox_user_id_id', 'outbox', ['user_id', 'id'], schema='lab2',
+        postgresql_include=['next_attempt_at']
+    )
+
+def downgrade():
+    op.drop_index('ix_outbox_user_id_id', table_name='outbox', schema='lab2')
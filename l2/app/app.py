@@ -1,40 +1,44 @@
-from flask import Flask, request, jsonify, session, Response
+from flask import Flask, request, jsonify, session, Response, g
 from flask_sqlalchemy import SQLAlchemy
 from redis import Redis
 import uuid
 import json
+import hashlib
 import time
 import logging
-import logging.handlers
 import os
+import sys
 from datetime import timedelta
 from alembic.config import Config
 from alembic import command
+from sqlalchemy import event, tuple_
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import selectinload
 from sqlalchemy.exc import OperationalError
 from redis.exceptions import ConnectionError as RedisConnectionError
+import inventory
+import bulk
+import carts
+import cache
+import catalog
+import local_cache
+import logging_setup
+import metrics
+import notification_hub
+import outbox
+import passwords
+import pool_metrics
+import tokens
 
-# Configure logging
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)  # Set to DEBUG for detailed logging
-
-# Console handler (for kubectl logs)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
-console_formatter = logging.Formatter('%(asctime)s - %(levelname)s - [%(name)s] - %(message)s')
-console_handler.setFormatter(console_formatter)
-logger.addHandler(console_handler)
-
-# File handler with rotation
-os.makedirs('/app/logs', exist_ok=True)  # Create logs directory
-file_handler = logging.handlers.RotatingFileHandler(
-    '/app/logs/app.log',
-    maxBytes=10*1024*1024,  # 10MB per file
-    backupCount=5  # Keep 5 backup files
-)
-file_handler.setLevel(logging.DEBUG)
-file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - [%(name)s] - %(message)s')
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
+# Configure logging: запись идёт через очередь и фоновый поток, см. logging_setup
+LOG_DIR               = os.environ.get('LOG_DIR', '/app/logs')
+LOG_LEVEL             = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT            = os.environ.get('LOG_FORMAT', 'json')
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '1.0'))
+LOG_LEVEL_KEY         = 'config:log_level'  # Уровень, заданный через /admin/log-level
+LOG_LEVEL_REFRESH     = 10  # Как часто воркер перечитывает уровень из Redis, секунд
+logging_setup.setup_logging(LOG_DIR, LOG_LEVEL, LOG_FORMAT, LOG_DEBUG_SAMPLE_RATE)
+logger = logging.getLogger(logging_setup.LOGGER_NAME)
 
 app = Flask(__name__)
 
@@ -46,19 +50,113 @@ PG_DB       = os.environ.get('PG_DB')
 REDIS_HOST  = os.environ.get('REDIS_HOST')
 REDIS_PORT  = os.environ.get('REDIS_PORT')
 REDIS_DB    = os.environ.get('REDIS_DB')
+# Пул соединений Postgres (на каждый процесс-воркер)
+DB_POOL_SIZE          = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW       = int(os.environ.get('DB_MAX_OVERFLOW', '5'))
+DB_POOL_TIMEOUT       = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_RECYCLE       = int(os.environ.get('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING      = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+DB_CONNECT_TIMEOUT    = int(os.environ.get('DB_CONNECT_TIMEOUT', '5'))
+DB_STATEMENT_TIMEOUT  = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', '30000'))
+# Общий пул соединений Redis (на каждый процесс-воркер)
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', '50'))
+REDIS_POOL_TIMEOUT    = float(os.environ.get('REDIS_POOL_TIMEOUT', '5'))
+REDIS_SOCKET_TIMEOUT  = float(os.environ.get('REDIS_SOCKET_TIMEOUT', '5'))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', '2'))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+L1_CACHE_ENABLED = os.environ.get('L1_CACHE_ENABLED', 'false').lower() == 'true'
+L1_CACHE_SIZE    = int(os.environ.get('L1_CACHE_SIZE', '10000'))
+L1_CACHE_TTL     = float(os.environ.get('L1_CACHE_TTL', '5'))
+
+# opaque - случайный токен, данные в Redis (token:{token}); signed - подписанный токен,
+# проверяемый локально. Проверяются токены обоих видов, режим определяет, какие выдаёт /login.
+TOKEN_MODE       = os.environ.get('TOKEN_MODE', 'opaque')
+TOKEN_SECRET     = os.environ.get('TOKEN_SECRET')
+TOKEN_TTL        = int(os.environ.get('TOKEN_TTL', '3600'))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', '10000'))
+TOKEN_CACHE_TTL  = float(os.environ.get('TOKEN_CACHE_TTL', '30'))
+# Хеширование паролей: стоимость bcrypt, потоки KDF и предел ожидающих запросов на воркер
+PASSWORD_HASH_ROUNDS  = int(os.environ.get('PASSWORD_HASH_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 1)))
+PASSWORD_HASH_PENDING = int(os.environ.get('PASSWORD_HASH_PENDING', '32'))
+# Не больше LOGIN_RATE_LIMIT попыток входа на логин за LOGIN_RATE_WINDOW секунд
+LOGIN_RATE_LIMIT      = int(os.environ.get('LOGIN_RATE_LIMIT', '10'))
+LOGIN_RATE_WINDOW     = int(os.environ.get('LOGIN_RATE_WINDOW', '60'))
+# Предельная длительность одного /notifications/sub, секунд (0 - без ограничения).
+# gunicorn.conf.py задаёт её для gthread, где стрим занимает поток воркера
+SSE_MAX_DURATION      = float(os.environ.get('SSE_MAX_DURATION', '0'))
+
+if TOKEN_MODE not in ('opaque', 'signed'):
+    raise ValueError(f'Unsupported TOKEN_MODE {TOKEN_MODE}')
+if TOKEN_MODE == 'signed' and not TOKEN_SECRET:
+    raise ValueError('TOKEN_SECRET is required when TOKEN_MODE=signed')
+
+# Диспетчер outbox уведомлений (фоновый поток в каждом воркере)
+OUTBOX_DISPATCHER    = os.environ.get('OUTBOX_DISPATCHER', 'true').lower() == 'true'
+OUTBOX_BATCH_SIZE    = int(os.environ.get('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', '1'))
 
 SQLALCHEMY_URL = f'postgresql://{PG_USERNAME}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_DB}'
-logger.debug(f'SQL_ALCHEMY_URL: {SQLALCHEMY_URL}')
+logger.debug('SQL_ALCHEMY_URL: %s', SQLALCHEMY_URL)
 os.environ['SQLALCHEMY_URL'] = SQLALCHEMY_URL  # Set for alembic.ini
 app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': pool_metrics.TimedQueuePool,
+    'pool_size': DB_POOL_SIZE,
+    'max_overflow': DB_MAX_OVERFLOW,
+    'pool_timeout': DB_POOL_TIMEOUT,
+    'pool_recycle': DB_POOL_RECYCLE,
+    'pool_pre_ping': DB_POOL_PRE_PING,
+    'connect_args': {
+        'connect_timeout': DB_CONNECT_TIMEOUT,
+        'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}',
+        'application_name': 'shop-app',
+        'keepalives': 1,
+        'keepalives_idle': 30,
+        'keepalives_interval': 10,
+        'keepalives_count': 3,
+    },
+}
 app.config['SECRET_KEY'] = 'super-secret-key'
 app.config['SESSION_TYPE'] = 'redis'
-app.config['SESSION_REDIS'] = Redis(host=REDIS_HOST, port=int(REDIS_PORT), db=int(REDIS_DB))
+redis_pool = pool_metrics.TimedBlockingConnectionPool(
+    host=REDIS_HOST,
+    port=int(REDIS_PORT),
+    db=int(REDIS_DB),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+    socket_keepalive=True,
+    retry_on_timeout=True,
+    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+)
+app.config['SESSION_REDIS'] = Redis(connection_pool=redis_pool)
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
 
+CART_TTL = 86400  # Время жизни корзины в Redis, секунд
+CATALOG_PAGE_LIMIT = 50       # Размер страницы каталога по умолчанию
+CATALOG_MAX_PAGE_LIMIT = 500  # Максимальный размер страницы каталога
+ORDERS_PAGE_LIMIT = 20        # Размер страницы истории заказов по умолчанию
+ORDERS_MAX_PAGE_LIMIT = 100   # Максимальный размер страницы истории заказов
+PRODUCT_CACHE_TTL = 300       # Время жизни товаров и страниц каталога в кэше, секунд
+NOTIFICATIONS_PAGE_LIMIT = notification_hub.HISTORY_SIZE  # Размер страницы /notifications по умолчанию
+SSE_HEARTBEAT = 15            # Интервал комментариев-heartbeat в /notifications/sub, секунд
+
 db = SQLAlchemy(app)
-redis_client = Redis(host=REDIS_HOST, port=int(REDIS_PORT), db=int(REDIS_DB))
+# Клиент приложения считает команды и время Redis для /metrics
+redis_client = metrics.InstrumentedRedis(connection_pool=redis_pool)
+event.listen(Engine, 'before_cursor_execute', metrics.before_cursor_execute)
+event.listen(Engine, 'after_cursor_execute', metrics.after_cursor_execute)
+# Кэш в памяти воркера перед Redis для токенов и товаров
+l1_cache = local_cache.LocalCache(L1_CACHE_SIZE if L1_CACHE_ENABLED else 0, L1_CACHE_TTL)
+# Результаты проверки denylist подписанных токенов; Redis спрашивается только при промахе
+token_cache = local_cache.LocalCache(TOKEN_CACHE_SIZE if TOKEN_SECRET else 0, TOKEN_CACHE_TTL)
+# Одна подписка Redis на процесс для всех SSE-клиентов
+hub = notification_hub.NotificationHub(redis_client)
+password_hasher = passwords.PasswordHasher(PASSWORD_HASH_ROUNDS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_PENDING)
+outbox_dispatcher = outbox.Dispatcher(redis_client, OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL)
 
 # Модель для пользователя
 class User(db.Model):
@@ -72,7 +170,12 @@ class User(db.Model):
 # Модель для товара
 class Product(db.Model):
     __tablename__ = 'products'
-    __table_args__ = {'schema': 'lab2'}
+    __table_args__ = (
+        db.Index('ix_products_price_id', 'price', 'id'),
+        db.Index('ix_products_name_id', 'name', 'id'),
+        db.Index('ix_products_in_stock_id', 'id', postgresql_where=db.text('stock > 0')),
+        {'schema': 'lab2'},
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)
@@ -81,7 +184,10 @@ class Product(db.Model):
 # Модель для заказа
 class Order(db.Model):
     __tablename__ = 'orders'
-    __table_args__ = {'schema': 'lab2'}
+    __table_args__ = (
+        db.Index('ix_orders_user_id_id', 'user_id', 'id', postgresql_include=['status']),
+        {'schema': 'lab2'},
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('lab2.users.id'), nullable=False)
     status = db.Column(db.String(50), nullable=False, default='Pending')
@@ -90,11 +196,15 @@ class Order(db.Model):
 # Модель для элементов заказа
 class OrderItem(db.Model):
     __tablename__ = 'order_items'
-    __table_args__ = {'schema': 'lab2'}
+    __table_args__ = (
+        db.Index('ix_order_items_order_id', 'order_id', postgresql_include=['id', 'product_id', 'quantity']),
+        {'schema': 'lab2'},
+    )
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('lab2.orders.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('lab2.products.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
+    product = db.relationship('Product')
 
 # Применение миграций при старте приложения
 def apply_migrations():
@@ -104,476 +214,1017 @@ def apply_migrations():
         command.upgrade(alembic_cfg, "head")
         logger.info("Alembic migrations applied successfully")
     except Exception as e:
-        logger.error(f"Failed to apply migrations: {str(e)}")
+        logger.error("Failed to apply migrations: %s", e)
         raise
 
 # Проверка токена и роли
+# Claims подписанного токена, если он действителен и не отозван
+def signed_token_claims(token):
+    claims = tokens.verify(TOKEN_SECRET, token) if TOKEN_SECRET else None
+    if claims is None:
+        return None
+    key = tokens.denylist_key(claims['jti'])
+    revoked = token_cache.get(key)
+    metrics.cache_result('token', 'l1', 'miss' if revoked is local_cache.MISSING else 'hit')
+    if revoked is local_cache.MISSING:
+        revoked = tokens.is_revoked(redis_client, claims)
+        token_cache.set(key, revoked)
+    return None if revoked else claims
+
 def check_token(token, required_role=None):
-    logger.debug(f'Checking token for role {required_role}, token: {token}')
+    logger.debug('Checking token for role %s, token: %s', required_role, token)
     if not token or not isinstance(token, str):
         logger.warning("Invalid or missing token")
         return None
     try:
-        logger.debug(f"Fetching token data from Redis for token: {token}")
-        token_data = redis_client.get(f'token:{token}')
-        if not token_data:
-            logger.warning(f"Token {token} not found in Redis")
-            return None
-        token_data = json.loads(token_data)
+        if tokens.is_signed(token):
+            claims = signed_token_claims(token)
+            if claims is None:
+                logger.warning("Signed token is invalid, expired or revoked")
+                return None
+            token_data = {'user_id': claims['sub'], 'role': claims['role']}
+        else:
+            token_data = l1_cache.get(f'token:{token}')
+            metrics.cache_result('token', 'l1', 'miss' if token_data is local_cache.MISSING else 'hit')
+        if token_data is local_cache.MISSING:
+            logger.debug("Fetching token data from Redis for token: %s", token)
+            token_data = redis_client.get(f'token:{token}')
+            metrics.cache_result('token', 'redis', 'hit' if token_data else 'miss')
+            if not token_data:
+                logger.warning("Token %s not found in Redis", token)
+                return None
+            token_data = json.loads(token_data)
+            l1_cache.set(f'token:{token}', token_data)
         user_id = token_data.get('user_id')
         role = token_data.get('role')
-        logger.debug(f"Token data: user_id={user_id}, role={role}")
+        logger.debug("Token data: user_id=%s, role=%s", user_id, role)
         if required_role and role != required_role:
-            logger.warning(f"User {user_id} does not have required role {required_role}")
+            logger.warning("User %s does not have required role %s", user_id, required_role)
             return None
         return user_id
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in check_token: {str(e)}")
+        logger.error("Redis connection error in check_token: %s", e)
         return None
     except Exception as e:
-        logger.error(f"Error in check_token: {str(e)}")
+        logger.error("Error in check_token: %s", e)
         return None
 
+# Счётчик попыток входа по логину в окне LOGIN_RATE_WINDOW; проверяется до хеширования
+def login_attempts(username):
+    key = f'login_attempts:{username}'
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.set(key, 0, ex=LOGIN_RATE_WINDOW, nx=True)
+    pipe.incr(key)
+    pipe.ttl(key)
+    _, attempts, ttl = pipe.execute()
+    return attempts, ttl
+
+# Метрики запроса: задержка по маршруту, код ответа, обращения к Redis и Postgres
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.finish_request(route, request.method, response.status_code,
+                           time.perf_counter() - g.request_started)
+    metrics.observe_pools(pool_metrics.sqlalchemy_pool_stats(db.engine.pool),
+                          pool_metrics.redis_pool_stats(redis_pool))
+    return response
+
+@app.teardown_request
+def end_request_metrics(exc):
+    metrics.end_request()
+
+# Подписка воркера на инвалидацию локального кэша (один раз на процесс)
+@app.before_request
+def start_cache_invalidation_listener():
+    l1_cache.start_listener(redis_client)
+    token_cache.start_listener(redis_client)
+
+@app.before_request
+def start_outbox_dispatcher():
+    if OUTBOX_DISPATCHER:
+        outbox_dispatcher.start(db.engine)
+
+# Подхват уровня логирования, заданного для всех воркеров через Redis
+log_level_checked_at = 0.0
+
+@app.before_request
+def refresh_log_level():
+    global log_level_checked_at
+    now = time.monotonic()
+    if now - log_level_checked_at < LOG_LEVEL_REFRESH:
+        return
+    log_level_checked_at = now
+    try:
+        level = redis_client.get(LOG_LEVEL_KEY)
+        if level and level.decode() != logging_setup.get_level():
+            logging_setup.set_level(level.decode())
+    except Exception as e:
+        logger.warning("Failed to refresh log level: %s", e)
+
+# Разбор параметров страницы каталога; ValueError при некорректных значениях
+def parse_catalog_query(args):
+    sort = args.get('sort', 'id')
+    if sort not in ('id', 'price', 'name'):
+        raise ValueError(f'Unsupported sort field {sort}')
+    order = args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError(f'Unsupported order {order}')
+    limit = int(args.get('limit', CATALOG_PAGE_LIMIT))
+    if not 1 <= limit <= CATALOG_MAX_PAGE_LIMIT:
+        raise ValueError(f'limit must be between 1 and {CATALOG_MAX_PAGE_LIMIT}')
+    after_id = args.get('after_id')
+    after_id = int(after_id) if after_id is not None else None
+    after_value = args.get('after_value')
+    if after_id is not None and sort != 'id':
+        if after_value is None:
+            raise ValueError(f'after_value is required when sorting by {sort}')
+        after_value = float(after_value) if sort == 'price' else after_value
+    min_price = args.get('min_price')
+    max_price = args.get('max_price')
+    q = args.get('q') or None
+    if q is not None and len(q) > 100:
+        raise ValueError('q must be at most 100 characters')
+    return {
+        'sort': sort,
+        'order': order,
+        'limit': limit,
+        'after_id': after_id,
+        'after_value': after_value if sort != 'id' else None,
+        'min_price': float(min_price) if min_price is not None else None,
+        'max_price': float(max_price) if max_price is not None else None,
+        'in_stock': args.get('in_stock', '').lower() in ('1', 'true', 'yes'),
+        'q': q,
+    }
+
+# Выборка страницы каталога по ключу (sort, id) вместо OFFSET
+def query_catalog_page(params):
+    sort_column = getattr(Product, params['sort'])
+    descending = params['order'] == 'desc'
+    query = db.session.query(Product.id, Product.name, Product.price, Product.stock)
+    if params['min_price'] is not None:
+        query = query.filter(Product.price >= params['min_price'])
+    if params['max_price'] is not None:
+        query = query.filter(Product.price <= params['max_price'])
+    if params['in_stock']:
+        query = query.filter(Product.stock > 0)
+    if params['q'] is not None:
+        # Поиск по началу названия без учёта регистра
+        prefix = params['q'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(Product.name.ilike(prefix + '%', escape='\\'))
+    if params['after_id'] is not None:
+        if params['sort'] == 'id':
+            cursor, bound = Product.id, params['after_id']
+        else:
+            cursor = tuple_(sort_column, Product.id)
+            bound = tuple_(params['after_value'], params['after_id'])
+        query = query.filter(cursor < bound if descending else cursor > bound)
+    if params['sort'] == 'id':
+        ordering = [Product.id.desc() if descending else Product.id]
+    else:
+        ordering = [sort_column.desc(), Product.id.desc()] if descending else [sort_column, Product.id]
+    rows = query.order_by(*ordering).limit(params['limit'] + 1).all()
+    products = [catalog.serialize_product(row) for row in rows[:params['limit']]]
+    next_cursor = None
+    if len(rows) > params['limit']:
+        last = products[-1]
+        next_cursor = {'after_id': last['id']}
+        if params['sort'] != 'id':
+            next_cursor['after_value'] = last[params['sort']]
+    return {'products': products, 'next': next_cursor}
+
+# Загрузка товара для кэша; None, если товара нет
+def load_product(product_id):
+    logger.debug("Querying database for product %s", product_id)
+    product = db.session.get(Product, product_id)
+    return catalog.serialize_product(product) if product else None
+
+# Загрузка товаров по списку id (дозаполнение страниц каталога из кэша)
+def load_products(product_ids):
+    rows = db.session.query(Product.id, Product.name, Product.price, Product.stock) \
+        .filter(Product.id.in_(product_ids)).all()
+    return [catalog.serialize_product(row) for row in rows]
+
+# Заказы с позициями и названиями товаров двумя запросами: заказы, затем
+# позиции всех заказов страницы вместе с товарами (selectin + joined)
+def orders_with_items():
+    return Order.query.options(
+        selectinload(Order.items).joinedload(OrderItem.product, innerjoin=True).load_only(Product.name)
+    )
+
+def serialize_order(order):
+    return {
+        'id': order.id,
+        'user_id': order.user_id,
+        'status': order.status,
+        'items': [
+            {'product_id': item.product_id, 'name': item.product.name, 'quantity': item.quantity}
+            for item in order.items
+        ],
+    }
+
+# before - страница старее данного id (новые первыми);
+# since / since_ts - уведомления после id или момента времени (по возрастанию)
+def parse_notifications_query(args):
+    limit = int(args.get('limit', NOTIFICATIONS_PAGE_LIMIT))
+    if not 1 <= limit <= notification_hub.HISTORY_SIZE:
+        raise ValueError(f'limit must be between 1 and {notification_hub.HISTORY_SIZE}')
+    before = args.get('before')
+    since = args.get('since')
+    for name, value in (('before', before), ('since', since)):
+        if value is not None and not notification_hub.is_event_id(value):
+            raise ValueError(f'Invalid {name}')
+    since_ts = args.get('since_ts')
+    since_ts = float(since_ts) if since_ts is not None else None
+    if sum(value is not None for value in (before, since, since_ts)) > 1:
+        raise ValueError('Only one of before, since, since_ts is allowed')
+    return {'limit': limit, 'before': before, 'since': since, 'since_ts': since_ts}
+
+def load_notifications(user_id, params):
+    if params['since'] is not None:
+        return notification_hub.history_since(redis_client, user_id, params['since'], params['limit'])
+    if params['since_ts'] is not None:
+        return notification_hub.history_from_time(redis_client, user_id, params['since_ts'], params['limit'])
+    return notification_hub.recent(redis_client, user_id, params['limit'], params['before'])
+
+# JSON-ответ с ETag по содержимому: клиент с совпавшим If-None-Match получает 304 без тела
+def conditional_json(payload):
+    response = jsonify(payload)
+    response.add_etag()
+    return response.make_conditional(request)
+
+# ETag ответа /notifications: меняется только с появлением нового уведомления
+def notifications_etag(latest_id, params):
+    return hashlib.sha1(f'{latest_id}:{sorted(params.items())}'.encode()).hexdigest()[:20]
+
 # Регистрация пользователя
 @app.route('/register', methods=['POST'])
 def register():
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         data = request.get_json()
         username = data.get('username')
         password = data.get('password')
-        logger.info(f'Requested register for {username}')
-        logger.debug(f"Checking if username {username} exists")
+        logger.info('Requested register for %s', username)
+        logger.debug("Checking if username %s exists", username)
+        if not username or not password:
+            return jsonify({'error': 'Missing required fields'}), 400
         if User.query.filter_by(username=username).first():
             return jsonify({'error': 'User already exists'}), 400
-        user = User(username=username, password=password, role='user')
+        user = User(username=username, password=password_hasher.hash(password), role='user')
         db.session.add(user)
-        logger.debug(f"Committing new user {username} to database")
+        logger.debug("Committing new user %s to database", username)
         db.session.commit()
         return jsonify({'message': 'User registered successfully'}), 201
+    except passwords.Busy:
+        logger.warning("Password hashing pool is saturated, rejecting register")
+        return jsonify({'error': 'Server is busy, try again later'}), 503
     except OperationalError as e:
-        logger.error(f"Database error in register: {str(e)}")
+        logger.error("Database error in register: %s", e)
         return jsonify({'error': 'Database connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in register: {str(e)}")
+        logger.error("Error in register: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Авторизация и генерация токена
 @app.route('/login', methods=['POST'])
 def login():
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         data = request.get_json()
         username = data.get('username')
         password = data.get('password')
-        logger.info(f'Requested login for {username}')
-        logger.debug(f"Querying user {username}")
-        user = User.query.filter_by(username=username, password=password).first()
-        if not user:
+        logger.info('Requested login for %s', username)
+        if not username or not password:
+            return jsonify({'error': 'Invalid credentials'}), 401
+        attempts, retry_after = login_attempts(username)
+        if attempts > LOGIN_RATE_LIMIT:
+            logger.warning("Too many login attempts for %s", username)
+            return jsonify({'error': 'Too many login attempts'}), 429, {'Retry-After': str(max(retry_after, 1))}
+        logger.debug("Querying user %s", username)
+        user = User.query.filter_by(username=username).first()
+        ok, rehash = password_hasher.verify(password, user.password if user else None)
+        if not ok:
             return jsonify({'error': 'Invalid credentials'}), 401
-        token = str(uuid.uuid4())
-        logger.debug(f"Storing token {token} in Redis for user {user.id}")
-        redis_client.setex(f'token:{token}', 3600, json.dumps({'user_id': user.id, 'role': user.role}))
+        if rehash:
+            # Открытый пароль или хеш с устаревшей стоимостью
+            logger.info("Rehashing password of user %s", user.id)
+            user.password = password_hasher.hash(password)
+            db.session.commit()
+        if TOKEN_MODE == 'signed':
+            token = tokens.issue(TOKEN_SECRET, user.id, user.role, TOKEN_TTL)
+        else:
+            token = str(uuid.uuid4())
+            logger.debug("Storing token %s in Redis for user %s", token, user.id)
+            redis_client.setex(f'token:{token}', TOKEN_TTL, json.dumps({'user_id': user.id, 'role': user.role}))
         return jsonify({'token': token, 'role': user.role}), 200
+    except passwords.Busy:
+        logger.warning("Password hashing pool is saturated, rejecting login")
+        return jsonify({'error': 'Server is busy, try again later'}), 503
     except OperationalError as e:
-        logger.error(f"Database error in login: {str(e)}")
+        logger.error("Database error in login: %s", e)
         return jsonify({'error': 'Database connection error'}), 500
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in login: {str(e)}")
+        logger.error("Redis connection error in login: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in login: {str(e)}")
+        logger.error("Error in login: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Выход: отзыв токена на всех подах
+@app.route('/logout', methods=['POST'])
+def logout():
+    try:
+        logger.debug("Received %s request to %s", request.method, request.url)
+        token = request.headers.get('Authorization')
+        user_id = check_token(token)
+        logger.info('Requested logout for user %s', user_id)
+        if not user_id:
+            return jsonify({'error': 'Unauthorized'}), 401
+        pipe = redis_client.pipeline(transaction=True)
+        if tokens.is_signed(token):
+            # Подписанный токен нельзя удалить - он попадает в denylist до истечения срока
+            claims = tokens.verify(TOKEN_SECRET, token)
+            key = tokens.denylist_key(claims['jti'])
+            tokens.revoke(pipe, claims)
+        else:
+            key = f'token:{token}'
+            pipe.delete(key)
+        local_cache.publish_invalidation(pipe, key)
+        pipe.execute()
+        l1_cache.delete(key)
+        token_cache.delete(key)
+        return jsonify({'message': 'Logged out'}), 200
+    except RedisConnectionError as e:
+        logger.error("Redis connection error in logout: %s", e)
+        return jsonify({'error': 'Redis connection error'}), 500
+    except Exception as e:
+        logger.error("Error in logout: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # CRUD: Создание товара (только для админа)
 @app.route('/products', methods=['POST'])
 def create_product():
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         token = request.headers.get('Authorization')
         user_id = check_token(token, required_role='admin')
-        logger.info(f'Requested product addition for user {user_id}')
+        logger.info('Requested product addition for user %s', user_id)
         if not user_id:
             return jsonify({'error': 'Unauthorized or not an admin'}), 401
         data = request.get_json()
         name = data.get('name')
         price = data.get('price')
         stock = data.get('stock')
-        logger.debug(f"Product data: name={name}, price={price}, stock={stock}")
+        logger.debug("Product data: name=%s, price=%s, stock=%s", name, price, stock)
         if not all([name, price, stock]):
             return jsonify({'error': 'Missing required fields'}), 400
         product = Product(name=name, price=price, stock=stock)
         db.session.add(product)
         logger.debug("Committing new product to database")
         db.session.commit()
-        redis_client.delete('products')
+        catalog.product_changed(redis_client, None, catalog.serialize_product(product), PRODUCT_CACHE_TTL)
+        l1_cache.delete(catalog.product_key(product.id))
         return jsonify({'message': 'Product created', 'id': product.id}), 201
     except OperationalError as e:
-        logger.error(f"Database error in create_product: {str(e)}")
+        logger.error("Database error in create_product: %s", e)
         return jsonify({'error': 'Database connection error'}), 500
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in create_product: {str(e)}")
+        logger.error("Redis connection error in create_product: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in create_product: {str(e)}")
+        logger.error("Error in create_product: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # CRUD: Получение одного товара
 @app.route('/products/<int:product_id>', methods=['GET'])
 def get_product(product_id):
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
-        logger.info(f'Requested product {product_id}')
-        logger.debug(f"Checking Redis cache for product:{product_id}")
-        cached = redis_client.get(f'product:{product_id}')
-        if cached:
-            logger.debug(f"Cache hit for product {product_id}")
-            return jsonify(json.loads(cached)), 200
-        logger.debug(f"Querying database for product {product_id}")
-        product = db.session.get(Product, product_id)
-        if not product:
+        logger.debug("Received %s request to %s", request.method, request.url)
+        logger.info('Requested product %s', product_id)
+        logger.debug("Checking Redis cache for product:%s", product_id)
+        product_key = catalog.product_key(product_id)
+        product_data = l1_cache.get(product_key)
+        metrics.cache_result('product', 'l1', 'miss' if product_data is local_cache.MISSING else 'hit')
+        if product_data is local_cache.MISSING:
+            product_data, status = cache.fetch(redis_client, product_key, PRODUCT_CACHE_TTL,
+                                               lambda: load_product(product_id))
+            metrics.cache_result('product', 'redis', status)
+            logger.debug("Cache %s for product %s", status, product_id)
+            l1_cache.set(product_key, product_data)
+        if product_data is None:
             return jsonify({'error': 'Product not found'}), 404
-        product_data = {'id': product.id, 'name': product.name, 'price': product.price, 'stock': product.stock}
-        logger.debug(f"Caching product {product_id} in Redis")
-        redis_client.setex(f'product:{product_id}', 300, json.dumps(product_data))
-        return jsonify(product_data), 200
+        return conditional_json(product_data)
     except OperationalError as e:
-        logger.error(f"Database error in get_product: {str(e)}")
+        logger.error("Database error in get_product: %s", e)
         return jsonify({'error': 'Database connection error'}), 500
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in get_product: {str(e)}")
+        logger.error("Redis connection error in get_product: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in get_product: {str(e)}")
+        logger.error("Error in get_product: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # CRUD: Обновление товара (только для админа)
 @app.route('/products/<int:product_id>', methods=['PUT'])
 def update_product(product_id):
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         token = request.headers.get('Authorization')
         user_id = check_token(token, required_role='admin')
-        logger.info(f'Requested product edit for user {user_id}')
+        logger.info('Requested product edit for user %s', user_id)
         if not user_id:
             return jsonify({'error': 'Unauthorized or not an admin'}), 401
-        logger.debug(f"Querying database for product {product_id}")
+        logger.debug("Querying database for product %s", product_id)
         product = db.session.get(Product, product_id)
         if not product:
             return jsonify({'error': 'Product not found'}), 404
         data = request.get_json()
+        old = catalog.serialize_product(product)
         product.name = data.get('name', product.name)
         product.price = data.get('price', product.price)
         product.stock = data.get('stock', product.stock)
-        logger.debug(f"Committing updated product {product_id} to database")
+        logger.debug("Committing updated product %s to database", product_id)
         db.session.commit()
-        redis_client.delete('products')
-        redis_client.delete(f'product:{product_id}')
+        changed = catalog.product_changed(redis_client, old, catalog.serialize_product(product), PRODUCT_CACHE_TTL)
+        l1_cache.delete(catalog.product_key(product_id))
+        logger.debug("Patched cached product %s, bumped catalog versions %s", product_id, changed)
         return jsonify({'message': 'Product updated'}), 200
     except OperationalError as e:
-        logger.error(f"Database error in update_product: {str(e)}")
+        logger.error("Database error in update_product: %s", e)
         return jsonify({'error': 'Database connection error'}), 500
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in update_product: {str(e)}")
+        logger.error("Redis connection error in update_product: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in update_product: {str(e)}")
+        logger.error("Error in update_product: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Массовое изменение товаров (только для админа): JSON-массив или NDJSON
+# (Content-Type: application/x-ndjson) записей {"id", "name"?, "price"?, "stock"?}
+@app.route('/admin/products/bulk', methods=['POST'])
+def bulk_update_products():
+    try:
+        logger.debug("Received %s request to %s", request.method, request.url)
+        token = request.headers.get('Authorization')
+        user_id = check_token(token, required_role='admin')
+        logger.info('Requested bulk product update for user %s', user_id)
+        if not user_id:
+            return jsonify({'error': 'Unauthorized or not an admin'}), 401
+
+        def invalidate(changes):
+            catalog.products_changed(redis_client, changes, PRODUCT_CACHE_TTL)
+            l1_cache.delete(*(catalog.product_key(new['id']) for _, new in changes))
+
+        records = bulk.iter_records(request.stream, request.mimetype)
+        try:
+            result = bulk.update_products(db.engine, records, invalidate)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        logger.info("Bulk product update: %s", result)
+        return jsonify(result), 200
+    except OperationalError as e:
+        logger.error("Database error in bulk_update_products: %s", e)
+        return jsonify({'error': 'Database connection error'}), 500
+    except RedisConnectionError as e:
+        logger.error("Redis connection error in bulk_update_products: %s", e)
+        return jsonify({'error': 'Redis connection error'}), 500
+    except Exception as e:
+        logger.error("Error in bulk_update_products: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # CRUD: Удаление товара (только для админа)
 @app.route('/products/<int:product_id>', methods=['DELETE'])
 def delete_product(product_id):
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         token = request.headers.get('Authorization')
         user_id = check_token(token, required_role='admin')
-        logger.info(f'Requested product removal for user {user_id}')
+        logger.info('Requested product removal for user %s', user_id)
         if not user_id:
             return jsonify({'error': 'Unauthorized or not an admin'}), 401
-        logger.debug(f"Querying database for product {product_id}")
+        logger.debug("Querying database for product %s", product_id)
         product = db.session.get(Product, product_id)
         if not product:
             return jsonify({'error': 'Product not found'}), 404
+        old = catalog.serialize_product(product)
         db.session.delete(product)
-        logger.debug(f"Committing deletion of product {product_id}")
+        logger.debug("Committing deletion of product %s", product_id)
         db.session.commit()
-        redis_client.delete('products')
-        redis_client.delete(f'product:{product_id}')
+        catalog.product_changed(redis_client, old, None, PRODUCT_CACHE_TTL)
+        l1_cache.delete(catalog.product_key(product_id))
         return jsonify({'message': 'Product deleted'}), 200
     except OperationalError as e:
-        logger.error(f"Database error in delete_product: {str(e)}")
+        logger.error("Database error in delete_product: %s", e)
         return jsonify({'error': 'Database connection error'}), 500
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in delete_product: {str(e)}")
+        logger.error("Redis connection error in delete_product: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in delete_product: {str(e)}")
+        logger.error("Error in delete_product: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Получение каталога товаров
 @app.route('/products', methods=['GET'])
 def get_products():
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         logger.info('Requested products')
-        logger.debug("Checking Redis cache for products")
-        cached = redis_client.get('products')
-        if cached:
-            logger.debug("Cache hit for products")
-            return jsonify(json.loads(cached)), 200
-        logger.debug("Querying database for all products")
-        products = Product.query.all()
-        product_list = [{'id': p.id, 'name': p.name, 'price': p.price, 'stock': p.stock} for p in products]
-        logger.debug("Caching products in Redis")
-        redis_client.setex('products', 300, json.dumps(product_list))
-        return jsonify(product_list), 200
+        try:
+            params = parse_catalog_query(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        page, status = catalog.get_page(redis_client, params, query_catalog_page, load_products, PRODUCT_CACHE_TTL)
+        metrics.cache_result('products', 'redis', status)
+        logger.debug("Cache %s for products page", status)
+        return conditional_json(page)
     except OperationalError as e:
-        logger.error(f"Database error in get_products: {str(e)}")
+        logger.error("Database error in get_products: %s", e)
         return jsonify({'error': 'Database connection error'}), 500
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in get_products: {str(e)}")
+        logger.error("Redis connection error in get_products: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in get_products: {str(e)}")
+        logger.error("Error in get_products: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Получение содержимого корзины
 @app.route('/cart', methods=['GET'])
 def get_cart():
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         token = request.headers.get('Authorization')
         user_id = check_token(token)
-        logger.info(f'Requested cart for user {user_id}')
+        logger.info('Requested cart for user %s', user_id)
         if not user_id:
             return jsonify({'error': 'Unauthorized'}), 401
-        cart_key = f'cart:{user_id}'
-        logger.debug(f"Fetching cart from Redis: {cart_key}")
-        cart = redis_client.get(cart_key)
-        cart = json.loads(cart) if cart else {}
-        return jsonify({'cart': cart}), 200
+        logger.debug("Fetching cart from Redis: %s", carts.cart_key(user_id))
+        cart = carts.get(redis_client, user_id)
+        return conditional_json({'cart': cart})
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in get_cart: {str(e)}")
+        logger.error("Redis connection error in get_cart: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in get_cart: {str(e)}")
+        logger.error("Error in get_cart: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Очистка корзины
 @app.route('/cart', methods=['DELETE'])
 def delete_cart():
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         token = request.headers.get('Authorization')
         user_id = check_token(token)
-        logger.info(f'Requested cart removal for user {user_id}')
+        logger.info('Requested cart removal for user %s', user_id)
         if not user_id:
             return jsonify({'error': 'Unauthorized'}), 401
-        cart_key = f'cart:{user_id}'
-        logger.debug(f"Deleting cart from Redis: {cart_key}")
-        redis_client.delete(cart_key)
+        logger.debug("Deleting cart from Redis: %s", carts.cart_key(user_id))
+        cart = carts.take(redis_client, user_id)
+        inventory.release(redis_client, user_id, cart)
         return jsonify({'message': 'Cart deleted'}), 200
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in delete_cart: {str(e)}")
+        logger.error("Redis connection error in delete_cart: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in delete_cart: {str(e)}")
+        logger.error("Error in delete_cart: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Добавление товара в корзину
 @app.route('/cart/add', methods=['POST'])
 def add_to_cart():
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         token = request.headers.get('Authorization')
         user_id = check_token(token)
-        logger.info(f'Requested product addition in cart for user {user_id}')
+        logger.info('Requested product addition in cart for user %s', user_id)
         if not user_id:
             return jsonify({'error': 'Unauthorized'}), 401
         data = request.get_json()
         product_id = data.get('product_id')
         quantity = int(data.get('quantity', 1))
-        logger.debug(f"Querying database for product {product_id}")
+        if quantity < 1:
+            return jsonify({'error': 'Quantity must be positive'}), 400
+        logger.debug("Querying database for product %s", product_id)
         product = db.session.get(Product, product_id)
         if product is None:
             return jsonify({'error': f'Product {product_id} not found'}), 404
-        cart_key = f'cart:{user_id}'
-        logger.debug(f"Fetching cart from Redis: {cart_key}")
-        cart = redis_client.get(cart_key)
-        cart = json.loads(cart) if cart else {}
-        cart[str(product_id)] = cart.get(str(product_id), 0) + quantity
-        logger.debug(f"Updating cart in Redis: {cart_key}")
-        redis_client.setex(cart_key, 86400, json.dumps(cart))
+        logger.debug("Reserving %s of product %s for user %s", quantity, product_id, user_id)
+        if not inventory.reserve(redis_client, product.id, user_id, quantity, product.stock, CART_TTL):
+            return jsonify({'error': f'Not enough stock for product {product_id}'}), 409
+        logger.debug("Updating cart in Redis: %s", carts.cart_key(user_id))
+        carts.add(redis_client, user_id, product.id, quantity, CART_TTL)
         return jsonify({'message': 'Added to cart'}), 200
     except OperationalError as e:
-        logger.error(f"Database error in add_to_cart: {str(e)}")
+        logger.error("Database error in add_to_cart: %s", e)
+        return jsonify({'error': 'Database connection error'}), 500
+    except RedisConnectionError as e:
+        logger.error("Redis connection error in add_to_cart: %s", e)
+        return jsonify({'error': 'Redis connection error'}), 500
+    except Exception as e:
+        logger.error("Error in add_to_cart: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Установка количества одной позиции корзины
+@app.route('/cart/<int:product_id>', methods=['PUT'])
+def set_cart_item(product_id):
+    try:
+        logger.debug("Received %s request to %s", request.method, request.url)
+        token = request.headers.get('Authorization')
+        user_id = check_token(token)
+        logger.info('Requested cart item update for user %s', user_id)
+        if not user_id:
+            return jsonify({'error': 'Unauthorized'}), 401
+        data = request.get_json()
+        quantity = int(data.get('quantity', 0))
+        if quantity < 0:
+            return jsonify({'error': 'Quantity must not be negative'}), 400
+        if quantity == 0:
+            old = carts.remove_line(redis_client, user_id, product_id)
+            inventory.release(redis_client, user_id, {product_id: old})
+            return jsonify({'message': 'Removed from cart'}), 200
+        logger.debug("Querying database for product %s", product_id)
+        product = db.session.get(Product, product_id)
+        if product is None:
+            return jsonify({'error': f'Product {product_id} not found'}), 404
+        logger.debug("Setting quantity %s of product %s in cart for user %s", quantity, product_id, user_id)
+        old = carts.set_line(redis_client, user_id, product_id, quantity, CART_TTL)
+        delta = quantity - old
+        if delta > 0 and not inventory.reserve(redis_client, product_id, user_id, delta, product.stock, CART_TTL):
+            if old:
+                carts.set_line(redis_client, user_id, product_id, old, CART_TTL)
+            else:
+                carts.remove_line(redis_client, user_id, product_id)
+            return jsonify({'error': f'Not enough stock for product {product_id}'}), 409
+        if delta < 0:
+            inventory.release(redis_client, user_id, {product_id: -delta})
+        return jsonify({'message': 'Cart updated'}), 200
+    except OperationalError as e:
+        logger.error("Database error in set_cart_item: %s", e)
         return jsonify({'error': 'Database connection error'}), 500
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in add_to_cart: {str(e)}")
+        logger.error("Redis connection error in set_cart_item: %s", e)
+        return jsonify({'error': 'Redis connection error'}), 500
+    except Exception as e:
+        logger.error("Error in set_cart_item: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Удаление одной позиции из корзины
+@app.route('/cart/<int:product_id>', methods=['DELETE'])
+def delete_cart_item(product_id):
+    try:
+        logger.debug("Received %s request to %s", request.method, request.url)
+        token = request.headers.get('Authorization')
+        user_id = check_token(token)
+        logger.info('Requested cart item removal for user %s', user_id)
+        if not user_id:
+            return jsonify({'error': 'Unauthorized'}), 401
+        logger.debug("Removing product %s from cart %s", product_id, carts.cart_key(user_id))
+        old = carts.remove_line(redis_client, user_id, product_id)
+        if not old:
+            return jsonify({'error': f'Product {product_id} is not in cart'}), 404
+        inventory.release(redis_client, user_id, {product_id: old})
+        return jsonify({'message': 'Removed from cart'}), 200
+    except RedisConnectionError as e:
+        logger.error("Redis connection error in delete_cart_item: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in add_to_cart: {str(e)}")
+        logger.error("Error in delete_cart_item: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Оформление заказа
 @app.route('/order', methods=['POST'])
 def create_order():
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         token = request.headers.get('Authorization')
         user_id = check_token(token)
-        logger.info(f'Requested order for user {user_id}')
+        logger.info('Requested order for user %s', user_id)
         if not user_id:
             return jsonify({'error': 'Unauthorized'}), 401
-        cart_key = f'cart:{user_id}'
-        logger.debug(f"Fetching cart from Redis: {cart_key}")
-        cart = redis_client.get(cart_key)
+        logger.debug("Taking cart from Redis: %s", carts.cart_key(user_id))
+        # Чтение и удаление корзины одной атомарной операцией
+        cart = carts.take(redis_client, user_id)
         if not cart:
             return jsonify({'error': 'Cart is empty'}), 400
-        cart = json.loads(cart)
-        order = Order(user_id=user_id, status='Pending')
-        db.session.add(order)
-        logger.debug("Committing new order to database")
-        db.session.commit()
-        for product_id, quantity in cart.items():
-            order_item = OrderItem(order_id=order.id, product_id=int(product_id), quantity=quantity)
-            db.session.add(order_item)
-        logger.debug("Committing order items to database")
-        db.session.commit()
-        redis_client.delete(cart_key)
-        # Store and publish notification for the user
-        notification = json.dumps({
-            'order_id': order.id,
-            'status': 'Pending',
-            'timestamp': int(time.time()),
-            'message': f'Order {order.id} created with status Pending'
-        })
-        logger.debug(f"Storing notification in Redis: notifications:{user_id}")
-        redis_client.lpush(f'notifications:{user_id}', notification)
-        redis_client.ltrim(f'notifications:{user_id}', 0, 99)  # Keep last 100 notifications
-        redis_client.publish(f'user_notifications:{user_id}', notification)
-        redis_client.publish('orders', notification)
+        try:
+            order = Order(user_id=user_id, status='Pending')
+            db.session.add(order)
+            db.session.flush()  # INSERT ... RETURNING id без отдельного коммита
+            # Все позиции одним executemany (psycopg2 склеивает его в многострочный INSERT)
+            db.session.execute(OrderItem.__table__.insert(), [
+                {'order_id': order.id, 'product_id': int(product_id), 'quantity': quantity}
+                for product_id, quantity in cart.items()
+            ])
+            # Уведомление уходит в Redis только вместе с заказом (через outbox)
+            outbox.enqueue(db.session, user_id, {
+                'order_id': order.id,
+                'status': 'Pending',
+                'timestamp': int(time.time()),
+                'message': f'Order {order.id} created with status Pending'
+            })
+            # Списание остатков - последний запрос перед COMMIT, чтобы строки товаров
+            # оставались заблокированными как можно меньше
+            short, changes = inventory.decrement(db.session, cart)
+            if short:
+                db.session.rollback()
+                logger.info("Order rejected for user %s, not enough stock for %s", user_id, short)
+                carts.restore(redis_client, user_id, cart, CART_TTL)
+                return jsonify({'error': 'Not enough stock', 'product_ids': short}), 409
+            logger.debug("Committing order %s with %s items to database", order.id, len(cart))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logger.warning("Order creation failed, restoring cart %s", carts.cart_key(user_id))
+            carts.restore(redis_client, user_id, cart, CART_TTL)
+            raise
+        outbox_dispatcher.notify()
+        try:
+            inventory.release(redis_client, user_id, cart)
+            # Остатки изменились: карточки товаров и страницы "в наличии" пересобираются
+            catalog.products_changed(redis_client, changes, PRODUCT_CACHE_TTL)
+            l1_cache.delete(*(catalog.product_key(new['id']) for _, new in changes))
+        except RedisConnectionError as e:
+            # Заказ уже оформлен; резервы сами истекут по TTL корзины, кэш - по TTL записей
+            logger.warning("Failed to release reservations or refresh cache for order %s: %s", order.id, e)
         return jsonify({'message': 'Order created', 'order_id': order.id}), 201
     except OperationalError as e:
-        logger.error(f"Database error in create_order: {str(e)}")
+        logger.error("Database error in create_order: %s", e)
         return jsonify({'error': 'Database connection error'}), 500
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in create_order: {str(e)}")
+        logger.error("Redis connection error in create_order: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in create_order: {str(e)}")
+        logger.error("Error in create_order: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+# История заказов пользователя, новые первыми; before_id - курсор следующей страницы.
+# Админ может запросить заказы другого пользователя через user_id.
+@app.route('/orders', methods=['GET'])
+def get_orders():
+    try:
+        logger.debug("Received %s request to %s", request.method, request.url)
+        token = request.headers.get('Authorization')
+        user_id = check_token(token)
+        logger.info('Requested orders for user %s', user_id)
+        if not user_id:
+            return jsonify({'error': 'Unauthorized'}), 401
+        try:
+            limit = int(request.args.get('limit', ORDERS_PAGE_LIMIT))
+            if not 1 <= limit <= ORDERS_MAX_PAGE_LIMIT:
+                raise ValueError(f'limit must be between 1 and {ORDERS_MAX_PAGE_LIMIT}')
+            before_id = request.args.get('before_id')
+            before_id = int(before_id) if before_id is not None else None
+            owner_id = request.args.get('user_id')
+            owner_id = int(owner_id) if owner_id is not None else user_id
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if owner_id != user_id and not check_token(token, required_role='admin'):
+            return jsonify({'error': 'Unauthorized or not an admin'}), 401
+        query = orders_with_items().filter(Order.user_id == owner_id)
+        if before_id is not None:
+            query = query.filter(Order.id < before_id)
+        orders = query.order_by(Order.id.desc()).limit(limit).all()
+        return jsonify({
+            'orders': [serialize_order(order) for order in orders],
+            'next': orders[-1].id if len(orders) == limit else None,
+        }), 200
+    except OperationalError as e:
+        logger.error("Database error in get_orders: %s", e)
+        return jsonify({'error': 'Database connection error'}), 500
+    except Exception as e:
+        logger.error("Error in get_orders: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Заказ с позициями (владельцу или админу)
+@app.route('/order/<int:order_id>', methods=['GET'])
+def get_order(order_id):
+    try:
+        logger.debug("Received %s request to %s", request.method, request.url)
+        token = request.headers.get('Authorization')
+        user_id = check_token(token)
+        logger.info('Requested order %s for user %s', order_id, user_id)
+        if not user_id:
+            return jsonify({'error': 'Unauthorized'}), 401
+        order = orders_with_items().filter(Order.id == order_id).one_or_none()
+        if not order or (order.user_id != user_id and not check_token(token, required_role='admin')):
+            return jsonify({'error': 'Order not found'}), 404
+        return jsonify(serialize_order(order)), 200
+    except OperationalError as e:
+        logger.error("Database error in get_order: %s", e)
+        return jsonify({'error': 'Database connection error'}), 500
+    except Exception as e:
+        logger.error("Error in get_order: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Обновление статуса заказа (только для админа)
 @app.route('/order/<int:order_id>/status', methods=['PUT'])
 def update_order_status(order_id):
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         token = request.headers.get('Authorization')
         user_id = check_token(token, required_role='admin')
-        logger.info(f'Requested order status edit for user {user_id}')
+        logger.info('Requested order status edit for user %s', user_id)
         if not user_id:
             return jsonify({'error': 'Unauthorized or not an admin'}), 401
         data = request.get_json()
         new_status = data.get('status')
-        logger.debug(f"Querying database for order {order_id}")
+        logger.debug("Querying database for order %s", order_id)
         order = db.session.get(Order, order_id)
         if not order:
             return jsonify({'error': 'Order not found'}), 404
         order.status = new_status
-        logger.debug(f"Committing updated order status {new_status} for order {order_id}")
-        db.session.commit()
-        # Store and publish notification for the order's user
-        notification = json.dumps({
+        outbox.enqueue(db.session, order.user_id, {
             'order_id': order_id,
             'status': new_status,
             'timestamp': int(time.time()),
             'message': f'Order {order_id} status updated to {new_status}'
         })
-        logger.debug(f"Storing notification in Redis: notifications:{order.user_id}")
-        redis_client.lpush(f'notifications:{order.user_id}', notification)
-        redis_client.ltrim(f'notifications:{order.user_id}', 0, 99)  # Keep last 100 notifications
-        redis_client.publish(f'user_notifications:{order.user_id}', notification)
-        redis_client.publish('orders', notification)
+        logger.debug("Committing updated order status %s for order %s", new_status, order_id)
+        db.session.commit()
+        outbox_dispatcher.notify()
         return jsonify({'message': 'Status updated'}), 200
     except OperationalError as e:
-        logger.error(f"Database error in update_order_status: {str(e)}")
+        logger.error("Database error in update_order_status: %s", e)
         return jsonify({'error': 'Database connection error'}), 500
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in update_order_status: {str(e)}")
+        logger.error("Redis connection error in update_order_status: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in update_order_status: {str(e)}")
+        logger.error("Error in update_order_status: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Массовая смена статусов заказов (только для админа): записи {"order_id", "status"}
+# JSON-массивом или NDJSON; уведомления уходят через outbox
+@app.route('/admin/orders/status/bulk', methods=['POST'])
+def bulk_update_order_status():
+    try:
+        logger.debug("Received %s request to %s", request.method, request.url)
+        token = request.headers.get('Authorization')
+        user_id = check_token(token, required_role='admin')
+        logger.info('Requested bulk order status update for user %s', user_id)
+        if not user_id:
+            return jsonify({'error': 'Unauthorized or not an admin'}), 401
+        records = bulk.iter_records(request.stream, request.mimetype)
+        try:
+            result = bulk.update_order_statuses(db.engine, records, outbox_dispatcher.notify)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        logger.info("Bulk order status update: %s", result)
+        return jsonify(result), 200
+    except OperationalError as e:
+        logger.error("Database error in bulk_update_order_status: %s", e)
+        return jsonify({'error': 'Database connection error'}), 500
+    except Exception as e:
+        logger.error("Error in bulk_update_order_status: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Получение исторических уведомлений
 @app.route('/notifications', methods=['GET'])
 def notifications():
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         token = request.headers.get('Authorization')
         user_id = check_token(token)
-        logger.info(f'Requested notifications for user {user_id}')
+        logger.info('Requested notifications for user %s', user_id)
         if not user_id:
             return jsonify({'error': 'Unauthorized'}), 401
-        notifications_key = f'notifications:{user_id}'
-        logger.debug(f"Fetching notifications from Redis: {notifications_key}")
-        notifications = redis_client.lrange(notifications_key, 0, -1)
-        if not notifications:
-            return jsonify({'notifications': []}), 200
-        notifications = [json.loads(notification) for notification in notifications]
-        return jsonify({'notifications': notifications}), 200
+        try:
+            params = parse_notifications_query(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        # Сначала дешёвая проверка последнего id: без новых уведомлений отвечаем 304
+        etag = notifications_etag(notification_hub.latest_id(redis_client, user_id), params)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        logger.debug("Fetching notifications from Redis: %s", notification_hub.stream_key(user_id))
+        notifications = load_notifications(user_id, params)
+        # Курсор следующей (более старой) страницы для листания назад
+        older = params['since'] is None and params['since_ts'] is None and len(notifications) == params['limit']
+        response = jsonify({'notifications': notifications,
+                            'next': notifications[-1]['id'] if older else None})
+        response.set_etag(etag)
+        return response, 200
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in notifications: {str(e)}")
+        logger.error("Redis connection error in notifications: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in notifications: {str(e)}")
+        logger.error("Error in notifications: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
+# Учёт открытых SSE-стримов; счётчик растёт с началом отдачи потока
+def counted_stream(stream):
+    metrics.SSE_SUBSCRIBERS.inc()
+    try:
+        yield from stream
+    finally:
+        metrics.SSE_SUBSCRIBERS.dec()
+
 # Подписка на уведомления через Pub/Sub
 @app.route('/notifications/sub', methods=['GET'])
 def notifications_sub():
     try:
-        logger.debug(f"Received {request.method} request to {request.url}")
+        logger.debug("Received %s request to %s", request.method, request.url)
         token = request.headers.get('Authorization')
         user_id = check_token(token)
-        logger.info(f'Requested notifications subscription for user {user_id}')
+        logger.info('Requested notifications subscription for user %s', user_id)
         if not user_id:
             return jsonify({'error': 'Unauthorized'}), 401
 
-        def stream():
-            logger.debug(f"Subscribing to user_notifications:{user_id}")
-            pubsub = redis_client.pubsub()
-            pubsub.subscribe(f'user_notifications:{user_id}')
-            timeout = 30
-            start_time = time.time()
-            yield 'data: {"message": "Subscribed to notifications"}\n\n'
-            while time.time() - start_time < timeout:
-                message = pubsub.get_message(timeout=1)
-                if message and message['type'] == 'message':
-                    data = json.loads(message['data'])
-                    logger.debug(f"Received notification: {data}")
-                    yield f'data: {json.dumps(data)}\n\n'
-                time.sleep(0.1)
-            yield 'data: {"message": "Subscription timed out"}\n\n'
-            logger.debug("Closing Pub/Sub subscription")
-            pubsub.close()
-
-        return Response(stream(), mimetype='text/event-stream')
+        last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id')) or None
+        if last_event_id and not notification_hub.is_event_id(last_event_id):
+            return jsonify({'error': 'Invalid Last-Event-ID'}), 400
+        logger.debug("Subscribing user %s to notifications after %s", user_id, last_event_id)
+        stream = counted_stream(notification_hub.stream(hub, redis_client, user_id, last_event_id, SSE_HEARTBEAT,
+                                                         SSE_MAX_DURATION or None))
+        return Response(stream, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
     except RedisConnectionError as e:
-        logger.error(f"Redis connection error in notifications_sub: {str(e)}")
+        logger.error("Redis connection error in notifications_sub: %s", e)
         return jsonify({'error': 'Redis connection error'}), 500
     except Exception as e:
-        logger.error(f"Error in notifications_sub: {str(e)}")
+        logger.error("Error in notifications_sub: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
+# Смена уровня логирования на всех воркерах (только для админа)
+@app.route('/admin/log-level', methods=['PUT'])
+def update_log_level():
+    try:
+        token = request.headers.get('Authorization')
+        user_id = check_token(token, required_role='admin')
+        if not user_id:
+            return jsonify({'error': 'Unauthorized or not an admin'}), 401
+        data = request.get_json()
+        level = str(data.get('level', '')).upper()
+        try:
+            logging_setup.set_level(level)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        redis_client.set(LOG_LEVEL_KEY, level)
+        logger.info('Log level set to %s by user %s', level, user_id)
+        return jsonify({'message': 'Log level updated', 'level': level}), 200
+    except RedisConnectionError as e:
+        logger.error("Redis connection error in update_log_level: %s", e)
+        return jsonify({'error': 'Redis connection error'}), 500
+    except Exception as e:
+        logger.error("Error in update_log_level: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Состояние пулов соединений текущего воркера (для подбора max_connections)
+@app.route('/internal/pools', methods=['GET'])
+def pool_stats():
+    return jsonify({
+        'postgres': pool_metrics.sqlalchemy_pool_stats(db.engine.pool),
+        'redis': pool_metrics.redis_pool_stats(redis_pool),
+    }), 200
+
+# Метрики всех воркеров в формате Prometheus
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    def outbox_gauges():
+        try:
+            stats = outbox.pending_stats(db.engine)
+        except Exception as e:
+            logger.warning("Failed to read outbox stats for metrics: %s", e)
+            return []
+        return [
+            ('shop_outbox_pending', 'Undelivered outbox events', stats['pending']),
+            ('shop_outbox_oldest_age_seconds', 'Age of the oldest undelivered outbox event',
+             stats['oldest_age_seconds']),
+        ]
+    return Response(metrics.render(metrics.CallbackCollector(outbox_gauges)), content_type=metrics.CONTENT_TYPE)
+
+# Очередь outbox и работа диспетчера текущего воркера
+@app.route('/internal/outbox', methods=['GET'])
+def outbox_stats():
+    return jsonify({
+        'pid': os.getpid(),
+        'dispatcher': outbox_dispatcher.stats.snapshot(),
+        **outbox.pending_stats(db.engine),
+    }), 200
+
+# Проверка готовности для балансировщика и k8s
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok'}), 200
+
+# python app.py          - dev-сервер Flask (один процесс);
+# python app.py migrate  - только миграции (вызывается gunicorn.conf.py один раз до старта воркеров).
+# В продакшене приложение запускается через gunicorn, см. gunicorn.conf.py.
 if __name__ == '__main__':
     try:
         logger.debug("Starting application")
         with app.app_context():
             apply_migrations()  # Применяем миграции при старте
+        if sys.argv[1:] == ['migrate']:
+            sys.exit(0)
         logger.info("Application starting on 0.0.0.0:5000")
         app.run(host='0.0.0.0', port=5000)
     except Exception as e:
-        logger.error(f"Failed to start application: {str(e)}")
-        raise
\ No newline at end of file
+        logger.error("Failed to start application: %s", e)
+        raise
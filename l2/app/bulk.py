@@ -0,0 +1,305 @@
+import codecs
+import json
+import logging
+import re
+
+from sqlalchemy import text
+
+logger = logging.getLogger('shop.bulk')
+
+# Массовые изменения для админских API. Записи читаются из тела запроса потоком
+# (JSON-массив или NDJSON), проверяются и через COPY попадают во временную таблицу
+# соединения. Затем изменения применяются порциями по chunk_size различных id:
+# каждая порция - одна транзакция с одним UPDATE ... FROM, после коммита которой
+# вызывается on_chunk (инвалидация кэшей, пробуждение диспетчера outbox). Поэтому
+# память не зависит от размера запроса. Ошибка в данных обнаруживается ещё на этапе
+# COPY, до изменения таблиц; порции, закоммиченные до сбоя БД, остаются применёнными.
+CHUNK_SIZE = 5000
+READ_SIZE = 64 * 1024
+
+NON_SPACE_RE = re.compile(r'\S')
+
+PRODUCTS_STAGING_SQL = text("""
+    CREATE TEMP TABLE bulk_products (seq bigint, id integer, name text, price double precision, stock integer)
+""")
+
+ORDERS_STAGING_SQL = text("""
+    CREATE TEMP TABLE bulk_order_status (seq bigint, order_id integer, status text)
+""")
+
+# Граница очередной порции: последний id и число различных id в ней
+CHUNK_SQL = """
+    SELECT max({key}), count(*) FROM (
+        SELECT DISTINCT {key} FROM {table} WHERE {key} > :after_id ORDER BY {key} LIMIT :limit
+    ) chunk
+"""
+
+# Строки товаров блокируются в порядке id, как при списании остатков в inventory,
+# поэтому пересекающиеся операции не взаимоблокируются. Последняя запись для id побеждает.
+UPDATE_PRODUCTS_SQL = text("""
+    WITH s AS (
+        SELECT DISTINCT ON (id) id, name, price, stock
+        FROM bulk_products
+        WHERE id > :after_id AND id <= :upper_id
+        ORDER BY id, seq DESC
+    ), old AS (
+        SELECT p.id, p.name, p.price, p.stock
+        FROM lab2.products p JOIN s ON s.id = p.id
+        ORDER BY p.id
+        FOR NO KEY UPDATE OF p
+    )
+    UPDATE lab2.products p
+    SET name = COALESCE(s.name, p.name),
+        price = COALESCE(s.price, p.price),
+        stock = COALESCE(s.stock, p.stock)
+    FROM s JOIN old ON old.id = s.id
+    WHERE p.id = s.id
+    RETURNING p.id, old.name AS old_name, old.price AS old_price, old.stock AS old_stock,
+              p.name, p.price, p.stock
+""")
+
+# Смена статуса и уведомление в outbox одним запросом; заказы, статус которых
+# уже совпадает с новым, не трогаются и не порождают уведомлений
+UPDATE_ORDER_STATUS_SQL = text("""
+    WITH s AS (
+        SELECT DISTINCT ON (order_id) order_id, status
+        FROM bulk_order_status
+        WHERE order_id > :after_id AND order_id <= :upper_id
+        ORDER BY order_id, seq DESC
+    ), locked AS (
+        SELECT o.id
+        FROM lab2.orders o JOIN s ON s.order_id = o.id
+        WHERE o.status IS DISTINCT FROM s.status
+        ORDER BY o.id
+        FOR NO KEY UPDATE OF o
+    ), updated AS (
+        UPDATE lab2.orders o
+        SET status = s.status
+        FROM s JOIN locked ON locked.id = s.order_id
+        WHERE o.id = s.order_id
+        RETURNING o.id, o.user_id, o.status
+    )
+    INSERT INTO lab2.outbox (user_id, payload)
+    SELECT user_id, jsonb_build_object(
+        'order_id', id,
+        'status', status,
+        'timestamp', extract(epoch FROM now())::bigint,
+        'message', format('Order %s status updated to %s', id, status)
+    )
+    FROM updated
+""")
+
+
+def _decoded_chunks(stream):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+            return
+        yield decoder.decode(chunk)
+
+
+# Элементы JSON-массива верхнего уровня по одному, без чтения всего тела в память
+def iter_json_array(stream):
+    decoder = json.JSONDecoder()
+    chunks = _decoded_chunks(stream)
+    buffer, pos = '', 0
+    state = 'start'
+    while True:
+        match = NON_SPACE_RE.search(buffer, pos)
+        if match is None:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError('Unexpected end of JSON array')
+            buffer, pos = chunk, 0
+            continue
+        pos = match.start()
+        char = buffer[pos]
+        if state == 'start':
+            if char != '[':
+                raise ValueError('Expected a JSON array')
+            pos, state = pos + 1, 'first'
+        elif char == ']' and state in ('first', 'next'):
+            return
+        elif state == 'next':
+            if char != ',':
+                raise ValueError('Expected , or ] in JSON array')
+            pos, state = pos + 1, 'value'
+        else:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Элемент разрезан границей чтения - дочитываем
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise ValueError('Invalid JSON array')
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+            yield value
+            pos, state = end, 'next'
+            if pos > READ_SIZE:
+                buffer, pos = buffer[pos:], 0
+
+
+def iter_ndjson(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+# Записи тела запроса по Content-Type: NDJSON или JSON-массив
+def iter_records(stream, mimetype):
+    if mimetype in ('application/x-ndjson', 'application/jsonl'):
+        return iter_ndjson(stream)
+    return iter_json_array(stream)
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+# Файлоподобный объект для COPY FROM STDIN: строки формируются по мере чтения.
+# Ошибка разбора записей сохраняется в error и завершает поток.
+class CopyStream:
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = bytearray()
+        self.count = 0
+        self.error = None
+
+    def read(self, size=-1):
+        while self.error is None and (size < 0 or len(self._buffer) < size):
+            try:
+                row = next(self._rows, None)
+            except ValueError as e:
+                self.error = e
+                return b''
+            if row is None:
+                break
+            self._buffer += ('\t'.join(_copy_value(value) for value in row) + '\n').encode()
+            self.count += 1
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _product_row(seq, record):
+    if not isinstance(record, dict) or not isinstance(record.get('id'), int) or isinstance(record['id'], bool):
+        raise ValueError(f'Record {seq}: integer id is required')
+    name, price, stock = record.get('name'), record.get('price'), record.get('stock')
+    if name is None and price is None and stock is None:
+        raise ValueError(f'Record {seq}: nothing to update')
+    if name is not None and (not isinstance(name, str) or not name or len(name) > 100):
+        raise ValueError(f'Record {seq}: invalid name')
+    if price is not None and (not _is_number(price) or price <= 0):
+        raise ValueError(f'Record {seq}: invalid price')
+    if stock is not None and (not isinstance(stock, int) or isinstance(stock, bool) or stock < 0):
+        raise ValueError(f'Record {seq}: invalid stock')
+    return seq, record['id'], name, price, stock
+
+
+def _order_status_row(seq, record):
+    if not isinstance(record, dict) or not isinstance(record.get('order_id'), int) \
+            or isinstance(record['order_id'], bool):
+        raise ValueError(f'Record {seq}: integer order_id is required')
+    status = record.get('status')
+    if not isinstance(status, str) or not status or len(status) > 50:
+        raise ValueError(f'Record {seq}: invalid status')
+    return seq, record['order_id'], status
+
+
+def _stage(connection, create_sql, table, columns, rows):
+    with connection.begin():
+        # Временная таблица живёт дольше одной транзакции (порции коммитятся по
+        # отдельности), поэтому ON COMMIT DROP не подходит
+        connection.execute(text(f'DROP TABLE IF EXISTS {table}'))
+        connection.execute(create_sql)
+        stream = CopyStream(rows)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", stream)
+        if stream.error is not None:
+            raise stream.error
+        connection.execute(text(f'CREATE INDEX ON {table} ({columns[1]}, seq DESC)'))
+        connection.execute(text(f'ANALYZE {table}'))
+    return stream.count
+
+
+# Порции различных ключей временной таблицы: (after_id, upper_id, count)
+def _chunks(connection, table, key, chunk_size):
+    chunk_sql = text(CHUNK_SQL.format(key=key, table=table))
+    after_id = -1
+    while True:
+        upper_id, count = connection.execute(chunk_sql, {'after_id': after_id, 'limit': chunk_size}).one()
+        if not count:
+            return
+        yield after_id, upper_id, count
+        after_id = upper_id
+
+
+def _drop(connection, table):
+    try:
+        connection.execute(text(f'DROP TABLE IF EXISTS {table}'))
+    except Exception as e:
+        # Соединение с оставшейся временной таблицей не возвращается в пул:
+        # пул закроет его вместо выдачи следующему запросу
+        logger.warning("Failed to drop staging table %s, discarding connection: %s", table, e)
+        connection.invalidate()
+
+
+# Обновление товаров; on_chunk([(old, new), ...]) вызывается после коммита каждой порции
+def update_products(engine, records, on_chunk, chunk_size=CHUNK_SIZE):
+    rows = (_product_row(seq, record) for seq, record in enumerate(records, 1))
+    result = {'received': 0, 'updated': 0, 'missing': 0}
+    with engine.connect() as connection:
+        try:
+            result['received'] = _stage(connection, PRODUCTS_STAGING_SQL, 'bulk_products',
+                                        ['seq', 'id', 'name', 'price', 'stock'], rows)
+            for after_id, upper_id, count in _chunks(connection, 'bulk_products', 'id', chunk_size):
+                with connection.begin():
+                    changed = connection.execute(UPDATE_PRODUCTS_SQL,
+                                                 {'after_id': after_id, 'upper_id': upper_id}).fetchall()
+                changes = [
+                    ({'id': row.id, 'name': row.old_name, 'price': row.old_price, 'stock': row.old_stock},
+                     {'id': row.id, 'name': row.name, 'price': row.price, 'stock': row.stock})
+                    for row in changed
+                ]
+                if changes:
+                    on_chunk(changes)
+                result['updated'] += len(changes)
+                result['missing'] += count - len(changes)
+        finally:
+            _drop(connection, 'bulk_products')
+    return result
+
+
+# Смена статусов заказов с уведомлениями через outbox; on_chunk() вызывается после коммита порции
+def update_order_statuses(engine, records, on_chunk, chunk_size=CHUNK_SIZE):
+    rows = (_order_status_row(seq, record) for seq, record in enumerate(records, 1))
+    result = {'received': 0, 'updated': 0, 'skipped': 0}
+    with engine.connect() as connection:
+        try:
+            result['received'] = _stage(connection, ORDERS_STAGING_SQL, 'bulk_order_status',
+                                        ['seq', 'order_id', 'status'], rows)
+            for after_id, upper_id, count in _chunks(connection, 'bulk_order_status', 'order_id', chunk_size):
+                with connection.begin():
+                    updated = connection.execute(UPDATE_ORDER_STATUS_SQL,
+                                                 {'after_id': after_id, 'upper_id': upper_id}).rowcount
+                if updated:
+                    on_chunk()
+                result['updated'] += updated
+                result['skipped'] += count - updated
+        finally:
+            _drop(connection, 'bulk_order_status')
+    return result
@@ -0,0 +1,86 @@
+import json
+import math
+import random
+import time
+import uuid
+
+# Кэш с защитой от "давки" при истечении TTL.
+# Значение хранится в конверте {"v": значение, "exp": логический срок, "delta": время пересчёта}.
+# Физический TTL ключа длиннее логического на STALE_TTL: пока один воркер
+# пересчитывает значение под блокировкой, остальные отдают устаревшее.
+# Пересчёт начинается заранее с вероятностью, растущей к концу срока (XFetch),
+# поэтому у горячих ключей до истечения TTL обычно не доходит.
+# Отсутствие значения (loader вернул None) кэшируется на NEGATIVE_TTL.
+STALE_TTL = 60          # Сколько секунд после логического срока можно отдавать старое значение
+NEGATIVE_TTL = 30       # Время жизни отрицательного результата (например, 404), секунд
+LOCK_TIMEOUT = 5        # Максимальное время владения блокировкой пересчёта, секунд
+WAIT_TIMEOUT = 1.0      # Сколько ждать чужого пересчёта при полном промахе, секунд
+WAIT_STEP = 0.05
+BETA = 1.0              # Агрессивность раннего пересчёта
+
+HIT = 'hit'
+STALE = 'stale'
+MISS = 'miss'
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def lock_key(key):
+    return f'lock:{key}'
+
+
+def encode(value, ttl, delta=0.0):
+    return json.dumps({'v': value, 'exp': time.time() + ttl, 'delta': delta})
+
+
+def decode(raw):
+    return json.loads(raw) if raw is not None else None
+
+
+# Запись значения в конверте; client может быть и pipeline
+def store(client, key, value, ttl, delta=0.0, nx=False):
+    if value is None:
+        client.set(key, encode(None, NEGATIVE_TTL, delta), ex=NEGATIVE_TTL, nx=nx)
+    else:
+        client.set(key, encode(value, ttl, delta), ex=ttl + STALE_TTL, nx=nx)
+
+
+def _should_refresh(entry, now):
+    # XFetch: -delta * beta * ln(rand) - случайный сдвиг "сейчас" вперёд
+    return now - entry['delta'] * BETA * math.log(1.0 - random.random()) >= entry['exp']
+
+
+def _rebuild(redis_client, key, ttl, loader):
+    start = time.time()
+    value = loader()
+    store(redis_client, key, value, ttl, delta=time.time() - start)
+    return value
+
+
+# Значение по ключу; loader() вызывается не более чем одним воркером одновременно.
+# Возвращает (значение, статус), где статус - HIT, STALE или MISS.
+def fetch(redis_client, key, ttl, loader):
+    entry = decode(redis_client.get(key))
+    if entry is not None and not _should_refresh(entry, time.time()):
+        return entry['v'], HIT
+    token = uuid.uuid4().hex
+    if redis_client.set(lock_key(key), token, nx=True, ex=LOCK_TIMEOUT):
+        try:
+            return _rebuild(redis_client, key, ttl, loader), MISS
+        finally:
+            redis_client.register_script(RELEASE_SCRIPT)(keys=[lock_key(key)], args=[token])
+    if entry is not None:
+        return entry['v'], STALE
+    # Значения нет совсем: ждём, пока его построит владелец блокировки
+    deadline = time.time() + WAIT_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(WAIT_STEP)
+        entry = decode(redis_client.get(key))
+        if entry is not None:
+            return entry['v'], HIT
+    return _rebuild(redis_client, key, ttl, loader), MISS
@@ -0,0 +1,107 @@
+from redis.exceptions import ResponseError
+
+# Корзина хранится в hash cart:{user_id} (product_id -> quantity), чтобы менять
+# одну позицию одной командой без чтения и перезаписи всей корзины.
+# Старые корзины лежат JSON-строкой; они переводятся в hash при первом обращении.
+MIGRATE_LUA = """
+if redis.call('TYPE', KEYS[1])['ok'] == 'string' then
+    local legacy = cjson.decode(redis.call('GET', KEYS[1]))
+    local ttl = redis.call('TTL', KEYS[1])
+    redis.call('DEL', KEYS[1])
+    for product_id, quantity in pairs(legacy) do
+        redis.call('HSET', KEYS[1], product_id, quantity)
+    end
+    if ttl > 0 then
+        redis.call('EXPIRE', KEYS[1], ttl)
+    end
+end
+"""
+
+MIGRATE_SCRIPT = MIGRATE_LUA + "return 1"
+
+# Атомарно забрать корзину целиком (оформление заказа, очистка)
+TAKE_SCRIPT = MIGRATE_LUA + """
+local cart = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return cart
+"""
+
+
+def cart_key(user_id):
+    return f'cart:{user_id}'
+
+
+def _decode(raw):
+    return {key.decode(): int(value) for key, value in raw.items()}
+
+
+# Выполнение операции с переводом старой JSON-корзины в hash при WRONGTYPE
+def _run(redis_client, key, operation):
+    try:
+        return operation()
+    except ResponseError as e:
+        if not str(e).startswith('WRONGTYPE'):
+            raise
+    redis_client.register_script(MIGRATE_SCRIPT)(keys=[key])
+    return operation()
+
+
+def _execute(redis_client, key, *commands):
+    def operation():
+        pipe = redis_client.pipeline(transaction=True)
+        for name, *args in commands:
+            getattr(pipe, name)(*args)
+        return pipe.execute()
+    return _run(redis_client, key, operation)
+
+
+# Содержимое корзины {product_id: quantity}
+def get(redis_client, user_id):
+    key = cart_key(user_id)
+    return _decode(_run(redis_client, key, lambda: redis_client.hgetall(key)))
+
+
+# Увеличение количества товара; возвращает новое количество
+def add(redis_client, user_id, product_id, quantity, ttl):
+    key = cart_key(user_id)
+    total, _ = _execute(redis_client, key,
+                        ('hincrby', key, str(product_id), quantity),
+                        ('expire', key, ttl))
+    return total
+
+
+# Установка количества товара; возвращает прежнее количество
+def set_line(redis_client, user_id, product_id, quantity, ttl):
+    key = cart_key(user_id)
+    old, _, _ = _execute(redis_client, key,
+                         ('hget', key, str(product_id)),
+                         ('hset', key, str(product_id), quantity),
+                         ('expire', key, ttl))
+    return int(old or 0)
+
+
+# Удаление позиции; возвращает удалённое количество
+def remove_line(redis_client, user_id, product_id):
+    key = cart_key(user_id)
+    old, _ = _execute(redis_client, key,
+                      ('hget', key, str(product_id)),
+                      ('hdel', key, str(product_id)))
+    return int(old or 0)
+
+
+# Атомарно забрать и удалить корзину
+def take(redis_client, user_id):
+    flat = redis_client.register_script(TAKE_SCRIPT)(keys=[cart_key(user_id)])
+    return {flat[i].decode(): int(flat[i + 1]) for i in range(0, len(flat), 2)}
+
+
+# Вернуть позиции в корзину (например, если заказ не удалось сохранить)
+def restore(redis_client, user_id, cart, ttl):
+    if not cart:
+        return
+    key = cart_key(user_id)
+    pipe = redis_client.pipeline(transaction=True)
+    for product_id, quantity in cart.items():
+        pipe.hincrby(key, str(product_id), quantity)
+    pipe.expire(key, ttl)
+    pipe.execute()
@@ -0,0 +1,124 @@
+import json
+
+import cache
+import local_cache
+
+# Кэш каталога из двух уровней:
+#   product:{id} - данные одного товара (общие с GET /products/<id>);
+#   products:page:... - только список id страницы и курсор следующей страницы.
+# Ключ страницы включает версии "измерений", от которых зависит её состав:
+# id (появление/удаление товаров), поле сортировки и поля фильтров. Изменение
+# товара увеличивает версии только затронутых измерений и переписывает его
+# product:{id}; страницы старых версий никто больше не читает, и они истекают по TTL.
+# Все записи хранятся в конверте модуля cache; страницы перестраиваются через cache.fetch.
+VERSION_KEY = 'catalog:version:{}'
+
+
+def product_key(product_id):
+    return f'product:{product_id}'
+
+
+def version_key(dimension):
+    return VERSION_KEY.format(dimension)
+
+
+def serialize_product(product):
+    return {'id': product.id, 'name': product.name, 'price': product.price, 'stock': product.stock}
+
+
+# Измерения, от которых зависит состав страницы с данными параметрами
+def page_dimensions(params):
+    dimensions = {'id', params['sort']}
+    if params['min_price'] is not None or params['max_price'] is not None:
+        dimensions.add('price')
+    if params['in_stock']:
+        dimensions.add('stock')
+    if params['q'] is not None:
+        dimensions.add('name')
+    return sorted(dimensions)
+
+
+def page_key(dimensions, versions, params):
+    version = '.'.join(f'{dimension}{int(value or 0)}' for dimension, value in zip(dimensions, versions))
+    return f'products:page:{version}:' + json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+
+def _cache_products(redis_client, products, ttl):
+    # nx: не затираем более свежие данные, записанные product_changed
+    pipe = redis_client.pipeline(transaction=False)
+    for product in products:
+        cache.store(pipe, product_key(product['id']), product, ttl, nx=True)
+    pipe.execute()
+
+
+# Страница каталога из кэша; load_page(params) и load_products(ids) читают БД.
+# Возвращает (страница, статус cache.fetch).
+def get_page(redis_client, params, load_page, load_products, ttl):
+    dimensions = page_dimensions(params)
+    versions = redis_client.mget([version_key(dimension) for dimension in dimensions])
+    key = page_key(dimensions, versions, params)
+    built = {}
+
+    def build():
+        page = built['page'] = load_page(params)
+        _cache_products(redis_client, page['products'], ttl)
+        return {'ids': [product['id'] for product in page['products']], 'next': page['next']}
+
+    cached, status = cache.fetch(redis_client, key, ttl, build)
+    if 'page' in built:
+        return built['page'], status
+    ids = cached['ids']
+    entries = redis_client.mget([product_key(product_id) for product_id in ids]) if ids else []
+    products = {}
+    missing = []
+    for product_id, entry in zip(ids, entries):
+        entry = cache.decode(entry)
+        if entry is None:
+            missing.append(product_id)
+        elif entry['v'] is not None:
+            products[product_id] = entry['v']
+    if missing:
+        loaded = load_products(missing)
+        _cache_products(redis_client, loaded, ttl)
+        products.update((product['id'], product) for product in loaded)
+    # Удалённые товары пропадают со страницы до её перестроения
+    page = {'products': [products[product_id] for product_id in ids if product_id in products],
+            'next': cached['next']}
+    return page, status
+
+
+# Измерения, версии которых меняет изменение товара old -> new
+def changed_dimensions(old, new):
+    if old is None or new is None:
+        return ['id']
+    dimensions = []
+    if old['price'] != new['price']:
+        dimensions.append('price')
+    if old['name'] != new['name']:
+        dimensions.append('name')
+    if (old['stock'] > 0) != (new['stock'] > 0):
+        dimensions.append('stock')
+    return dimensions
+
+
+# Обновление кэша после изменения товара; old/new - словари serialize_product или None
+def product_changed(redis_client, old, new, ttl):
+    return products_changed(redis_client, [(old, new)], ttl)
+
+
+# То же для пачки изменений [(old, new), ...] одной транзакцией Redis: каждая версия
+# увеличивается один раз, а воркеры получают одно сообщение об инвалидации
+def products_changed(redis_client, changes, ttl):
+    dimensions = sorted({dimension for old, new in changes for dimension in changed_dimensions(old, new)})
+    keys = []
+    pipe = redis_client.pipeline(transaction=True)
+    for dimension in dimensions:
+        pipe.incr(version_key(dimension))
+    for old, new in changes:
+        key = product_key((new or old)['id'])
+        # Для удалённого товара сразу кладём отрицательную запись
+        cache.store(pipe, key, new, ttl)
+        keys.append(key)
+    local_cache.publish_invalidation(pipe, *keys)
+    pipe.execute()
+    return dimensions
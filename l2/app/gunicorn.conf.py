@@ -0,0 +1,60 @@
+# Конфигурация gunicorn для продакшен-запуска: gunicorn -c gunicorn.conf.py app:app
+#
+# WEB_WORKER_CLASS=gevent (по умолчанию) - зелёные потоки, дешёвые долгие SSE-стримы /notifications/sub;
+# WEB_WORKER_CLASS=gthread - пул потоков в каждом воркере, стримы ограничены по времени.
+import os
+import shutil
+import subprocess
+import sys
+
+bind = f"0.0.0.0:{os.environ.get('WEB_PORT', '5000')}"
+workers = int(os.environ.get('WEB_WORKERS', '2'))
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gevent')
+threads = int(os.environ.get('WEB_THREADS', '8'))
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', '1000'))
+timeout = int(os.environ.get('WEB_TIMEOUT', '60'))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', '5'))
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', '0'))
+# Приложение импортируется в каждом воркере после fork: пулы соединений
+# и фоновые потоки не разделяются между процессами, а gevent успевает пропатчить сокеты
+preload_app = False
+accesslog = '-' if os.environ.get('WEB_ACCESS_LOG', 'false').lower() == 'true' else None
+
+# Каталог, через который воркеры делятся метриками Prometheus (см. metrics.py);
+# задаётся до fork, чтобы воркеры унаследовали переменную
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/shop-metrics')
+# Под gthread каждый SSE-стрим держит поток воркера: без предела длительности
+# WEB_WORKERS * WEB_THREADS открытых вкладок заняли бы все потоки
+if worker_class != 'gevent':
+    os.environ.setdefault('SSE_MAX_DURATION', '300')
+
+
+# Миграции выполняются один раз в мастер-процессе до открытия сокета,
+# отдельным процессом, чтобы мастер не импортировал приложение до fork
+def on_starting(server):
+    # Значения прошлого запуска не должны попасть в сумму
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+    if os.environ.get('RUN_MIGRATIONS', 'true').lower() != 'true':
+        server.log.info("Skipping migrations (RUN_MIGRATIONS is not true)")
+        return
+    server.log.info("Applying migrations before starting workers")
+    subprocess.run([sys.executable, 'app.py', 'migrate'], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 должен уступать управление другим гринлетам во время запросов к БД
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def child_exit(server, worker):
+    # Gauge-метрики завершившегося воркера больше не учитываются
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,111 @@
+from sqlalchemy import text
+
+# Мягкий резерв остатка в Redis для корзин, которые ещё не оформлены.
+# Резерв хранится отдельно для каждой корзины: hash reservations:{product_id}
+# (user_id -> quantity) и zset reservations:{product_id}:expiry (user_id -> момент
+# истечения в мс). Занятым считается только количество живых резервов; резервы
+# брошенных корзин вычищаются при следующем резервировании товара, поэтому чужая
+# активность не продлевает их. Источник истины - products.stock в Postgres,
+# резерв лишь не даёт положить в корзины больше, чем есть на складе.
+EXPIRE_LUA = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+for _, user_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+    redis.call('HDEL', KEYS[1], user_id)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+"""
+
+RESERVE_SCRIPT = EXPIRE_LUA + """
+local reserved = 0
+for _, quantity in ipairs(redis.call('HVALS', KEYS[1])) do
+    reserved = reserved + tonumber(quantity)
+end
+local quantity = tonumber(ARGV[2])
+if reserved + quantity > tonumber(ARGV[3]) then
+    return -1
+end
+local ttl = tonumber(ARGV[4]) * 1000
+redis.call('HINCRBY', KEYS[1], ARGV[1], quantity)
+redis.call('ZADD', KEYS[2], now + ttl, ARGV[1])
+-- Ключи товара живут, пока жив самый поздний резерв
+redis.call('PEXPIRE', KEYS[1], ttl)
+redis.call('PEXPIRE', KEYS[2], ttl)
+return reserved + quantity
+"""
+
+RELEASE_SCRIPT = """
+for i = 1, #KEYS, 2 do
+    local quantity = tonumber(ARGV[(i + 1) / 2 + 1])
+    if redis.call('HEXISTS', KEYS[i], ARGV[1]) == 1 then
+        if redis.call('HINCRBY', KEYS[i], ARGV[1], -quantity) <= 0 then
+            redis.call('HDEL', KEYS[i], ARGV[1])
+            redis.call('ZREM', KEYS[i + 1], ARGV[1])
+        end
+    end
+end
+return #KEYS / 2
+"""
+
+# Списание остатков всей корзины одним запросом.
+# Строки блокируются в порядке id (FOR NO KEY UPDATE не конфликтует с FK-проверками
+# order_items), поэтому параллельные заказы не ловят дедлоки, а блокировка горячей
+# строки держится только до COMMIT, который вызывающий делает сразу после запроса.
+# Непустое количество проверяется и здесь: отрицательная позиция увеличила бы остаток.
+# Старый и новый остаток возвращаются для обновления кэша каталога.
+DECREMENT_SQL = text("""
+    WITH wanted AS (
+        SELECT * FROM unnest(CAST(:product_ids AS integer[]), CAST(:quantities AS integer[]))
+            AS w(id, quantity)
+    ), locked AS (
+        SELECT p.id, p.stock, w.quantity
+        FROM lab2.products p
+        JOIN wanted w ON w.id = p.id
+        WHERE w.quantity > 0 AND p.stock >= w.quantity
+        ORDER BY p.id
+        FOR NO KEY UPDATE OF p
+    )
+    UPDATE lab2.products AS p
+    SET stock = p.stock - locked.quantity
+    FROM locked
+    WHERE p.id = locked.id
+    RETURNING p.id, p.name, p.price, locked.stock AS old_stock, p.stock
+""")
+
+
+def reservation_keys(product_id):
+    key = f'reservations:{product_id}'
+    return [key, f'{key}:expiry']
+
+
+# Резервирование количества товара за корзиной пользователя; False, если свободного
+# остатка не хватает. Резерв корзины истекает через ttl после последнего изменения.
+def reserve(redis_client, product_id, user_id, quantity, stock, ttl):
+    script = redis_client.register_script(RESERVE_SCRIPT)
+    return script(keys=reservation_keys(product_id), args=[user_id, quantity, stock, ttl]) >= 0
+
+
+# Снятие резерва корзины пользователя для позиций {product_id: quantity}
+def release(redis_client, user_id, cart):
+    if not cart:
+        return
+    script = redis_client.register_script(RELEASE_SCRIPT)
+    keys = [key for product_id in cart for key in reservation_keys(product_id)]
+    script(keys=keys, args=[user_id] + [int(quantity) for quantity in cart.values()])
+
+
+# Списание остатков по корзине; возвращает id товаров, которых не хватило, и изменения
+# [(old, new), ...] в формате catalog.serialize_product для catalog.products_changed.
+# При непустом первом списке вызывающий обязан откатить транзакцию.
+def decrement(session, cart):
+    lines = {int(product_id): int(quantity) for product_id, quantity in cart.items()}
+    product_ids = sorted(lines)
+    quantities = [lines[product_id] for product_id in product_ids]
+    rows = session.execute(DECREMENT_SQL, {'product_ids': product_ids, 'quantities': quantities}).fetchall()
+    changes = [
+        ({'id': row.id, 'name': row.name, 'price': row.price, 'stock': row.old_stock},
+         {'id': row.id, 'name': row.name, 'price': row.price, 'stock': row.stock})
+        for row in rows
+    ]
+    updated = {row.id for row in rows}
+    return [product_id for product_id in product_ids if product_id not in updated], changes
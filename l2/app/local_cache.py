@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger('shop.local_cache')
+
+# Канал, через который поды сообщают друг другу об изменённых ключах
+INVALIDATION_CHANNEL = 'cache_invalidation'
+
+MISSING = object()
+
+
+# Кэш в памяти воркера (LRU с ограниченным размером и коротким TTL)
+# перед Redis. С max_size=0 кэш выключен: get всегда промахивается.
+class LocalCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._listener = None
+        self._listener_pid = None
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        if not self.enabled:
+            return MISSING
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return MISSING
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return MISSING
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + (ttl or self.ttl))
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    # Запуск подписки на инвалидацию; вызывается в каждом процессе (после fork)
+    def start_listener(self, redis_client):
+        if not self.enabled or self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            self._items.clear()
+            self._listener = threading.Thread(target=self._listen, args=(redis_client,),
+                                              name='local-cache-invalidation', daemon=True)
+            self._listener.start()
+
+    def _listen(self, redis_client):
+        backoff = 0.5
+        while True:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                backoff = 0.5
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message['type'] == 'message':
+                        self.delete(*json.loads(message['data']))
+            except RedisError as e:
+                # Пока подписки не было, сообщения могли потеряться
+                logger.warning("Cache invalidation subscription lost: %s", e)
+                self.clear()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+            finally:
+                pubsub.close()
+
+
+# Сообщить всем воркерам об изменении ключей; client может быть и pipeline
+def publish_invalidation(client, *keys):
+    client.publish(INVALIDATION_CHANNEL, json.dumps(keys))
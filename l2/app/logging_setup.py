@@ -0,0 +1,111 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+# Логирование без ввода-вывода в потоке запроса: обработчик только кладёт запись
+# во внутрипроцессную очередь, а форматирование и запись в консоль и файл
+# выполняет фоновый QueueListener.
+LOGGER_NAME = 'shop'
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - [%(name)s] - %(message)s'
+
+
+# Структурированный вывод: одна JSON-строка на запись
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload['exc'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+# Пропускает только долю DEBUG-записей; остальные уровни всегда проходят
+class DebugSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+# QueueHandler без полного форматирования в потоке запроса. В потоке запроса
+# фиксируются только текст сообщения и traceback: аргументы могут измениться, пока
+# запись ждёт в очереди, а exc_info держит кадры стека живыми. Время, JSON и
+# уровень форматирует слушатель.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    _exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_level(level):
+    value = logging.getLevelName(str(level).upper())
+    if not isinstance(value, int):
+        raise ValueError(f'Unknown log level {level}')
+    return value
+
+
+# Настройка логгера приложения; возвращает запущенный QueueListener
+def setup_logging(log_dir, level='INFO', fmt='json', debug_sample_rate=1.0):
+    formatter = JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT)
+
+    # Console handler (for kubectl logs)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+    handlers = [console_handler]
+
+    # File handler with rotation
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            os.path.join(log_dir, 'app.log'),
+            maxBytes=10*1024*1024,  # 10MB per file
+            backupCount=5  # Keep 5 backup files
+        )
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(debug_sample_rate))
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(parse_level(level))
+    logger.handlers = [queue_handler]
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+# Смена уровня логирования без перезапуска
+def set_level(level):
+    logging.getLogger(LOGGER_NAME).setLevel(parse_level(level))
+
+
+def get_level():
+    return logging.getLevelName(logging.getLogger(LOGGER_NAME).level)
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from redis import Redis
+from redis.client import Pipeline
+
+# Метрики в формате Prometheus. Под gunicorn каждый воркер пишет значения в файлы
+# каталога PROMETHEUS_MULTIPROC_DIR (его задаёт gunicorn.conf.py), и /metrics любого
+# воркера отдаёт сумму по всем процессам; без него метрики хранятся в памяти процесса.
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CALL_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+REQUEST_LATENCY = Histogram('shop_http_request_duration_seconds', 'Request latency by route',
+                            ['route', 'method'], buckets=LATENCY_BUCKETS)
+REQUESTS = Counter('shop_http_requests_total', 'Requests by route and status code',
+                   ['route', 'method', 'status'])
+IN_FLIGHT = Gauge('shop_http_requests_in_flight', 'Requests being processed', multiprocess_mode='livesum')
+
+REDIS_COMMANDS = Histogram('shop_redis_command_duration_seconds', 'Redis command and pipeline round trips',
+                           ['command'], buckets=LATENCY_BUCKETS)
+DB_QUERIES = Histogram('shop_db_query_duration_seconds', 'Postgres statements', buckets=LATENCY_BUCKETS)
+REQUEST_REDIS_CALLS = Histogram('shop_request_redis_calls', 'Redis round trips per request',
+                                ['route'], buckets=CALL_BUCKETS)
+REQUEST_REDIS_SECONDS = Histogram('shop_request_redis_seconds', 'Time in Redis per request',
+                                  ['route'], buckets=LATENCY_BUCKETS)
+REQUEST_DB_CALLS = Histogram('shop_request_db_calls', 'Postgres statements per request',
+                             ['route'], buckets=CALL_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('shop_request_db_seconds', 'Time in Postgres per request',
+                               ['route'], buckets=LATENCY_BUCKETS)
+
+CACHE_REQUESTS = Counter('shop_cache_requests_total', 'Cache lookups by cache, layer and result',
+                         ['cache', 'layer', 'result'])
+SSE_SUBSCRIBERS = Gauge('shop_sse_subscribers', 'Open /notifications/sub streams', multiprocess_mode='livesum')
+
+POOL_CHECKED_OUT = Gauge('shop_pool_connections_in_use', 'Connections checked out of the pool',
+                         ['pool'], multiprocess_mode='livesum')
+POOL_SIZE = Gauge('shop_pool_connections_open', 'Connections opened by the pool',
+                  ['pool'], multiprocess_mode='livesum')
+POOL_WAIT = Gauge('shop_pool_wait_seconds', 'Cumulative time spent waiting for a pool connection',
+                  ['pool'], multiprocess_mode='livesum')
+
+OUTBOX_EVENTS = Counter('shop_outbox_events_total', 'Outbox events handled by dispatchers', ['result'])
+OUTBOX_BATCH_SIZE = Histogram('shop_outbox_batch_size', 'Rows per outbox dispatch batch', buckets=BATCH_BUCKETS)
+OUTBOX_LAG = Histogram('shop_outbox_lag_seconds', 'Age of the oldest event in a dispatched batch',
+                       buckets=LATENCY_BUCKETS + (30, 60, 300))
+
+# Счётчики обращений к Redis и Postgres текущего запроса (поток или гринлет)
+_calls = threading.local()
+
+
+def start_request():
+    _calls.redis = _calls.redis_seconds = _calls.db = _calls.db_seconds = 0
+    IN_FLIGHT.inc()
+
+
+def finish_request(route, method, status, duration):
+    REQUEST_LATENCY.labels(route, method).observe(duration)
+    REQUESTS.labels(route, method, str(status)).inc()
+    REQUEST_REDIS_CALLS.labels(route).observe(getattr(_calls, 'redis', 0))
+    REQUEST_REDIS_SECONDS.labels(route).observe(getattr(_calls, 'redis_seconds', 0))
+    REQUEST_DB_CALLS.labels(route).observe(getattr(_calls, 'db', 0))
+    REQUEST_DB_SECONDS.labels(route).observe(getattr(_calls, 'db_seconds', 0))
+
+
+def end_request():
+    IN_FLIGHT.dec()
+
+
+def _record_redis(command, seconds):
+    REDIS_COMMANDS.labels(command).observe(seconds)
+    _calls.redis = getattr(_calls, 'redis', 0) + 1
+    _calls.redis_seconds = getattr(_calls, 'redis_seconds', 0) + seconds
+
+
+def record_db(seconds):
+    DB_QUERIES.observe(seconds)
+    _calls.db = getattr(_calls, 'db', 0) + 1
+    _calls.db_seconds = getattr(_calls, 'db_seconds', 0) + seconds
+
+
+def cache_result(cache, layer, result):
+    CACHE_REQUESTS.labels(cache, layer, result).inc()
+
+
+# Перехват выполнения запросов SQLAlchemy (подключается к engine через event.listen)
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record_db(time.perf_counter() - conn.info['query_start'].pop())
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            _record_redis('PIPELINE', time.perf_counter() - start)
+
+
+# Клиент Redis, замеряющий каждую команду и каждый pipeline как один round trip
+class InstrumentedRedis(Redis):
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            _record_redis(str(args[0]).upper(), time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+# Состояние пулов воркера: словари pool_metrics.sqlalchemy_pool_stats / redis_pool_stats
+def observe_pools(postgres, redis):
+    POOL_CHECKED_OUT.labels('postgres').set(postgres['checked_out'])
+    POOL_SIZE.labels('postgres').set(postgres['checked_out'] + postgres['checked_in'])
+    POOL_WAIT.labels('postgres').set(postgres['wait_seconds_total'])
+    POOL_CHECKED_OUT.labels('redis').set(redis['in_use'])
+    POOL_SIZE.labels('redis').set(redis['created'])
+    POOL_WAIT.labels('redis').set(redis['wait_seconds_total'])
+
+
+def observe_outbox_batch(size, sent, lag):
+    OUTBOX_EVENTS.labels('sent').inc(sent)
+    OUTBOX_EVENTS.labels('failed').inc(size - sent)
+    OUTBOX_BATCH_SIZE.observe(size)
+    OUTBOX_LAG.observe(lag)
+
+
+# Gauge-метрики, вычисляемые при каждом запросе /metrics: fn() -> [(name, doc, value), ...]
+class CallbackCollector:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def collect(self):
+        for name, documentation, value in self.fn():
+            yield GaugeMetricFamily(name, documentation, value=value)
+
+
+# Текст для /metrics; collectors - дополнительные коллекторы, вычисляемые при запросе
+def render(*collectors):
+    registry = CollectorRegistry()
+    if MULTIPROCESS:
+        multiprocess.MultiProcessCollector(registry)
+    for collector in collectors:
+        registry.register(collector)
+    output = generate_latest(registry)
+    if not MULTIPROCESS:
+        output = generate_latest(REGISTRY) + output
+    return output
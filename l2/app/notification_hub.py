@@ -0,0 +1,239 @@
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+import msgpack
+from redis.exceptions import RedisError
+
+logger = logging.getLogger('shop.notifications')
+
+CHANNEL_PATTERN = 'user_notifications:*'
+ORDERS_STREAM = 'orders:events'  # Общий поток событий заказов для обработчиков (consumer groups)
+HISTORY_SIZE = 100               # Примерная длина потока уведомлений пользователя (MAXLEN ~)
+ORDERS_STREAM_SIZE = 100000      # Примерная длина общего потока заказов (MAXLEN ~)
+QUEUE_SIZE = 100                 # Очередь одного подписчика; при переполнении он догоняет по истории
+
+# Уведомление пишется в поток пользователя и в общий поток заказов; id записи потока
+# пользователя становится id уведомления и рассылается подписчикам как "<id>\n<данные>".
+# Данные хранятся в msgpack (компактнее JSON и быстрее разбираются).
+# Всё выполняется атомарно за один запрос к Redis.
+EVENT_ID_RE = re.compile(r'\d+-\d+')
+
+PUBLISH_SCRIPT = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], '*', 'data', ARGV[1])
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], '*', 'user_id', ARGV[4], 'event_id', id, 'data', ARGV[1])
+redis.call('PUBLISH', KEYS[3], id .. '\\n' .. ARGV[1])
+return id
+"""
+
+# Маркер для подписчика: часть сообщений могла потеряться, надо перечитать историю
+RESYNC = object()
+
+
+def stream_key(user_id):
+    return f'notification_stream:{user_id}'
+
+
+def channel(user_id):
+    return f'user_notifications:{user_id}'
+
+
+# id записи потока Redis ("<ms>-<seq>") в виде, пригодном для сравнения
+def parse_id(event_id):
+    ms, _, seq = str(event_id).partition('-')
+    return int(ms), int(seq or 0)
+
+
+def is_event_id(value):
+    return EVENT_ID_RE.fullmatch(value) is not None
+
+
+def pack(payload):
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+def unpack(data):
+    # Записи, сделанные до перехода на msgpack, хранятся в JSON
+    if data[:1] == b'{':
+        return json.loads(data)
+    return msgpack.unpackb(data, raw=False)
+
+
+def _event(entry_id, fields):
+    event = unpack(fields[b'data'])
+    event['id'] = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+    return event
+
+
+# Запись уведомления (data - результат pack); client может быть и pipeline,
+# тогда id записи вернёт execute
+def append(client, user_id, data):
+    script = client.register_script(PUBLISH_SCRIPT)
+    return script(keys=[stream_key(user_id), ORDERS_STREAM, channel(user_id)],
+                  args=[data, HISTORY_SIZE, ORDERS_STREAM_SIZE, user_id])
+
+
+# Сохранение уведомления и рассылка подписчикам; возвращает уведомление с id
+def publish(redis_client, user_id, payload):
+    event_id = append(redis_client, user_id, pack(payload))
+    return dict(payload, id=event_id.decode())
+
+
+# Уведомления пользователя строго после last_id в порядке возрастания
+def history_since(redis_client, user_id, last_id, count=HISTORY_SIZE):
+    entries = redis_client.xrange(stream_key(user_id), min=f'({last_id}', max='+', count=count)
+    return [_event(entry_id, fields) for entry_id, fields in entries]
+
+
+# Уведомления пользователя начиная с момента timestamp (unix, секунды) в порядке возрастания;
+# id записи потока начинается с времени в миллисекундах
+def history_from_time(redis_client, user_id, timestamp, count=HISTORY_SIZE):
+    entries = redis_client.xrange(stream_key(user_id), min=str(int(timestamp * 1000)), max='+', count=count)
+    return [_event(entry_id, fields) for entry_id, fields in entries]
+
+
+# Последние уведомления пользователя (строго до before, если задан), новые первыми
+def recent(redis_client, user_id, count=HISTORY_SIZE, before=None):
+    max_id = f'({before}' if before else '+'
+    entries = redis_client.xrevrange(stream_key(user_id), max=max_id, min='-', count=count)
+    return [_event(entry_id, fields) for entry_id, fields in entries]
+
+
+def latest_id(redis_client, user_id):
+    entries = redis_client.xrevrange(stream_key(user_id), max='+', min='-', count=1)
+    return entries[0][0].decode() if entries else '0-0'
+
+
+# Один pattern-подписчик на процесс, раздающий уведомления очередям клиентов.
+# Вместо соединения Redis на каждый открытый /notifications/sub процесс держит одно.
+class NotificationHub:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._thread_pid = None
+
+    def subscribe(self, user_id):
+        self._ensure_started()
+        subscriber = queue.Queue(maxsize=QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(str(user_id), set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, user_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(str(user_id))
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[str(user_id)]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def _ensure_started(self):
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            self._subscribers.clear()
+            threading.Thread(target=self._run, name='notification-hub', daemon=True).start()
+
+    def _deliver(self, user_id, item):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(item)
+            except queue.Full:
+                # Медленный клиент: сбрасываем очередь, он дочитает пропущенное из истории
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait(RESYNC)
+
+    def _resync_all(self):
+        with self._lock:
+            users = list(self._subscribers)
+        for user_id in users:
+            self._deliver(user_id, RESYNC)
+
+    def _run(self):
+        backoff = 0.5
+        while True:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe(CHANNEL_PATTERN)
+                backoff = 0.5
+                while True:
+                    # Блокирующее ожидание сообщения; таймаут нужен только для проверки соединения
+                    message = pubsub.get_message(timeout=5.0)
+                    if message and message['type'] == 'pmessage':
+                        user_id = message['channel'].decode().rsplit(':', 1)[1]
+                        self._deliver(user_id, message['data'])
+            except RedisError as e:
+                logger.warning("Notification hub subscription lost: %s", e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                self._resync_all()
+            finally:
+                pubsub.close()
+
+
+def format_event(event):
+    return f"id: {event['id']}\ndata: {json.dumps(event)}\n\n"
+
+
+def _parse_message(item):
+    event_id, _, data = item.partition(b'\n')
+    return dict(unpack(data), id=event_id.decode())
+
+
+# SSE-поток для пользователя: догоняет историю после last_event_id,
+# затем отдаёт новые уведомления по мере поступления и комментарии-heartbeat
+# max_duration - через сколько секунд закрыть стрим; клиент переподключится
+# с Last-Event-ID и ничего не потеряет
+def stream(hub, redis_client, user_id, last_event_id, heartbeat, max_duration=None):
+    deadline = time.monotonic() + max_duration if max_duration else None
+    subscriber = hub.subscribe(user_id)
+    try:
+        yield 'retry: 3000\n\n'
+        yield 'data: {"message": "Subscribed to notifications"}\n\n'
+        if last_event_id is None:
+            # Новый клиент: историю не отдаём, начинаем с последней записи потока
+            last_id = latest_id(redis_client, user_id)
+        else:
+            last_id = last_event_id
+            for event in history_since(redis_client, user_id, last_id):
+                last_id = event['id']
+                yield format_event(event)
+        while True:
+            timeout = heartbeat
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                timeout = min(heartbeat, remaining)
+            try:
+                item = subscriber.get(timeout=timeout)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if item is RESYNC:
+                events = history_since(redis_client, user_id, last_id)
+            else:
+                events = [_parse_message(item)]
+            for event in events:
+                # Уже отданные при догоне истории события пропускаем
+                if parse_id(event['id']) <= parse_id(last_id):
+                    continue
+                last_id = event['id']
+                yield format_event(event)
+    finally:
+        hub.unsubscribe(user_id, subscriber)
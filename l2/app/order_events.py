@@ -0,0 +1,136 @@
+import argparse
+import logging
+import os
+import socket
+import time
+
+from redis import Redis
+from redis.exceptions import RedisError, ResponseError
+
+import logging_setup
+import notification_hub
+
+logger = logging.getLogger('shop.order_events')
+
+# Обработчики общего потока событий заказов (notification_hub.ORDERS_STREAM).
+# Воркеры одной группы делят поток между собой: каждое событие получает один
+# потребитель группы и подтверждает его XACK только после успешной обработки.
+# События упавшего потребителя остаются в PEL группы, и через CLAIM_IDLE их
+# забирает (XAUTOCLAIM) любой живой потребитель - доставка "хотя бы один раз",
+# поэтому обработчик должен быть идемпотентным.
+GROUP = 'order-events'
+BATCH_SIZE = 100
+BLOCK_MS = 5000
+CLAIM_IDLE_MS = 60000
+
+# XAUTOCLAIM через скрипт: redis-py 4.0.2 разбирает ответ команды и отбрасывает
+# курсор следующей итерации, а ответ EVALSHA возвращается как есть:
+# [cursor, [[id, [field, value, ...] или nil], ...], (Redis 7) [удалённые id]]
+XAUTOCLAIM_SCRIPT = """
+return redis.call('XAUTOCLAIM', KEYS[1], ARGV[1], ARGV[2], ARGV[3], ARGV[4], 'COUNT', ARGV[5])
+"""
+
+
+def ensure_group(redis_client, group, stream=notification_hub.ORDERS_STREAM):
+    try:
+        # '0': новая группа получит и события, записанные до её создания
+        redis_client.xgroup_create(stream, group, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def decode_event(entry_id, fields):
+    return {
+        'stream_id': entry_id.decode(),
+        'user_id': fields[b'user_id'].decode(),
+        'event_id': fields[b'event_id'].decode(),
+        **notification_hub.unpack(fields[b'data']),
+    }
+
+
+class Consumer:
+    def __init__(self, redis_client, group, name, handler, stream=notification_hub.ORDERS_STREAM,
+                 batch_size=BATCH_SIZE, block_ms=BLOCK_MS, claim_idle_ms=CLAIM_IDLE_MS):
+        self.redis_client = redis_client
+        self.group = group
+        self.name = name
+        self.handler = handler
+        self.stream = stream
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self._claim_cursor = '0-0'
+
+    # Обработка пачки; возвращает число подтверждённых событий
+    def _process(self, entries):
+        done = []
+        for entry_id, fields in entries:
+            # Запись могла быть удалена из потока по MAXLEN, пока висела в PEL
+            if not fields:
+                done.append(entry_id)
+                continue
+            try:
+                self.handler(decode_event(entry_id, fields))
+                done.append(entry_id)
+            except Exception as e:
+                # Без XACK событие останется в PEL и будет передано повторно
+                logger.error("Failed to handle order event %s: %s", entry_id, e)
+        if done:
+            self.redis_client.xack(self.stream, self.group, *done)
+        return len(done)
+
+    # Забрать события, зависшие у других (упавших) потребителей группы
+    def claim_stale(self):
+        script = self.redis_client.register_script(XAUTOCLAIM_SCRIPT)
+        result = script(keys=[self.stream], args=[self.group, self.name, self.claim_idle_ms,
+                                                  self._claim_cursor, self.batch_size])
+        cursor = result[0]
+        self._claim_cursor = cursor.decode() if isinstance(cursor, bytes) else cursor
+        # Redis 6.2 отдаёт удалённые из потока записи с пустыми полями
+        entries = [(entry_id, dict(zip(fields[::2], fields[1::2])) if fields else {})
+                   for entry_id, fields in result[1]]
+        if entries:
+            logger.info("Claimed %s stale order events", len(entries))
+        return self._process(entries)
+
+    def read_new(self):
+        response = self.redis_client.xreadgroup(self.group, self.name, {self.stream: '>'},
+                                                count=self.batch_size, block=self.block_ms)
+        return sum(self._process(entries) for _, entries in response)
+
+    def run_once(self):
+        return self.claim_stale() + self.read_new()
+
+    def run(self):
+        ensure_group(self.redis_client, self.group, self.stream)
+        logger.info("Consumer %s joined group %s on %s", self.name, self.group, self.stream)
+        backoff = 0.5
+        while True:
+            try:
+                self.run_once()
+                backoff = 0.5
+            except RedisError as e:
+                logger.warning("Order events consumer error: %s", e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+
+def log_event(event):
+    logger.info("Order %s of user %s: %s", event.get('order_id'), event['user_id'], event.get('status'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Order events consumer')
+    parser.add_argument('--group', default=GROUP)
+    parser.add_argument('--consumer', default=f'{socket.gethostname()}-{os.getpid()}')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--claim-idle-ms', type=int, default=CLAIM_IDLE_MS)
+    args = parser.parse_args()
+
+    logging_setup.setup_logging(os.environ.get('LOG_DIR'), os.environ.get('LOG_LEVEL', 'INFO'),
+                                os.environ.get('LOG_FORMAT', 'json'))
+    redis_client = Redis(host=os.environ.get('REDIS_HOST'), port=int(os.environ.get('REDIS_PORT')),
+                         db=int(os.environ.get('REDIS_DB')))
+    Consumer(redis_client, args.group, args.consumer, log_event, batch_size=args.batch_size,
+             claim_idle_ms=args.claim_idle_ms).run()
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from redis.exceptions import RedisError
+from sqlalchemy import text
+
+import metrics
+import notification_hub
+
+logger = logging.getLogger('shop.outbox')
+
+# Транзакционный outbox для уведомлений о заказах: запрос пишет уведомление
+# в lab2.outbox в той же транзакции, что и заказ, а фоновый диспетчер пачками
+# забирает строки, отправляет их в Redis одним pipeline и удаляет доставленные.
+#
+# Забор пачки - короткая транзакция: строки получают аренду (next_attempt_at
+# сдвигается на LEASE) и сразу коммитятся, а отправка в Redis идёт уже без
+# открытой транзакции и блокировок. Упавший диспетчер не удаляет строки, и после
+# аренды их заберёт другой. При ошибке Redis строка повторяется с экспоненциальной
+# задержкой, поэтому доставка "хотя бы один раз".
+#
+# Уведомления одного пользователя уходят по порядку id: строка не забирается, пока
+# у пользователя есть более ранняя строка в аренде или в ожидании повтора. Заборы
+# разных диспетчеров сериализуются advisory-блокировкой, чтобы двое не забрали
+# соседние строки одного пользователя одновременно.
+BATCH_SIZE = 100
+POLL_INTERVAL = 1.0  # Опрос таблицы, если никто не разбудил диспетчер, секунд
+MAX_BACKOFF = 60     # Предельная задержка повтора, секунд
+LEASE = 30           # Время, на которое забранная строка скрыта от других диспетчеров, секунд
+CLAIM_LOCK_KEY = 0x6f7574626f78  # Ключ advisory-блокировки забора ('outbox')
+
+ENQUEUE_SQL = text("""
+    INSERT INTO lab2.outbox (user_id, payload) VALUES (:user_id, CAST(:payload AS jsonb))
+""")
+
+CLAIM_LOCK_SQL = text("SELECT pg_advisory_xact_lock(:key)")
+
+CLAIM_SQL = text("""
+    WITH claimed AS (
+        SELECT o.id
+        FROM lab2.outbox o
+        WHERE o.next_attempt_at <= now()
+          AND NOT EXISTS (
+              SELECT 1 FROM lab2.outbox e
+              WHERE e.user_id = o.user_id AND e.id < o.id AND e.next_attempt_at > now()
+          )
+        ORDER BY o.id
+        LIMIT :limit
+    )
+    UPDATE lab2.outbox o
+    SET next_attempt_at = now() + make_interval(secs => :lease)
+    FROM claimed
+    WHERE o.id = claimed.id
+    RETURNING o.id, o.user_id, o.payload, EXTRACT(EPOCH FROM clock_timestamp() - o.created_at) AS lag
+""")
+
+DELETE_SQL = text("DELETE FROM lab2.outbox WHERE id = ANY(:ids)")
+
+RETRY_SQL = text("""
+    UPDATE lab2.outbox
+    SET attempts = attempts + 1,
+        next_attempt_at = now() + make_interval(secs => least(power(2, attempts), :max_backoff)),
+        last_error = :error
+    WHERE id = ANY(:ids)
+""")
+
+PENDING_SQL = text("""
+    SELECT count(*), EXTRACT(EPOCH FROM clock_timestamp() - min(created_at)) FROM lab2.outbox
+""")
+
+
+# Добавить уведомление в outbox текущей транзакции session
+def enqueue(session, user_id, payload):
+    session.execute(ENQUEUE_SQL, {'user_id': user_id, 'payload': json.dumps(payload)})
+
+
+# Размеры пачек и задержка доставки (от записи в outbox до отправки в Redis)
+class DispatchStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.sent = 0
+        self.failed = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def record(self, size, sent, lag):
+        with self._lock:
+            self.batches += 1
+            self.sent += sent
+            self.failed += size - sent
+            self.last_batch_size = size
+            self.max_batch_size = max(self.max_batch_size, size)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'sent': self.sent,
+                'failed': self.failed,
+                'last_batch_size': self.last_batch_size,
+                'max_batch_size': self.max_batch_size,
+                'lag_seconds_last': round(self.last_lag, 6),
+                'lag_seconds_max': round(self.max_lag, 6),
+            }
+
+
+class Dispatcher:
+    def __init__(self, redis_client, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL):
+        self.redis_client = redis_client
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stats = DispatchStats()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread_pid = None
+
+    # Запуск фонового потока; вызывается в каждом процессе (после fork)
+    def start(self, engine):
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, args=(engine,), name='outbox-dispatcher', daemon=True).start()
+
+    # Разбудить диспетчер после коммита, не дожидаясь очередного опроса
+    def notify(self):
+        self._wakeup.set()
+
+    # Одна пачка; возвращает число забранных строк
+    def dispatch_batch(self, engine):
+        with engine.begin() as connection:
+            connection.execute(CLAIM_LOCK_SQL, {'key': CLAIM_LOCK_KEY})
+            rows = connection.execute(CLAIM_SQL, {'limit': self.batch_size, 'lease': LEASE}).fetchall()
+        if not rows:
+            return 0
+        # RETURNING не гарантирует порядок
+        rows.sort(key=lambda row: row.id)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for row in rows:
+            notification_hub.append(pipe, row.user_id, notification_hub.pack(row.payload))
+        try:
+            results = pipe.execute(raise_on_error=False)
+        except RedisError as e:
+            results = [e] * len(rows)
+        sent = [row.id for row, result in zip(rows, results) if not isinstance(result, Exception)]
+        errors = [result for result in results if isinstance(result, Exception)]
+        with engine.begin() as connection:
+            if sent:
+                connection.execute(DELETE_SQL, {'ids': sent})
+            if errors:
+                failed = [row.id for row, result in zip(rows, results) if isinstance(result, Exception)]
+                logger.warning("Failed to dispatch %s outbox events: %s", len(failed), errors[0])
+                connection.execute(RETRY_SQL, {'ids': failed, 'error': str(errors[0]),
+                                               'max_backoff': MAX_BACKOFF})
+        lag = float(max(row.lag for row in rows))
+        self.stats.record(len(rows), len(sent), lag)
+        metrics.observe_outbox_batch(len(rows), len(sent), lag)
+        return len(rows)
+
+    def _run(self, engine):
+        backoff = 0.5
+        while True:
+            self._wakeup.clear()
+            try:
+                count = self.dispatch_batch(engine)
+                backoff = 0.5
+            except Exception as e:
+                logger.warning("Outbox dispatch failed: %s", e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            # Полная пачка - в таблице, скорее всего, есть ещё строки
+            if count < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+
+
+# Недоставленные уведомления и возраст самого старого из них
+def pending_stats(engine):
+    with engine.connect() as connection:
+        count, oldest = connection.execute(PENDING_SQL).one()
+    return {'pending': count, 'oldest_age_seconds': round(float(oldest or 0), 6)}
@@ -0,0 +1,90 @@
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+# Хеширование паролей bcrypt вне потока запроса. KDF выполняется в отдельном
+# пуле потоков (bcrypt отпускает GIL), число одновременно ожидающих хеширования
+# запросов ограничено: сверх лимита сразу возвращается Busy, а не растёт очередь.
+# Под gevent используется отдельный пул настоящих потоков gevent того же размера,
+# иначе хеширование блокировало бы все гринлеты воркера.
+#
+# Пароли, сохранённые до перехода на bcrypt, хранятся открытым текстом; они
+# проверяются как есть и перехешируются при следующем успешном входе, как и хеши
+# с устаревшей стоимостью. Хеши pgcrypto crypt(..., gen_salt('bf')) тоже подходят.
+BCRYPT_PREFIXES = ('$2a$', '$2b$', '$2y$')
+
+
+class Busy(Exception):
+    pass
+
+
+def _gevent_threadpool(size):
+    try:
+        from gevent import monkey
+        from gevent.threadpool import ThreadPool
+    except ImportError:
+        return None
+    if not monkey.is_module_patched('threading'):
+        return None
+    # Не пул хаба: его размер (10) не зависит от PASSWORD_HASH_WORKERS, и он нужен
+    # самому gevent, например для DNS
+    return ThreadPool(size)
+
+
+def is_hashed(stored):
+    return stored.startswith(BCRYPT_PREFIXES)
+
+
+def _cost(stored):
+    return int(stored.split('$')[2])
+
+
+class PasswordHasher:
+    def __init__(self, rounds, workers, max_pending):
+        self.rounds = rounds
+        self.workers = workers
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._threadpool = None
+        self._lock = threading.Lock()
+        # Хеш для проверки несуществующего пользователя: время ответа не выдаёт,
+        # есть ли такой логин
+        self._dummy = None
+
+    def _submit(self, fn, *args):
+        if self._executor is None and self._threadpool is None:
+            with self._lock:
+                if self._executor is None and self._threadpool is None:
+                    self._threadpool = _gevent_threadpool(self.workers)
+                    if self._threadpool is None:
+                        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='password-hash')
+        if self._threadpool is not None:
+            return self._threadpool.spawn(fn, *args).get()
+        return self._executor.submit(fn, *args).result()
+
+    def _run(self, fn, *args):
+        if not self._pending.acquire(blocking=False):
+            raise Busy()
+        try:
+            return self._submit(fn, *args)
+        finally:
+            self._pending.release()
+
+    def hash(self, password):
+        salt = bcrypt.gensalt(self.rounds)
+        return self._run(bcrypt.hashpw, password.encode(), salt).decode()
+
+    # (пароль верен, нужно ли перехешировать сохранённое значение)
+    def verify(self, password, stored):
+        if stored is None:
+            if self._dummy is None:
+                self._dummy = self.hash('')
+            self._run(bcrypt.checkpw, password.encode(), self._dummy.encode())
+            return False, False
+        if not is_hashed(stored):
+            ok = hmac.compare_digest(password.encode(), stored.encode())
+            return ok, ok
+        ok = self._run(bcrypt.checkpw, password.encode(), stored.encode())
+        return ok, ok and _cost(stored) != self.rounds
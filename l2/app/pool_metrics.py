@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+
+from redis import BlockingConnectionPool
+from sqlalchemy.pool import QueuePool
+
+
+# Накопитель времени ожидания свободного соединения в пуле
+class WaitStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.count,
+                'wait_seconds_total': round(self.total, 6),
+                'wait_seconds_max': round(self.max, 6),
+            }
+
+
+# QueuePool SQLAlchemy, замеряющий ожидание соединения при checkout
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = WaitStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.wait_stats.record(time.perf_counter() - start)
+
+
+# Пул Redis, который ждёт освобождения соединения (а не падает) и замеряет ожидание
+class TimedBlockingConnectionPool(BlockingConnectionPool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = WaitStats()
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.perf_counter()
+        try:
+            return super().get_connection(command_name, *keys, **options)
+        finally:
+            self.wait_stats.record(time.perf_counter() - start)
+
+
+def sqlalchemy_pool_stats(pool):
+    return {
+        'pid': os.getpid(),
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        'overflow': pool.overflow(),
+        **pool.wait_stats.snapshot(),
+    }
+
+
+def redis_pool_stats(pool):
+    idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+    created = len(pool._connections)
+    return {
+        'pid': os.getpid(),
+        'max_connections': pool.max_connections,
+        'created': created,
+        'in_use': created - idle,
+        'idle': idle,
+        **pool.wait_stats.snapshot(),
+    }
@@ -0,0 +1,61 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+# Подписанные токены доступа: "v1.<claims>.<подпись>", claims - JSON в base64url
+# с user_id (sub), ролью, сроком действия (exp, unix) и идентификатором (jti),
+# подпись - HMAC-SHA256 на секрете приложения. Проверка не требует обращения
+# к Redis; отозванные до истечения срока токены попадают в denylist по jti.
+PREFIX = 'v1'
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _sign(secret, message):
+    return _b64encode(hmac.new(secret.encode(), message.encode(), hashlib.sha256).digest())
+
+
+def is_signed(token):
+    return token.startswith(PREFIX + '.')
+
+
+def issue(secret, user_id, role, ttl):
+    claims = {'sub': user_id, 'role': role, 'exp': int(time.time()) + ttl, 'jti': uuid.uuid4().hex}
+    message = PREFIX + '.' + _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+    return message + '.' + _sign(secret, message)
+
+
+# Claims действительного токена или None (подделка, повреждение, истёк срок)
+def verify(secret, token):
+    message, _, signature = token.rpartition('.')
+    if not is_signed(message) or not hmac.compare_digest(signature.encode(), _sign(secret, message).encode()):
+        return None
+    try:
+        claims = json.loads(_b64decode(message[len(PREFIX) + 1:]))
+    except ValueError:
+        return None
+    if claims.get('exp', 0) <= time.time():
+        return None
+    return claims
+
+
+def denylist_key(jti):
+    return f'token_denylist:{jti}'
+
+
+# Отзыв токена: запись живёт до истечения его срока; client может быть и pipeline
+def revoke(client, claims):
+    client.set(denylist_key(claims['jti']), 1, ex=max(1, int(claims['exp'] - time.time())))
+
+
+def is_revoked(redis_client, claims):
+    return bool(redis_client.exists(denylist_key(claims['jti'])))
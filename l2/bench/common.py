@@ -0,0 +1,93 @@
+"""Shared helpers for the benchmark scripts: HTTP client, login, percentiles."""
+import http.client
+import json
+import os
+import statistics
+from urllib.parse import urlsplit
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(latencies, elapsed):
+    if not latencies:
+        return {'count': 0, 'rps': 0.0}
+    return {
+        'count': len(latencies),
+        'rps': round(len(latencies) / elapsed, 2),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def connect(url, timeout=30):
+    parts = urlsplit(url)
+    return http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+
+
+# Keep-alive клиент API; переподключается после сетевой ошибки
+class ApiClient:
+    def __init__(self, url, token=None):
+        self.url = url
+        self.token = token
+        self.conn = connect(url)
+
+    def request(self, method, path, body=None):
+        headers = {'Authorization': self.token} if self.token else {}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(body)
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            self.conn = connect(self.url)
+            raise
+        if response.headers.get('Content-Type', '').startswith('application/json'):
+            return response.status, json.loads(data)
+        return response.status, data
+
+    def close(self):
+        self.conn.close()
+
+
+def login(url, username, password):
+    client = ApiClient(url)
+    status, body = client.request('POST', '/login', {'username': username, 'password': password})
+    client.close()
+    if status != 200:
+        raise SystemExit(f'login failed for {username}: {body}')
+    return body['token']
+
+
+def hold_stream(url, token, stop, counter=None):
+    # Держим SSE-соединение открытым, как вкладка магазина; counter[0] - число событий,
+    # counter[1] - 1, если сервер начал отдавать поток (под gthread стрим ждёт свободный поток)
+    conn = connect(url)
+    try:
+        conn.request('GET', '/notifications/sub', headers={'Authorization': token})
+        response = conn.getresponse()
+        while not stop.is_set():
+            line = response.fp.readline()
+            if not line:
+                break
+            if counter is not None:
+                counter[1] = 1
+                if line.startswith(b'id:'):
+                    counter[0] += 1
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+
+def database_url(env=None):
+    env = os.environ if env is None else env
+    return 'postgresql://{}:{}@{}:{}/{}'.format(
+        env.get('PG_USERNAME'), env.get('PG_PASSWORD'), env.get('PG_HOST'), env.get('PG_PORT'), env.get('PG_DB'))
@@ -0,0 +1,387 @@
+"""Mixed-workload load test for the shop API with JSON results and a compare mode.
+
+`run` seeds N users and M products, logs the users in and drives keep-alive
+client threads through a weighted mix of catalog browsing, cart, checkout,
+history and admin requests for a fixed duration, optionally while holding
+/notifications/sub streams open. Throughput, error counts and p50/p95/p99 are
+reported per endpoint and saved as JSON. Without --url the API, Postgres and
+Redis are started locally (see stack.py) and removed afterwards; with --url the
+running instance is seeded through the PG_*/REDIS_* environment variables.
+
+    python bench/loadtest.py run --mix shop --concurrency 32 --duration 60 --streams 50 \
+        --worker-class gevent --output bench/results/gevent.json
+    python bench/loadtest.py compare bench/results/base.json bench/results/gevent.json
+
+`compare` prints both runs side by side and exits with code 1 if any endpoint
+got slower or lost throughput beyond the thresholds, or started failing.
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+import bcrypt
+from redis import Redis
+from sqlalchemy import create_engine, text
+
+import stack
+from common import ApiClient, database_url, hold_stream, login, summarize
+
+sys.path.insert(0, stack.APP_DIR)
+import catalog  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+USER_PREFIX = 'bench_user_'
+ADMIN_USERNAME = 'bench_admin'
+PRODUCT_PREFIX = 'bench-product-'
+PRODUCT_STOCK = 10 ** 9
+PRODUCT_CACHE_TTL = 300
+
+# Относительные веса действий в каждой смеси
+MIXES = {
+    'browse': {'catalog': 5, 'product': 5},
+    'shop': {'catalog': 3, 'product': 4, 'cart_add': 2, 'cart': 1, 'checkout': 1, 'orders': 1,
+             'notifications': 1},
+    'admin': {'catalog': 3, 'product': 3, 'admin_update': 2},
+    'full': {'catalog': 3, 'product': 4, 'cart_add': 2, 'cart': 1, 'checkout': 1, 'orders': 1,
+             'notifications': 1, 'admin_update': 0.5},
+}
+
+
+def seed(engine, redis_client, users, products, password, rounds):
+    # Один хеш на всех: bcrypt на тысячи пользователей занял бы минуты
+    hashed = bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+    with engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO lab2.users (username, password, role) "
+            "SELECT :prefix || n, :password, 'user' FROM generate_series(0, :count - 1) AS n "
+            "ON CONFLICT (username) DO NOTHING"), {'prefix': USER_PREFIX, 'password': hashed, 'count': users})
+        conn.execute(text(
+            "INSERT INTO lab2.users (username, password, role) VALUES (:username, :password, 'admin') "
+            "ON CONFLICT (username) DO UPDATE SET password = EXCLUDED.password, role = 'admin'"),
+            {'username': ADMIN_USERNAME, 'password': hashed})
+        conn.execute(text(
+            "UPDATE lab2.users SET password = :password WHERE username LIKE :pattern"),
+            {'password': hashed, 'pattern': USER_PREFIX + '%'})
+        existing = conn.execute(text("SELECT count(*) FROM lab2.products WHERE name LIKE :pattern"),
+                                {'pattern': PRODUCT_PREFIX + '%'}).scalar()
+        created = conn.execute(text(
+            "INSERT INTO lab2.products (name, price, stock) "
+            "SELECT :prefix || n, round((random() * 999 + 1)::numeric, 2), :stock "
+            "FROM generate_series(:start, :count - 1) AS n RETURNING id, name, price, stock"),
+            {'prefix': PRODUCT_PREFIX, 'stock': PRODUCT_STOCK, 'start': existing, 'count': products}).fetchall()
+        # Остаток не должен кончиться за прогон
+        conn.execute(text("UPDATE lab2.products SET stock = :stock WHERE name LIKE :pattern"),
+                     {'stock': PRODUCT_STOCK, 'pattern': PRODUCT_PREFIX + '%'})
+        product_ids = [row[0] for row in conn.execute(text(
+            "SELECT id FROM lab2.products WHERE name LIKE :pattern ORDER BY id LIMIT :count"),
+            {'pattern': PRODUCT_PREFIX + '%', 'count': products})]
+    # Новые товары должны появиться на уже закэшированных страницах каталога
+    changes = [(None, dict(row._mapping)) for row in created]
+    for start in range(0, len(changes), 1000):
+        catalog.products_changed(redis_client, changes[start:start + 1000], PRODUCT_CACHE_TTL)
+    return product_ids
+
+
+class Shopper:
+    def __init__(self, url, token, admin_token, product_ids, rng):
+        self.client = ApiClient(url, token)
+        self.admin = ApiClient(url, admin_token)
+        self.product_ids = product_ids
+        # Популярные товары: десятая часть каталога получает 80% просмотров
+        self.hot = product_ids[:max(1, len(product_ids) // 10)]
+        self.rng = rng
+        self.cursor = None
+        self.cart_lines = 0
+
+    def pick_product(self):
+        return self.rng.choice(self.hot if self.rng.random() < 0.8 else self.product_ids)
+
+    def catalog(self, call):
+        if self.cursor and self.rng.random() < 0.5:
+            sort, cursor = self.cursor
+            params = dict(cursor, sort=sort, limit=20)
+        else:
+            sort = self.rng.choice(('id', 'price', 'name'))
+            params = {'sort': sort, 'limit': 20}
+        status, body = call(self.client, 'GET', '/products', f'/products?{urlencode(params)}')
+        self.cursor = (sort, body['next']) if status == 200 and body.get('next') else None
+
+    def product(self, call):
+        product_id = self.pick_product()
+        call(self.client, 'GET', '/products/<id>', f'/products/{product_id}')
+
+    def cart_add(self, call):
+        body = {'product_id': self.pick_product(), 'quantity': self.rng.randint(1, 3)}
+        status, _ = call(self.client, 'POST', '/cart/add', '/cart/add', body)
+        if status == 200:
+            self.cart_lines += 1
+
+    def cart(self, call):
+        call(self.client, 'GET', '/cart', '/cart')
+
+    def checkout(self, call):
+        if not self.cart_lines:
+            self.cart_add(call)
+        status, _ = call(self.client, 'POST', '/order', '/order')
+        if status in (201, 400):
+            self.cart_lines = 0
+
+    def orders(self, call):
+        call(self.client, 'GET', '/orders', '/orders?limit=20')
+
+    def notifications(self, call):
+        call(self.client, 'GET', '/notifications', '/notifications?limit=20')
+
+    def admin_update(self, call):
+        body = {'price': round(self.rng.uniform(1, 1000), 2)}
+        call(self.admin, 'PUT', '/products/<id>', f'/products/{self.pick_product()}', body)
+
+    def close(self):
+        self.client.close()
+        self.admin.close()
+
+
+class Recorder:
+    def __init__(self, measure_from):
+        self.measure_from = measure_from
+        self.latencies = {}
+        self.statuses = {}
+
+    def call(self, client, method, route, path, body=None):
+        start = time.perf_counter()
+        try:
+            status, response = client.request(method, path, body)
+        except (OSError, http.client.HTTPException):
+            status, response = 'error', None
+        if start >= self.measure_from:
+            endpoint = f'{method} {route}'
+            if status != 'error':
+                self.latencies.setdefault(endpoint, []).append(time.perf_counter() - start)
+            statuses = self.statuses.setdefault(endpoint, {})
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        return status, response if isinstance(response, dict) else {}
+
+
+def worker(shopper, mix, measure_from, deadline, recorders, lock):
+    recorder = Recorder(measure_from)
+    actions = [getattr(shopper, name) for name in mix]
+    weights = list(mix.values())
+    while time.perf_counter() < deadline:
+        shopper.rng.choices(actions, weights)[0](recorder.call)
+    shopper.close()
+    with lock:
+        recorders.append(recorder)
+
+
+def merge(recorders, elapsed):
+    latencies, statuses = {}, {}
+    for recorder in recorders:
+        for endpoint, values in recorder.latencies.items():
+            latencies.setdefault(endpoint, []).extend(values)
+        for endpoint, counts in recorder.statuses.items():
+            merged = statuses.setdefault(endpoint, {})
+            for status, count in counts.items():
+                merged[status] = merged.get(status, 0) + count
+    endpoints = {}
+    for endpoint in sorted(statuses):
+        result = summarize(latencies.get(endpoint, []), elapsed)
+        # Ошибка - обрыв соединения или 5xx; 4xx (пустая корзина, нет остатка) - часть сценария
+        result['errors'] = sum(count for status, count in statuses[endpoint].items()
+                               if status == 'error' or int(status) >= 500)
+        result['statuses'] = statuses[endpoint]
+        endpoints[endpoint] = result
+    total = summarize([value for values in latencies.values() for value in values], elapsed)
+    total['errors'] = sum(result['errors'] for result in endpoints.values())
+    return endpoints, total
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def drive(url, env, args):
+    engine = create_engine(database_url(env))
+    redis_client = Redis(host=env.get('REDIS_HOST'), port=int(env.get('REDIS_PORT') or 6379),
+                         db=int(env.get('REDIS_DB') or 0))
+    product_ids = seed(engine, redis_client, args.users, args.products, args.password, args.hash_rounds)
+    engine.dispose()
+    redis_client.close()
+
+    # Логинимся столькими пользователями, сколько одновременно работает клиентов
+    usernames = [f'{USER_PREFIX}{i}' for i in range(min(args.users, max(args.concurrency, args.streams)))]
+    user_tokens = [login(url, username, args.password) for username in usernames]
+    admin_token = login(url, ADMIN_USERNAME, args.password)
+
+    stop = threading.Event()
+    # Стримы открыты у тех же пользователей, что делают заказы, как вкладка покупателя,
+    # поэтому уведомления о заказах доходят до них
+    counters = [[0, 0] for _ in range(args.streams)]
+    streams = [threading.Thread(target=hold_stream, args=(url, user_tokens[i % len(user_tokens)], stop,
+                                                          counters[i]), daemon=True)
+               for i in range(args.streams)]
+    for thread in streams:
+        thread.start()
+
+    mix = MIXES[args.mix]
+    recorders, lock = [], threading.Lock()
+    measure_from = time.perf_counter() + args.warmup
+    deadline = measure_from + args.duration
+    threads = [threading.Thread(target=worker, args=(
+        Shopper(url, user_tokens[i % len(user_tokens)], admin_token, product_ids, random.Random(args.seed + i)),
+        mix, measure_from, deadline, recorders, lock)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+
+    endpoints, total = merge(recorders, args.duration)
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'label': args.label,
+            'commit': git_commit(),
+            'target': url if args.url else f'local {args.worker_class} x{args.workers}',
+            'mix': args.mix,
+            'weights': mix,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'users': args.users,
+            'products': args.products,
+            'streams': args.streams,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+        },
+        'total': total,
+        'endpoints': endpoints,
+        'streams': {'open': args.streams, 'served': sum(counter[1] for counter in counters),
+                    'events': sum(counter[0] for counter in counters)},
+    }
+
+
+def print_result(result):
+    print(f'{"endpoint":<24} {"count":>7} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>6}')
+    for endpoint, row in list(result['endpoints'].items()) + [('total', result['total'])]:
+        if not row['count']:
+            print(f'{endpoint:<24} {0:>7} {"-":>8} {"-":>8} {"-":>8} {"-":>8} {row["errors"]:>6}')
+            continue
+        print(f'{endpoint:<24} {row["count"]:>7} {row["rps"]:>8.1f} {row["p50_ms"]:>8.1f} '
+              f'{row["p95_ms"]:>8.1f} {row["p99_ms"]:>8.1f} {row["errors"]:>6}')
+    if result['streams']['open']:
+        print(f'streams: {result["streams"]["open"]} open, {result["streams"].get("served", "?")} served, '
+              f'{result["streams"]["events"]} events received')
+
+
+def run(args):
+    if args.url:
+        env = {name: os.environ[name] for name in os.environ if name.startswith(('PG_', 'REDIS_'))}
+        result = drive(args.url, env, args)
+    else:
+        local = stack.from_args(args)
+        local.api_env['PASSWORD_HASH_ROUNDS'] = str(args.hash_rounds)
+        with local:
+            result = drive(local.url, local.env, args)
+    print_result(result)
+    output = args.output or os.path.join(
+        BENCH_DIR, 'results', f'{time.strftime("%Y%m%d-%H%M%S")}-{args.label or args.mix}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+        f.write('\n')
+    print(f'saved {output}')
+
+
+def change(base, new):
+    return (new - base) / base if base else 0.0
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    for key in ('mix', 'concurrency', 'duration', 'streams', 'target'):
+        if base['meta'].get(key) != new['meta'].get(key):
+            print(f'warning: {key} differs: {base["meta"].get(key)} -> {new["meta"].get(key)}')
+
+    regressions = []
+    print(f'{"endpoint":<24} {"req/s":>16} {"p50 ms":>16} {"p95 ms":>16} {"p99 ms":>16} {"errors":>9}')
+    rows = [(endpoint, base['endpoints'].get(endpoint), new['endpoints'].get(endpoint))
+            for endpoint in sorted(set(base['endpoints']) | set(new['endpoints']))]
+    for endpoint, old, cur in rows + [('total', base['total'], new['total'])]:
+        if not old or not cur or not old['count'] or not cur['count']:
+            print(f'{endpoint:<24} only in {"base" if old else "new"} run')
+            continue
+        cells = []
+        for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            delta = change(old[key], cur[key])
+            cells.append(f'{cur[key]:>8.1f} {delta:>+7.0%}')
+            if key == 'rps' and delta < -args.max_throughput_drop:
+                regressions.append(f'{endpoint}: throughput {delta:+.0%}')
+            if key in ('p95_ms', 'p99_ms') and delta > args.max_latency_increase:
+                regressions.append(f'{endpoint}: {key[:3]} {delta:+.0%}')
+        old_rate = old['errors'] / (old['count'] + old['errors'])
+        new_rate = cur['errors'] / (cur['count'] + cur['errors'])
+        if new_rate > old_rate + args.max_error_rate_increase:
+            regressions.append(f'{endpoint}: error rate {old_rate:.1%} -> {new_rate:.1%}')
+        print(f'{endpoint:<24} {" ".join(cells)} {old["errors"]:>4}->{cur["errors"]:<4}')
+
+    if regressions:
+        print('regressions:')
+        for regression in regressions:
+            print(f'  {regression}')
+        sys.exit(1)
+    print('no regressions')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run a load test and save the results')
+    run_parser.add_argument('--url', help='running API; by default a local stack is started')
+    run_parser.add_argument('--mix', default='shop', choices=sorted(MIXES))
+    run_parser.add_argument('--users', type=int, default=1000)
+    run_parser.add_argument('--products', type=int, default=10000)
+    run_parser.add_argument('--password', default='bench-password')
+    run_parser.add_argument('--hash-rounds', type=int, default=12,
+                            help='bcrypt cost of seeded passwords, should match PASSWORD_HASH_ROUNDS')
+    run_parser.add_argument('--concurrency', type=int, default=32)
+    run_parser.add_argument('--duration', type=float, default=60)
+    run_parser.add_argument('--warmup', type=float, default=5)
+    run_parser.add_argument('--streams', type=int, default=0, help='open /notifications/sub streams')
+    run_parser.add_argument('--seed', type=int, default=1, help='random seed of the client threads')
+    run_parser.add_argument('--label')
+    run_parser.add_argument('--output')
+    stack.add_arguments(run_parser)
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser('compare', help='compare two saved runs')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--max-latency-increase', type=float, default=0.2)
+    compare_parser.add_argument('--max-throughput-drop', type=float, default=0.1)
+    compare_parser.add_argument('--max-error-rate-increase', type=float, default=0.001)
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Login throughput benchmark for the bcrypt hashing pool.
+
+Registers a set of users, then runs rounds of concurrent /login calls with a
+growing number of client threads and reports logins/s and latency percentiles
+per round. The result is the best throughput whose p99 stays under the target.
+Run the API with LOGIN_RATE_LIMIT raised (or enough --users) so the per-username
+rate limit does not reject benchmark traffic.
+
+    python bench/login_throughput.py --url http://localhost:5000 --users 200 \
+        --p99-target 0.5 --concurrency 1,2,4,8,16,32 --duration 15
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+
+from common import connect, percentile
+
+
+def post(conn, path, body):
+    conn.request('POST', path, body=json.dumps(body), headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+
+def register_users(url, prefix, count, password):
+    conn = connect(url)
+    for i in range(count):
+        status = post(conn, '/register', {'username': f'{prefix}{i}', 'password': password})
+        if status not in (201, 400):
+            raise SystemExit(f'register failed with status {status}')
+    conn.close()
+
+
+def client(url, users, password, deadline, latencies, statuses, lock, offset):
+    conn = connect(url)
+    local, counts, i = [], {}, offset
+    while time.time() < deadline:
+        username = users[i % len(users)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            status = post(conn, '/login', {'username': username, 'password': password})
+        except (OSError, http.client.HTTPException):
+            status = 'error'
+            conn.close()
+            conn = connect(url)
+        counts[status] = counts.get(status, 0) + 1
+        if status == 200:
+            local.append(time.perf_counter() - start)
+    conn.close()
+    with lock:
+        latencies.extend(local)
+        for status, count in counts.items():
+            statuses[status] = statuses.get(status, 0) + count
+
+
+def run_round(url, users, password, concurrency, duration):
+    latencies, statuses, lock = [], {}, threading.Lock()
+    deadline = time.time() + duration
+    threads = [threading.Thread(target=client, args=(url, users, password, deadline, latencies, statuses, lock,
+                                                     i * len(users) // concurrency))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--prefix', default='bench_login_')
+    parser.add_argument('--password', default='bench-password')
+    parser.add_argument('--concurrency', default='1,2,4,8,16,32')
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--p99-target', type=float, default=0.5, help='seconds')
+    args = parser.parse_args()
+
+    register_users(args.url, args.prefix, args.users, args.password)
+    users = [f'{args.prefix}{i}' for i in range(args.users)]
+
+    best = None
+    print(f'{"threads":>7} {"logins/s":>9} {"p50":>8} {"p95":>8} {"p99":>8}  statuses')
+    for concurrency in (int(value) for value in args.concurrency.split(',')):
+        latencies, statuses = run_round(args.url, users, args.password, concurrency, args.duration)
+        if not latencies:
+            print(f'{concurrency:>7} {"-":>9}  statuses {statuses}')
+            continue
+        rate = len(latencies) / args.duration
+        p99 = percentile(latencies, 0.99)
+        print(f'{concurrency:>7} {rate:>9.1f} {percentile(latencies, 0.5) * 1000:>6.1f}ms '
+              f'{percentile(latencies, 0.95) * 1000:>6.1f}ms {p99 * 1000:>6.1f}ms  {statuses}')
+        if p99 <= args.p99_target and (best is None or rate > best[1]):
+            best = (concurrency, rate, p99)
+    if best:
+        print(f'best under p99 {args.p99_target * 1000:.0f}ms: {best[1]:.1f} logins/s '
+              f'at {best[0]} threads (p99 {best[2] * 1000:.1f}ms)')
+    else:
+        print(f'no round met p99 {args.p99_target * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    main()
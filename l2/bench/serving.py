@@ -0,0 +1,86 @@
+"""Throughput benchmark for comparing serving modes (Flask dev server vs gunicorn).
+
+Drives a fixed number of keep-alive client threads against a running instance
+for a fixed duration and reports requests/s and latency percentiles, optionally
+while holding a number of /notifications/sub streams open.
+
+    python bench/serving.py --url http://localhost:5000 --concurrency 32 --duration 30 \
+        --streams 50 --username testuser --password userpass
+"""
+import argparse
+import http.client
+import statistics
+import threading
+import time
+
+from common import connect, hold_stream, login, percentile
+
+
+def client(url, paths, headers, deadline, latencies, errors, lock):
+    conn = connect(url)
+    local, failed, i = [], 0, 0
+    while time.time() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 500:
+                failed += 1
+        except (OSError, http.client.HTTPException):
+            failed += 1
+            conn.close()
+            conn = connect(url)
+            continue
+        local.append(time.perf_counter() - start)
+    conn.close()
+    with lock:
+        latencies.extend(local)
+        errors[0] += failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--streams', type=int, default=0, help='open /notifications/sub streams')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--paths', default='/products?limit=50,/products/1,/cart')
+    args = parser.parse_args()
+
+    token = login(args.url, args.username, args.password) if args.username else None
+    headers = {'Authorization': token} if token else {}
+    paths = args.paths.split(',')
+
+    stop = threading.Event()
+    streams = [threading.Thread(target=hold_stream, args=(args.url, token, stop), daemon=True)
+               for _ in range(args.streams if token else 0)]
+    for stream in streams:
+        stream.start()
+
+    latencies, errors, lock = [], [0], threading.Lock()
+    deadline = time.time() + args.duration
+    clients = [threading.Thread(target=client, args=(args.url, paths, headers, deadline, latencies, errors, lock))
+               for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+
+    if not latencies:
+        raise SystemExit('no successful requests')
+    print(f'requests: {len(latencies)} in {elapsed:.1f}s, {len(latencies) / elapsed:.0f} req/s, '
+          f'errors {errors[0]}, open streams {len(streams)}')
+    print(f'latency: p50 {statistics.median(latencies) * 1000:.1f} ms, '
+          f'p95 {percentile(latencies, 0.95) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
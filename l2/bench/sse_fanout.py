@@ -0,0 +1,121 @@
+"""Fan-out benchmark for /notifications/sub.
+
+Opens N concurrent SSE streams (non-blocking sockets, one thread), publishes
+notifications straight to the user's Redis channel and reports how many
+events reached the clients, the number of Redis client connections and the
+CPU time used by the given API processes while the streams were open.
+
+    ulimit -n 20000
+    python bench/sse_fanout.py --url http://localhost:5000 --streams 5000 \
+        --username testuser --password userpass --pids $(pgrep -f 'gunicorn') \
+        --redis-host localhost --duration 60
+"""
+import argparse
+import json
+import os
+import selectors
+import socket
+import sys
+import time
+from urllib.parse import urlsplit
+
+from redis import Redis
+
+from common import login
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import notification_hub  # noqa: E402
+
+
+def whoami(redis_client, token):
+    return json.loads(redis_client.get(f'token:{token}'))['user_id']
+
+
+def cpu_seconds(pids):
+    # utime + stime из /proc/<pid>/stat, в тиках
+    total = 0
+    for pid in pids:
+        with open(f'/proc/{pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def open_streams(url, token, count, selector):
+    parts = urlsplit(url)
+    request = (f'GET /notifications/sub HTTP/1.1\r\nHost: {parts.hostname}\r\n'
+               f'Authorization: {token}\r\nAccept: text/event-stream\r\n\r\n').encode()
+    for _ in range(count):
+        sock = socket.create_connection((parts.hostname, parts.port or 80))
+        sock.sendall(request)
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, {'events': 0})
+
+
+def pump(selector, until):
+    while time.time() < until:
+        for key, _ in selector.select(timeout=0.2):
+            try:
+                chunk = key.fileobj.recv(65536)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                continue
+            key.data['events'] += chunk.count(b'\nid: ') + chunk.startswith(b'id: ')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--streams', type=int, default=5000)
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--pids', type=int, nargs='*', default=[], help='API processes to measure CPU of')
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--redis-db', type=int, default=0)
+    parser.add_argument('--notifications', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=60, help='idle seconds to measure CPU over')
+    args = parser.parse_args()
+
+    redis_client = Redis(host=args.redis_host, port=args.redis_port, db=args.redis_db)
+    token = login(args.url, args.username, args.password)
+    user_id = whoami(redis_client, token)
+    clients_before = redis_client.info('clients')['connected_clients']
+
+    selector = selectors.DefaultSelector()
+    start = time.time()
+    open_streams(args.url, token, args.streams, selector)
+    pump(selector, time.time() + 5)
+    print(f'opened {len(selector.get_map())} streams in {time.time() - start:.1f}s')
+    clients_open = redis_client.info('clients')['connected_clients']
+
+    cpu_start = cpu_seconds(args.pids)
+    idle_start = time.time()
+    pump(selector, idle_start + args.duration)
+    idle_cpu = cpu_seconds(args.pids) - cpu_start
+    idle_elapsed = time.time() - idle_start
+
+    for i in range(args.notifications):
+        notification_hub.publish(redis_client, user_id, {'order_id': 0, 'status': 'Bench',
+                                                         'timestamp': int(time.time()),
+                                                         'message': 'benchmark notification'})
+    pump(selector, time.time() + 10)
+
+    streams = list(selector.get_map().values())
+    delivered = sum(key.data['events'] for key in streams)
+    expected = len(streams) * args.notifications
+    print(f'redis connected_clients: {clients_before} before, {clients_open} with streams open '
+          f'(+{clients_open - clients_before})')
+    if args.pids:
+        print(f'api cpu while idle: {idle_cpu:.2f}s over {idle_elapsed:.0f}s '
+              f'({idle_cpu / idle_elapsed * 100:.1f}% of one core)')
+    print(f'events delivered: {delivered}/{expected} to {len(streams)} open streams')
+    for key in streams:
+        key.fileobj.close()
+
+
+if __name__ == '__main__':
+    main()
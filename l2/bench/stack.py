@@ -0,0 +1,181 @@
+"""Throwaway local stack for benchmarks: Postgres, Redis and the API on free ports.
+
+Postgres and Redis run as child processes from the binaries on PATH (or
+--pg-bin for a Postgres install outside PATH) with durability turned off; the
+API runs under gunicorn, which applies the migrations before the workers start.
+Everything lives in a temporary directory that is removed on exit.
+
+    python bench/stack.py --worker-class gthread   # prints env and URL, Ctrl+C to stop
+"""
+import argparse
+import glob
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def find_binary(name, extra_dir=None):
+    candidates = [os.path.join(extra_dir, name)] if extra_dir else []
+    candidates += [shutil.which(name) or '']
+    # Debian/Ubuntu кладут серверные утилиты Postgres вне PATH
+    candidates += sorted(glob.glob(f'/usr/lib/postgresql/*/bin/{name}'), reverse=True)
+    for path in candidates:
+        if path and os.access(path, os.X_OK):
+            return path
+    raise SystemExit(f'{name} not found; install it or pass --pg-bin')
+
+
+def wait_for(check, timeout, what):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f'{what} did not start in {timeout}s')
+
+
+def _health(url):
+    with urllib.request.urlopen(url + '/health', timeout=2) as response:
+        return response.status == 200
+
+
+def _redis_ping(port):
+    with socket.create_connection(('127.0.0.1', port), timeout=1) as sock:
+        sock.sendall(b'PING\r\n')
+        return sock.recv(16).startswith(b'+PONG')
+
+
+class LocalStack:
+    def __init__(self, pg_bin=None, api_env=None, keep_logs=False):
+        self.pg_bin = pg_bin
+        self.api_env = api_env or {}
+        self.keep_logs = keep_logs
+        self.dir = None
+        self.processes = []
+        self.pg_data = None
+        self.env = {}
+        self.url = None
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix='shop-bench-')
+        try:
+            self._start_postgres()
+            self._start_redis()
+            self._start_api()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _log(self, name):
+        return open(os.path.join(self.dir, f'{name}.log'), 'ab')
+
+    def _start_postgres(self):
+        port = free_port()
+        self.pg_data = os.path.join(self.dir, 'pg')
+        subprocess.run([find_binary('initdb', self.pg_bin), '-D', self.pg_data, '-U', 'postgres',
+                        '-A', 'trust', '-E', 'UTF8', '--no-sync'],
+                       check=True, stdout=subprocess.DEVNULL)
+        # Надёжность записи не нужна: базу всё равно удаляем после прогона
+        options = (f'-p {port} -k {self.dir} -c listen_addresses=127.0.0.1 -c fsync=off '
+                   f'-c synchronous_commit=off -c full_page_writes=off -c max_connections=200')
+        subprocess.run([find_binary('pg_ctl', self.pg_bin), '-D', self.pg_data, '-o', options,
+                        '-l', os.path.join(self.dir, 'postgres.log'), '-w', 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+        self.env.update({'PG_USERNAME': 'postgres', 'PG_PASSWORD': 'postgres', 'PG_HOST': '127.0.0.1',
+                         'PG_PORT': str(port), 'PG_DB': 'postgres'})
+
+    def _start_redis(self):
+        port = free_port()
+        self.processes.append(subprocess.Popen(
+            [find_binary('redis-server'), '--port', str(port), '--bind', '127.0.0.1',
+             '--save', '', '--appendonly', 'no', '--maxclients', '20000'],
+            stdout=self._log('redis'), stderr=subprocess.STDOUT))
+        wait_for(lambda: _redis_ping(port), 10, 'redis-server')
+        self.env.update({'REDIS_HOST': '127.0.0.1', 'REDIS_PORT': str(port), 'REDIS_DB': '0'})
+
+    def _start_api(self):
+        port = free_port()
+        env = dict(os.environ, **self.env)
+        env.update({'WEB_PORT': str(port), 'LOG_DIR': os.path.join(self.dir, 'logs'),
+                    'PROMETHEUS_MULTIPROC_DIR': os.path.join(self.dir, 'metrics')})
+        env.update(self.api_env)
+        self.processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+            cwd=APP_DIR, env=env, stdout=self._log('api'), stderr=subprocess.STDOUT))
+        self.url = f'http://127.0.0.1:{port}'
+        wait_for(lambda: _health(self.url), 60, 'API')
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in reversed(self.processes):
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = []
+        if self.pg_data and os.path.exists(os.path.join(self.pg_data, 'postmaster.pid')):
+            subprocess.run([find_binary('pg_ctl', self.pg_bin), '-D', self.pg_data, '-m', 'fast', 'stop'],
+                           stdout=subprocess.DEVNULL)
+        if self.dir:
+            if self.keep_logs:
+                print(f'logs kept in {self.dir}', file=sys.stderr)
+            else:
+                shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+
+def add_arguments(parser):
+    parser.add_argument('--pg-bin', help='directory with initdb and pg_ctl')
+    parser.add_argument('--worker-class', default='gevent', choices=('gevent', 'gthread'))
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--keep-logs', action='store_true')
+    parser.add_argument('--api-env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the API, e.g. TOKEN_MODE=signed')
+
+
+def from_args(args):
+    api_env = {'WEB_WORKER_CLASS': args.worker_class, 'WEB_WORKERS': str(args.workers),
+               'WEB_THREADS': str(args.threads)}
+    api_env.update(item.split('=', 1) for item in args.api_env)
+    return LocalStack(args.pg_bin, api_env, args.keep_logs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    args = parser.parse_args()
+    with from_args(args) as stack:
+        for name, value in sorted(stack.env.items()):
+            print(f'export {name}={value}')
+        print(f'# API: {stack.url}, logs: {stack.dir}')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""Concurrency benchmark for checkout: reservations, POST /order and the stock decrement.
+
+Each client thread logs in as its own user and keeps checking out random carts
+over a handful of hot products through the API: POST /cart/add reserves stock
+(409 when the free stock is reserved by other carts), POST /order writes it
+off (409 when the stock ran out), DELETE /cart drops a rejected cart and its
+reservations. Demand is far above the stock, so the products sell out during
+the run. Afterwards the stock in Postgres is checked against the order items
+of the committed orders, and GET /products/<id> against Postgres. The run
+fails (exit code 1) if any product's stock goes below zero, the stock written
+off differs from the quantity sold, an order item is not positive, the catalog
+cache serves stale stock or a negative quantity is accepted into a cart.
+Without --url the API, Postgres and Redis are started locally (see stack.py);
+with --url the running instance is seeded through the PG_*/REDIS_* variables.
+
+    python bench/stock_oversell.py --concurrency 32 --attempts 50 --output bench/results/stock-oversell.json
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+import bcrypt
+from redis import Redis
+from sqlalchemy import create_engine, text
+
+import stack
+from common import ApiClient, database_url, login, summarize
+
+sys.path.insert(0, stack.APP_DIR)
+import catalog  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+USER_PREFIX = 'bench_oversell_'
+PRODUCT_PREFIX = 'bench-hot-'
+PRODUCT_CACHE_TTL = 300
+
+
+def seed(engine, redis_client, users, products, stock, password, rounds):
+    # Один хеш на всех: bcrypt на каждого пользователя занял бы минуты
+    hashed = bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+    with engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO lab2.users (username, password, role) "
+            "SELECT :prefix || n, :password, 'user' FROM generate_series(0, :count - 1) AS n "
+            "ON CONFLICT (username) DO UPDATE SET password = EXCLUDED.password"),
+            {'prefix': USER_PREFIX, 'password': hashed, 'count': users})
+        created = conn.execute(text(
+            "INSERT INTO lab2.products (name, price, stock) "
+            "SELECT :prefix || n, 1.0, :stock FROM generate_series(1, :count) AS n "
+            "RETURNING id, name, price, stock"), {'prefix': PRODUCT_PREFIX, 'stock': stock, 'count': products}).fetchall()
+    catalog.products_changed(redis_client, [(None, dict(row._mapping)) for row in created], PRODUCT_CACHE_TTL)
+    return [row.id for row in created]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+
+    def call(self, client, method, endpoint, path, body=None):
+        start = time.perf_counter()
+        try:
+            status, response = client.request(method, path, body)
+        except (OSError, http.client.HTTPException):
+            status, response = 'error', None
+        self.latencies.setdefault(endpoint, []).append(time.perf_counter() - start)
+        counts = self.statuses.setdefault(endpoint, {})
+        counts[str(status)] = counts.get(str(status), 0) + 1
+        return status, response
+
+
+def worker(url, token, product_ids, attempts, max_lines, max_quantity, rng, recorder, orders, lock):
+    client = ApiClient(url, token)
+    created = []
+    for _ in range(attempts):
+        lines = rng.sample(product_ids, rng.randint(1, min(max_lines, len(product_ids))))
+        added = 0
+        for product_id in lines:
+            status, _ = recorder.call(client, 'POST', 'POST /cart/add', '/cart/add',
+                                      {'product_id': product_id, 'quantity': rng.randint(1, max_quantity)})
+            added += status == 200
+        if not added:
+            continue
+        status, body = recorder.call(client, 'POST', 'POST /order', '/order')
+        if status == 201:
+            created.append(body['order_id'])
+        else:
+            # Отклонённая корзина восстановлена вместе с резервами; снимаем их
+            recorder.call(client, 'DELETE', 'DELETE /cart', '/cart')
+    client.close()
+    with lock:
+        orders.extend(created)
+
+
+# Отрицательное количество не должно попасть в корзину: при оформлении оно увеличило бы
+# остаток. Проверяется до прогона, пока товар есть в наличии, на фоне чужого резерва,
+# за счёт которого отрицательный резерв проходил проверку свободного остатка.
+def probe_negative(url, tokens, product_id):
+    other, client = ApiClient(url, tokens[1]), ApiClient(url, tokens[0])
+    other.request('POST', '/cart/add', {'product_id': product_id, 'quantity': 10})
+    status, _ = client.request('POST', '/cart/add', {'product_id': product_id, 'quantity': -5})
+    for api in (client, other):
+        api.request('DELETE', '/cart')
+        api.close()
+    return status
+
+
+def check(url, token, engine, product_ids, stock, orders):
+    with engine.connect() as conn:
+        final = dict(conn.execute(
+            text("SELECT id, stock FROM lab2.products WHERE id = ANY(:ids)"), {'ids': product_ids}).fetchall())
+        sold = dict(conn.execute(text(
+            "SELECT product_id, sum(quantity) FROM lab2.order_items "
+            "WHERE order_id = ANY(:orders) AND product_id = ANY(:ids) GROUP BY product_id"),
+            {'orders': orders, 'ids': product_ids}).fetchall())
+        non_positive = conn.execute(text(
+            "SELECT count(*) FROM lab2.order_items WHERE product_id = ANY(:ids) AND quantity <= 0"),
+            {'ids': product_ids}).scalar()
+    client = ApiClient(url, token)
+    products = []
+    for product_id in product_ids:
+        status, body = client.request('GET', f'/products/{product_id}')
+        products.append({
+            'id': product_id,
+            'stock_before': stock,
+            'stock_after': final[product_id],
+            'sold': int(sold.get(product_id, 0)),
+            'cached_stock': body.get('stock') if status == 200 else None,
+        })
+    client.close()
+    return products, non_positive
+
+
+# Заказы прогона и горячие товары удаляются, товары - и из кэша каталога
+def cleanup(engine, redis_client, product_ids, orders):
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM lab2.order_items WHERE order_id = ANY(:orders)"), {'orders': orders})
+        conn.execute(text("DELETE FROM lab2.orders WHERE id = ANY(:orders)"), {'orders': orders})
+        deleted = conn.execute(text(
+            "DELETE FROM lab2.products WHERE id = ANY(:ids) RETURNING id, name, price, stock"),
+            {'ids': product_ids}).fetchall()
+    catalog.products_changed(redis_client, [(dict(row._mapping), None) for row in deleted], PRODUCT_CACHE_TTL)
+
+
+def run(url, env, args):
+    engine = create_engine(database_url(env))
+    redis_client = Redis(host=env.get('REDIS_HOST'), port=int(env.get('REDIS_PORT') or 6379),
+                         db=int(env.get('REDIS_DB') or 0))
+    product_ids = seed(engine, redis_client, args.concurrency, args.products, args.stock, args.password,
+                       args.hash_rounds)
+    tokens = [login(url, f'{USER_PREFIX}{i}', args.password) for i in range(args.concurrency)]
+    negative_status = probe_negative(url, tokens, product_ids[0])
+
+    recorders = [Recorder() for _ in range(args.concurrency)]
+    orders, lock = [], threading.Lock()
+    threads = [
+        threading.Thread(target=worker, args=(url, tokens[i], product_ids, args.attempts, args.max_lines,
+                                              args.max_quantity, random.Random(args.seed + i), recorders[i],
+                                              orders, lock))
+        for i in range(args.concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    try:
+        products, non_positive = check(url, tokens[0], engine, product_ids, args.stock, orders)
+    finally:
+        if not args.keep_products:
+            cleanup(engine, redis_client, product_ids, orders)
+        engine.dispose()
+        redis_client.close()
+
+    endpoints = {}
+    for endpoint in sorted({endpoint for recorder in recorders for endpoint in recorder.statuses}):
+        endpoints[endpoint] = summarize([value for recorder in recorders
+                                         for value in recorder.latencies.get(endpoint, [])], elapsed)
+        statuses = {}
+        for recorder in recorders:
+            for status, count in recorder.statuses.get(endpoint, {}).items():
+                statuses[status] = statuses.get(status, 0) + count
+        endpoints[endpoint]['statuses'] = statuses
+
+    oversold = [product['id'] for product in products
+                if product['stock_after'] < 0 or product['stock_before'] - product['stock_after'] != product['sold']]
+    stale = [product['id'] for product in products if product['cached_stock'] != product['stock_after']]
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'target': url if args.url else f'local {args.worker_class} x{args.workers}',
+            'concurrency': args.concurrency,
+            'attempts': args.attempts,
+            'products': args.products,
+            'stock': args.stock,
+            'max_lines': args.max_lines,
+            'max_quantity': args.max_quantity,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+        },
+        'elapsed': round(elapsed, 3),
+        'orders': len(orders),
+        'endpoints': endpoints,
+        'products': products,
+        'checks': {
+            'oversold_products': oversold,
+            'stale_cached_products': stale,
+            'non_positive_order_items': non_positive,
+            'negative_quantity_status': negative_status,
+        },
+    }
+
+
+def failures(result):
+    checks = result['checks']
+    problems = []
+    if checks['oversold_products']:
+        problems.append(f'oversold products {checks["oversold_products"]}')
+    if checks['stale_cached_products']:
+        problems.append(f'stale cached stock for {checks["stale_cached_products"]}')
+    if checks['non_positive_order_items']:
+        problems.append(f'{checks["non_positive_order_items"]} non-positive order items')
+    if checks['negative_quantity_status'] != 400:
+        problems.append(f'negative quantity answered {checks["negative_quantity_status"]}')
+    return problems
+
+
+def print_result(result):
+    for product in result['products']:
+        print(f'product {product["id"]}: stock {product["stock_before"]} -> {product["stock_after"]}, '
+              f'sold {product["sold"]}, cached {product["cached_stock"]}')
+    print(f'{"endpoint":<16} {"count":>7} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8}  statuses')
+    for endpoint, row in result['endpoints'].items():
+        print(f'{endpoint:<16} {row["count"]:>7} {row["rps"]:>8.1f} {row["p50_ms"]:>8.1f} {row["p99_ms"]:>8.1f}  '
+              f'{row["statuses"]}')
+    print(f'orders: {result["orders"]} in {result["elapsed"]:.1f}s')
+    print(f'oversold products: {len(result["checks"]["oversold_products"])}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='running API; by default a local stack is started')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent shoppers, one user each (at least 2)')
+    parser.add_argument('--attempts', type=int, default=50, help='checkouts per thread')
+    parser.add_argument('--products', type=int, default=3, help='number of hot products')
+    parser.add_argument('--stock', type=int, default=200, help='initial stock per hot product')
+    parser.add_argument('--max-lines', type=int, default=3)
+    parser.add_argument('--max-quantity', type=int, default=3)
+    parser.add_argument('--password', default='bench-password')
+    parser.add_argument('--hash-rounds', type=int, default=12,
+                        help='bcrypt cost of the seeded users (the API rehashes to its own on login)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the client threads')
+    parser.add_argument('--keep-products', action='store_true', help='keep the hot products and the orders')
+    parser.add_argument('--output')
+    stack.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.url:
+        env = {name: os.environ[name] for name in os.environ if name.startswith(('PG_', 'REDIS_'))}
+        result = run(args.url, env, args)
+    else:
+        local = stack.from_args(args)
+        local.api_env['PASSWORD_HASH_ROUNDS'] = str(args.hash_rounds)
+        with local:
+            result = run(local.url, local.env, args)
+    print_result(result)
+    output = args.output or os.path.join(BENCH_DIR, 'results', f'{time.strftime("%Y%m%d-%H%M%S")}-stock-oversell.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+        f.write('\n')
+    print(f'saved {output}')
+    problems = failures(result)
+    for problem in problems:
+        print(f'FAIL: {problem}')
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
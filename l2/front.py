@@ -2,11 +2,26 @@ import streamlit as st
 import requests
 import pandas as pd
 import json
+import random
+import threading
 import time
+from collections import OrderedDict, deque
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 
 # Backend API URL
 BASE_URL = "http://localhost:5000"
+REQUEST_TIMEOUT = 10  # seconds
+# The API sends a keepalive comment every 15 seconds; silence longer than this means a dead stream
+STREAM_READ_TIMEOUT = 45  # seconds
+STREAM_MAX_BACKOFF = 30  # seconds
+# A stream nobody has rendered for this long is closed; reopening resumes from Last-Event-ID
+STREAM_IDLE_TIMEOUT = 60  # seconds
+NOTIFICATIONS_SHOWN = 20
+CATALOG_CACHE_TTL = 30  # seconds before a cached catalog page is revalidated
+CART_CACHE_TTL = 10  # seconds
+RESPONSE_CACHE_SIZE = 256  # responses kept per browser session
+PICKER_PAGE_SIZE = 50
 
 # Initialize session state
 if "token" not in st.session_state:
@@ -15,25 +30,233 @@ if "role" not in st.session_state:
     st.session_state.role = None
 if "username" not in st.session_state:
     st.session_state.username = None
+if "response_cache" not in st.session_state:
+    st.session_state.response_cache = OrderedDict()
+
+@st.cache_resource
+def get_http_session():
+    """Keep-alive connection pool shared by all browser sessions of this server."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=32)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 def make_authenticated_request(method, endpoint, **kwargs):
     """Make an authenticated request to the backend."""
     headers = {"Authorization": st.session_state.token} if st.session_state.token else {}
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
     try:
-        response = getattr(requests, method)(f"{BASE_URL}{endpoint}", headers=headers, **kwargs)
+        response = get_http_session().request(method, f"{BASE_URL}{endpoint}", headers=headers, **kwargs)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
         st.error(f"Error: {str(e)}")
         return None
 
+def cached_get(endpoint, ttl, params=None):
+    """GET through the session's response cache, keyed by token, endpoint and params.
+
+    A fresh entry is returned without a request. A stale one is revalidated with
+    If-None-Match, and a 304 keeps the cached body.
+    """
+    cache = st.session_state.response_cache
+    key = (st.session_state.token, endpoint, tuple(sorted((params or {}).items())))
+    entry = cache.get(key)
+    now = time.monotonic()
+    if entry and now - entry["fetched_at"] < ttl:
+        cache.move_to_end(key)
+        return entry["body"]
+    headers = {"Authorization": st.session_state.token} if st.session_state.token else {}
+    if entry and entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    try:
+        response = get_http_session().get(f"{BASE_URL}{endpoint}", params=params, headers=headers,
+                                          timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304 and entry:
+            body = entry["body"]
+        else:
+            response.raise_for_status()
+            body = response.json()
+    except requests.exceptions.RequestException as e:
+        st.error(f"Error: {str(e)}")
+        return None
+    cache[key] = {"etag": response.headers.get("ETag"), "body": body, "fetched_at": now}
+    cache.move_to_end(key)
+    while len(cache) > RESPONSE_CACHE_SIZE:
+        cache.popitem(last=False)
+    return body
+
+def invalidate_cache(endpoint):
+    """Drop cached responses of an endpoint (and its sub-paths) after a change."""
+    cache = st.session_state.response_cache
+    for key in [key for key in cache if key[1] == endpoint or key[1].startswith(endpoint + "/")]:
+        del cache[key]
+
+def fetch_products(limit=100, **params):
+    """Fetch one page of the product catalog."""
+    return cached_get("/products", CATALOG_CACHE_TTL, {"limit": limit, **params})
+
+def product_picker(key, label):
+    """Searchable, paged product selector.
+
+    Pages are fetched by name with the API's keyset cursor, so only one page of the
+    catalog is loaded and rendered at a time. Returns the selected id and the page.
+    """
+    query = st.text_input("Search by name", key=f"{key}_query").strip()
+    # Cursors of the pages visited so far; the last one is the current page
+    if st.session_state.get(f"{key}_last_query") != query:
+        st.session_state[f"{key}_last_query"] = query
+        st.session_state[f"{key}_cursors"] = [None]
+    cursors = st.session_state[f"{key}_cursors"]
+    params = {"sort": "name", **(cursors[-1] or {})}
+    if query:
+        params["q"] = query
+    page = fetch_products(PICKER_PAGE_SIZE, **params)
+    if not page:
+        return None, []
+    products = page["products"]
+    if not products:
+        st.info("No products found")
+        return None, []
+    col1, col2, col3 = st.columns([1, 1, 2])
+    with col1:
+        if st.button("Previous", key=f"{key}_prev", disabled=len(cursors) == 1):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        if st.button("Next", key=f"{key}_next", disabled=page["next"] is None):
+            cursors.append(page["next"])
+            st.rerun()
+    with col3:
+        st.caption(f"Page {len(cursors)}")
+    names = {p["id"]: p["name"] for p in products}
+    product_id = st.selectbox(label, list(names), format_func=lambda x: f"{names[x]} (ID: {x})",
+                              key=f"{key}_select")
+    return product_id, products
+
+class NotificationStream:
+    """Background consumer of /notifications/sub for one logged-in browser session.
+
+    Keeps the latest notifications in memory for rendering. A dropped connection is
+    reopened with exponential backoff and jitter, sending Last-Event-ID so the API
+    replays whatever was published in between.
+    """
+
+    def __init__(self, token, history):
+        self.token = token
+        self.session = get_http_session()
+        self.events = deque(history, maxlen=NOTIFICATIONS_SHOWN)
+        self.last_event_id = history[-1]["id"] if history else None
+        self.connected = False
+        self.expired = False
+        self.error = None
+        self.last_seen = time.monotonic()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="notification-stream", daemon=True)
+        self._thread.start()
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def stop(self):
+        self._stop.set()
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.events)
+
+    def _run(self):
+        base_delay = delay = 1.0
+        while not self._stop.is_set():
+            if time.monotonic() - self.last_seen > STREAM_IDLE_TIMEOUT:
+                break
+            try:
+                retry = self._consume()
+                if retry:
+                    base_delay = retry
+                delay = base_delay
+            except (requests.exceptions.RequestException, ValueError) as e:
+                self.error = str(e)
+            self.connected = False
+            # Full jitter keeps reconnecting tabs from hitting the API in lockstep
+            self._stop.wait(random.uniform(0, delay))
+            delay = min(delay * 2, STREAM_MAX_BACKOFF)
+
+    def _consume(self):
+        headers = {"Authorization": self.token, "Accept": "text/event-stream"}
+        if self.last_event_id:
+            headers["Last-Event-ID"] = self.last_event_id
+        retry = None
+        with self.session.get(f"{BASE_URL}/notifications/sub", headers=headers, stream=True,
+                              timeout=(REQUEST_TIMEOUT, STREAM_READ_TIMEOUT)) as response:
+            if response.status_code == 401:
+                self.error = "Session expired, please login again"
+                self.expired = True
+                self._stop.set()
+                return None
+            response.raise_for_status()
+            self.connected = True
+            self.error = None
+            data = []
+            for line in response.iter_lines(decode_unicode=True):
+                if self._stop.is_set() or time.monotonic() - self.last_seen > STREAM_IDLE_TIMEOUT:
+                    break
+                if line:
+                    field, _, value = line.partition(":")
+                    value = value[1:] if value.startswith(" ") else value
+                    if field == "data":
+                        data.append(value)
+                    elif field == "retry" and value.isdigit():
+                        retry = int(value) / 1000
+                    continue
+                # Blank line: dispatch the event; comments (keepalive) carry no data
+                if data:
+                    self._dispatch("\n".join(data))
+                data = []
+        return retry
+
+    def _dispatch(self, data):
+        event = json.loads(data)
+        # The greeting has no id and is not a notification
+        if "id" not in event:
+            return
+        with self._lock:
+            self.events.append(event)
+            self.last_event_id = event["id"]
+
+def notification_stream():
+    """Stream of the current session, started with the recent history on first use."""
+    stream = st.session_state.get("notification_stream")
+    if stream is not None and stream.token != st.session_state.token:
+        stream.stop()
+        stream = None
+    if stream is not None and not stream.is_alive() and not stream.expired:
+        # Closed while nobody looked: resume from the last seen event instead of refetching
+        stream = NotificationStream(stream.token, stream.snapshot())
+        st.session_state.notification_stream = stream
+    if stream is None:
+        page = make_authenticated_request("get", "/notifications", params={"limit": NOTIFICATIONS_SHOWN})
+        if page is None:
+            return None
+        # The API returns the newest first
+        stream = NotificationStream(st.session_state.token, list(reversed(page["notifications"])))
+        st.session_state.notification_stream = stream
+    stream.touch()
+    return stream
+
 def login():
     """Login form."""
     st.subheader("Login")
     username = st.text_input("Username", key="login_username")
     password = st.text_input("Password", type="password", key="login_password")
     if st.button("Login"):
-        response = requests.post(f"{BASE_URL}/login", json={"username": username, "password": password})
+        response = get_http_session().post(f"{BASE_URL}/login", json={"username": username, "password": password},
+                                           timeout=REQUEST_TIMEOUT)
         if response.status_code == 200:
             data = response.json()
             st.session_state.token = data["token"]
@@ -50,7 +273,8 @@ def register():
     username = st.text_input("Username", key="register_username")
     password = st.text_input("Password", type="password", key="register_password")
     if st.button("Register"):
-        response = requests.post(f"{BASE_URL}/register", json={"username": username, "password": password})
+        response = get_http_session().post(f"{BASE_URL}/register", json={"username": username, "password": password},
+                                           timeout=REQUEST_TIMEOUT)
         if response.status_code == 201:
             st.success("Registered successfully! Please login.")
         else:
@@ -58,24 +282,28 @@ def register():
 
 def logout():
     """Logout function."""
+    make_authenticated_request("post", "/logout")
+    stream = st.session_state.pop("notification_stream", None)
+    if stream is not None:
+        stream.stop()
     st.session_state.token = None
     st.session_state.role = None
     st.session_state.username = None
+    st.session_state.response_cache.clear()
     st.success("Logged out successfully!")
     st.rerun()
 
 def show_products():
     """Display product catalog."""
     st.subheader("Product Catalog")
-    products = make_authenticated_request("get", "/products")
+    product_id, products = product_picker("catalog", "Select Product to Add to Cart")
     if products:
-        df = pd.DataFrame(products)
-        st.dataframe(df[["id", "name", "price", "stock"]])
-        product_id = st.selectbox("Select Product to Add to Cart", df["id"], format_func=lambda x: f"{df[df['id'] == x]['name'].iloc[0]} (ID: {x})")
+        st.dataframe(pd.DataFrame(products)[["id", "name", "price", "stock"]])
         quantity = st.number_input("Quantity", min_value=1, value=1)
         if st.button("Add to Cart"):
             if st.session_state.token:
                 response = make_authenticated_request("post", "/cart/add", json={"product_id": product_id, "quantity": quantity})
+                invalidate_cache("/cart")
                 if response:
                     st.success(response.get("message", "Added to cart"))
             else:
@@ -87,7 +315,7 @@ def show_cart():
     if not st.session_state.token:
         st.error("Please login to view your cart")
         return
-    cart = make_authenticated_request("get", "/cart")
+    cart = cached_get("/cart", CART_CACHE_TTL)
     if cart and cart.get("cart"):
         df = pd.DataFrame([(k, v) for k, v in cart["cart"].items()], columns=["Product ID", "Quantity"])
         st.dataframe(df)
@@ -95,12 +323,14 @@ def show_cart():
         with col1:
             if st.button("Clear Cart"):
                 response = make_authenticated_request("delete", "/cart")
+                invalidate_cache("/cart")
                 if response:
                     st.success(response.get("message", "Cart cleared"))
                     st.rerun()
         with col2:
             if st.button("Create Order"):
                 response = make_authenticated_request("post", "/order")
+                invalidate_cache("/cart")
                 if response:
                     st.success(f"Order created: {response.get('order_id')}")
                     st.rerun()
@@ -113,23 +343,25 @@ def show_notifications():
     if not st.session_state.token:
         st.error("Please login to view notifications")
         return
-    notifications = make_authenticated_request("get", "/notifications")
-    if notifications and notifications.get("notifications"):
-        df = pd.DataFrame(notifications["notifications"])
+    render_notifications()
+
+@st.fragment(run_every=2)
+def render_notifications():
+    """Re-render the stream buffer in place; new events arrive over SSE, not by polling."""
+    stream = notification_stream()
+    if stream is None:
+        return
+    if stream.error:
+        st.warning(f"Notification stream: {stream.error}")
+    elif not stream.connected:
+        st.caption("Connecting to the notification stream...")
+    events = stream.snapshot()
+    if events:
+        df = pd.DataFrame(list(reversed(events)))
         df["timestamp"] = df["timestamp"].apply(lambda x: datetime.fromtimestamp(x).strftime("%Y-%m-%d %H:%M:%S"))
         st.dataframe(df[["order_id", "status", "message", "timestamp"]])
     else:
         st.info("No notifications available")
-    
-    # Placeholder for real-time notifications (simplified polling)
-    if st.checkbox("Enable Real-Time Notifications"):
-        placeholder = st.empty()
-        while True:
-            notifications = make_authenticated_request("get", "/notifications")
-            if notifications and notifications.get("notifications"):
-                latest = notifications["notifications"][0]
-                placeholder.write(f"Latest: {latest['message']} at {datetime.fromtimestamp(latest['timestamp']).strftime('%Y-%m-%d %H:%M:%S')}")
-            time.sleep(5)
 
 def show_admin_panel():
     """Admin panel for product and order management."""
@@ -145,14 +377,14 @@ def show_admin_panel():
     stock = st.number_input("Stock", min_value=0, step=1)
     if st.button("Create Product"):
         response = make_authenticated_request("post", "/products", json={"name": name, "price": price, "stock": stock})
+        invalidate_cache("/products")
         if response:
             st.success(response.get("message", "Product created"))
     
     # Update/Delete Product
     st.write("### Update/Delete Product")
-    products = make_authenticated_request("get", "/products")
+    product_id, products = product_picker("admin", "Select Product")
     if products:
-        product_id = st.selectbox("Select Product", [p["id"] for p in products], format_func=lambda x: next(p["name"] for p in products if p["id"] == x))
         new_name = st.text_input("New Name")
         new_price = st.number_input("New Price", min_value=0.0, step=0.01)
         new_stock = st.number_input("New Stock", min_value=0, step=1)
@@ -160,11 +392,13 @@ def show_admin_panel():
         with col1:
             if st.button("Update Product"):
                 response = make_authenticated_request("put", f"/products/{product_id}", json={"name": new_name, "price": new_price, "stock": new_stock})
+                invalidate_cache("/products")
                 if response:
                     st.success(response.get("message", "Product updated"))
         with col2:
             if st.button("Delete Product"):
                 response = make_authenticated_request("delete", f"/products/{product_id}")
+                invalidate_cache("/products")
                 if response:
                     st.success(response.get("message", "Product deleted"))
                     st.rerun()
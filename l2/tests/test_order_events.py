@@ -0,0 +1,59 @@
+import notification_hub
+import order_events
+
+
+class FakeRedis:
+    """Отдаёт заранее заданные ответы скрипта XAUTOCLAIM и запоминает XACK."""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.calls = []
+        self.acked = []
+
+    def register_script(self, script):
+        assert script == order_events.XAUTOCLAIM_SCRIPT
+
+        def run(keys, args):
+            self.calls.append((keys, args))
+            return self.replies.pop(0)
+        return run
+
+    def xack(self, stream, group, *ids):
+        self.acked.extend(ids)
+
+
+def make_consumer(client, handled):
+    return order_events.Consumer(client, 'group', 'worker-1', handled.append, stream='orders:events')
+
+
+def test_claim_stale_with_empty_pel():
+    client = FakeRedis([[b'0-0', [], []]])
+    handled = []
+    consumer = make_consumer(client, handled)
+
+    assert consumer.claim_stale() == 0
+    assert consumer._claim_cursor == '0-0'
+    assert handled == [] and client.acked == []
+
+
+def test_claim_stale_advances_cursor():
+    data = notification_hub.pack({'order_id': 5, 'status': 'Pending'})
+    client = FakeRedis([
+        [b'1700000000000-3', [
+            [b'1-0', [b'user_id', b'7', b'event_id', b'1-0', b'data', data]],
+            [b'2-0', None],  # запись удалена из потока (Redis 6.2)
+        ], []],
+        [b'0-0', [], []],
+    ])
+    handled = []
+    consumer = make_consumer(client, handled)
+
+    assert consumer.claim_stale() == 2
+    assert consumer._claim_cursor == '1700000000000-3'
+    assert [(event['user_id'], event['order_id']) for event in handled] == [('7', 5)]
+    assert client.acked == [b'1-0', b'2-0']
+
+    consumer.claim_stale()
+    assert client.calls[0][1][3] == '0-0'
+    assert client.calls[1][1][3] == '1700000000000-3'
+    assert consumer._claim_cursor == '0-0'